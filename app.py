@@ -2,8 +2,12 @@ import streamlit as st
 from collections import namedtuple
 from iep_goal_generator import My_IEP_Goal_Generator
 from rag_utils import StudentProfile
+from retrieval_utils import DEFAULT_CATEGORY_QUOTAS
+from cache_utils import ResponseCache
+from metrics_utils import METRICS
 
 import sys
+import time
 
 
 
@@ -17,7 +21,10 @@ def load_agent():
     This function caches the agent across reruns.
     We assume our agent is deterministic and does not change wth input
     """
-    agent = My_IEP_Goal_Generator(model="gpt-4", open_ai_key=open_ai_key)
+    ## Resubmitting the same profile returns the cached goals instead of calling the model again.
+    ## The vector store is loaded on a background thread, so the page renders right away.
+    agent = My_IEP_Goal_Generator(model="gpt-4", open_ai_key=open_ai_key, response_cache=ResponseCache()
+                                    , startup="background")
     agent.create_rag_pipeline()
     return agent
 
@@ -36,6 +43,77 @@ st.set_page_config(page_title="IEP Goal Generator", layout="centered")
 agent = load_agent()
 
 
+def show_warm_up_status(status:dict):
+    "Shows the warm-up progress until the agent is ready, then a one-line summary."
+    if status['state'] == "ready":
+        st.caption(f"✅ Ready: {status.get('chunks')} document chunks ({status['source']}, loaded in {status['elapsed_s']:.1f}s)")
+    elif status['state'] == "failed":
+        st.error(f"The IEP assistant could not start: {status['error']}")
+    else:
+        st.progress(status['progress'], text=f"Warming up: {status['stage']}...")
+
+
+@st.fragment(run_every=1.0)
+def poll_warm_up_status():
+    "Refreshes the warm-up progress every second, and reruns the app once when the warm-up is over."
+    status = agent.status()
+    if status['state'] in ("ready", "failed"):
+        ## The rerun renders the final state outside of this fragment, which stops the polling
+        st.rerun()
+    show_warm_up_status(status)
+
+
+
+warm_up_status = agent.status()
+if warm_up_status['state'] in ("ready", "failed"):
+    show_warm_up_status(warm_up_status)
+else:
+    poll_warm_up_status()
+
+
+def show_diagnostics():
+    "Shows the stage timings of the last request, the latency per stage, the cache hit rates and the token counts."
+    with st.expander("🔎 Diagnostics", expanded=True):
+        trace = METRICS.last_trace()
+        if trace:
+            st.markdown("**Last request**")
+            parents = {span['span_id']: span['parent_id'] for span in trace}
+            rows = []
+            ## Spans finish child first, so they are listed by start time
+            for span in sorted(trace, key=lambda span: span['started_at']):
+                depth, parent = 0, span['parent_id']
+                while parent in parents:
+                    depth, parent = depth + 1, parents[parent]
+                attrs = {key: value for key, value in span.items()
+                            if key not in ('span', 'trace_id', 'span_id', 'parent_id', 'started_at', 'duration_s', 'error')}
+                rows.append({'stage': "· " * depth + span['span']
+                                , 'duration_s': round(span['duration_s'], 3)
+                                , 'error': span['error'] or ""
+                                , 'details': ", ".join(f"{key}={value}" for key, value in attrs.items())})
+            st.dataframe(rows, hide_index=True)
+
+        summary = METRICS.stage_summary()
+        if summary:
+            st.markdown("**Latency per stage**")
+            st.dataframe([dict(stage=stage, **stats) for stage, stats in summary.items()], hide_index=True)
+
+        caches = METRICS.cache_stats()
+        if caches:
+            st.markdown("**Caches**")
+            st.dataframe([dict(cache=name, **stats) for name, stats in caches.items()], hide_index=True)
+
+        tokens = [counter for counter in METRICS.snapshot()['counters'] if counter['name'].endswith("tokens_total")]
+        if tokens:
+            st.markdown("**Tokens**")
+            st.dataframe([dict(metric=counter['name'], **counter['labels'], value=counter['value']) for counter in tokens]
+                            , hide_index=True)
+
+        st.download_button("Download metrics (Prometheus)", METRICS.prometheus_text(), file_name="rag_iep_metrics.txt")
+
+
+## The diagnostics are shown at the bottom of the page, after the tabs have run
+show_diagnostics_panel = st.sidebar.checkbox("Show diagnostics", value=False)
+
 # Set up tabs
 tab1, tab2 = st.tabs(["🎯 IEP Goal Generator", "💬 Live Conversation"])
 
@@ -120,30 +198,53 @@ with tab1:
             st.error("Career suggestions are required!")
 
 
-        with st.spinner("Generating goals..."):
-
-            student_profile = StudentProfile(
-                name=st.session_state.name,
-                age=st.session_state.age,
-                grade=st.session_state.grade,
-                career_interest_or_category=st.session_state.career_interests_or_category,
-                # career_interests=career_interests,
-                learning_preferences=st.session_state.learning_preferences,
-                onnet_results=st.session_state.onnet_results,
-                career_suggestions=st.session_state.career_suggestions,
-                preferred_employers=st.session_state.preferred_employers
-            )
-
-
-            # Generate the IEP goals
-            iep_output, relevant_docs = agent.generate_iep_goals(student_profile, k=10)
-
-            # Display results
-            st.success("✅ IEP Goals Generated!")
-            print("✅ IEP Goals Generated!")
+        goal_stream = None
+        warm_up_status = agent.status()
+        if warm_up_status['state'] == "failed":
+            st.error(f"The IEP goals could not be generated: the IEP assistant could not start ({warm_up_status['error']}).")
+        else:
+            with st.spinner("Retrieving documents..." if agent.is_ready() else "Waiting for the documents to be loaded..."):
+
+                student_profile = StudentProfile(
+                    name=st.session_state.name,
+                    age=st.session_state.age,
+                    grade=st.session_state.grade,
+                    career_interest_or_category=st.session_state.career_interests_or_category,
+                    # career_interests=career_interests,
+                    learning_preferences=st.session_state.learning_preferences,
+                    onnet_results=st.session_state.onnet_results,
+                    career_suggestions=st.session_state.career_suggestions,
+                    preferred_employers=st.session_state.preferred_employers
+                )
+
+
+                # Retrieve the documents; the goals are generated while they are displayed
+                try:
+                    goal_stream, relevant_docs = agent.stream_iep_goals(student_profile, hybrid=True
+                                                                        , category_quotas=DEFAULT_CATEGORY_QUOTAS)
+                except RuntimeError as exp:
+                    ## The warm-up failed while the request was waiting for it
+                    st.error(f"The IEP goals could not be generated: {exp}")
+
+        if goal_stream is not None:
+            # Display results as they are generated
             st.markdown("---")
             st.markdown(f"### IEP Goals and Transition Plan for **{st.session_state.name}**")
-            st.markdown(iep_output.content)
+            iep_output = st.write_stream(goal_stream)
+            st.success("✅ IEP Goals Generated!")
+            print("✅ IEP Goals Generated!")
+
+            timings = agent.last_timings
+            st.caption(f"First token after {timings.get('ttft_s') or 0:.1f}s, generated in {timings.get('total_s') or 0:.1f}s.")
+            if timings.get('context') is not None:
+                st.caption(f"Context: {timings['context']['tokens']} tokens ({timings['context']['tokens_saved']} saved by packing).")
+
+            cache_info = timings.get('cached')
+            if cache_info is not None:
+                cache_stats = agent.response_cache.stats()
+                st.caption(f"Served from the response cache ({cache_info['tier']} match, generated "
+                            f"{time.strftime('%Y-%m-%d %H:%M', time.localtime(cache_info['created_at']))}). "
+                            f"Cache hit rate: {cache_stats['hit_rate']:.0%}")
 
 
 # -------------------------
@@ -168,26 +269,26 @@ with tab2:
     if "chat_messages" not in st.session_state:
         st.session_state.chat_messages = []
 
-    if submitted and user_prompt.strip():
-        # Append user's message
-        st.session_state.chat_messages.append({"role": "user", "content": user_prompt})
+    # Group messages in (user, assistant) pairs
+    messages = st.session_state.chat_messages
+    message_pairs = list(zip(messages[::2], messages[1::2]))  # step in pairs
 
-        # Get response
-        with st.spinner("Thinking..."):
+    if submitted and user_prompt.strip():
+        # Display the new question, and the response as it is generated, on top
+        with st.chat_message("user"):
+            st.markdown(user_prompt)
+        with st.chat_message("assistant"):
             try:
-                response = agent.generate_response(user_prompt)
+                response = st.write_stream(agent.stream_response(user_prompt))
             except Exception as e:
                 response = f"❌ Error: {e}"
+                st.markdown(response)
 
-        # Append agent's response
-        st.session_state.chat_messages.append({"role": "assistant", "content": response['result']})
-
-
-    # Group messages in (user, assistant) pairs
-    messages = st.session_state.chat_messages
-    message_pairs = list(zip(messages[::2], messages[1::2]))  # step in pairs
+        # Append the user's message and the agent's response
+        st.session_state.chat_messages.append({"role": "user", "content": user_prompt})
+        st.session_state.chat_messages.append({"role": "assistant", "content": response})
 
-    # Display latest pairs first
+    # Display the previous pairs, latest first
     for user_msg, assistant_msg in reversed(message_pairs):
         with st.chat_message(user_msg["role"]):
             st.markdown(user_msg["content"])
@@ -239,3 +340,7 @@ with tab2:
 
 #         # Save agent response
 #         st.session_state.chat_messages.append({"role": "assistant", "content": response['result']})
+
+
+if show_diagnostics_panel:
+    show_diagnostics()
@@ -0,0 +1,241 @@
+"""
+Generates IEP goals for a roster of students.
+
+Usage:
+    python batch_iep.py roster.csv --output goals.jsonl
+    python batch_iep.py roster.jsonl --output goals.jsonl --parquet goals.parquet --workers 8
+    python batch_iep.py roster.csv --output goals.jsonl --fake-llm --embedding-backend hashing
+
+The roster is a CSV or JSONL file with one student per row and the StudentProfile fields as columns
+(name, age, grade, career_interest_or_category, learning_preferences, onnet_results, career_suggestions,
+preferred_employers), plus an optional 'id' column. Students without an id are identified by a hash of their profile.
+
+Documents are retrieved once per distinct career_suggestions, and the goals are generated by up to --workers
+concurrent chat model calls. Each result is appended to the JSONL output, with its GoalAssessment scores, as soon
+as it is generated: re-running the same command after an interruption skips the students already in the output
+(students whose generation failed are retried). The Parquet file, if requested, is written from the JSONL output
+at the end of the run.
+"""
+import argparse
+import csv
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Iterable, List
+
+from langchain_core.messages import SystemMessage
+
+from dedup_utils import ChunkDeduplicator
+from iep_goal_generator import My_IEP_Goal_Generator, GoalAssessment
+from rag_utils import StudentProfile
+from retrieval_utils import DEFAULT_CATEGORY_QUOTAS
+
+
+
+## Statuses of the output records. Students with any other status (i.e. errors) are retried on resume.
+DONE_STATUSES = ("ok", "no_documents")
+
+## Response of the --fake-llm chat model, in the format of IEP_RAG_PROMT
+FAKE_GOALS = """Annual IEP Goal: After high school, the student will obtain a part-time job in their field of interest, as measured by employer feedback.
+Short-term Objectives:
+1. By the end of the semester, the student will complete a job application with 90% accuracy.
+2. Within 9 weeks, the student will demonstrate customer service skills in 4 out of 5 role-plays.
+Alignment to Standards: 21st century skills, employability skills."""
+
+
+def read_roster(path:str) -> List[tuple]:
+    """
+    Reads the student profiles of a CSV or JSONL roster.
+
+    Returns:
+        list: (record id, StudentProfile) pairs, in file order.
+    """
+    with open(path, "r", encoding="utf-8-sig", newline="") as f:
+        if path.lower().endswith((".jsonl", ".json")):
+            rows = [json.loads(line) for line in f if line.strip()]
+        else:
+            rows = list(csv.DictReader(f))
+
+    records = []
+    for row in rows:
+        values = {}
+        for field in StudentProfile._fields:
+            value = row.get(field)
+            values[field] = "" if value is None else value
+        if isinstance(values['age'], str) and values['age'].strip().isdigit():
+            values['age'] = int(values['age'])
+        profile = StudentProfile(**values)
+        record_id = row.get('id') or row.get('student_id') or profile_id(profile)
+        records.append((str(record_id), profile))
+    return records
+
+
+def profile_id(profile:StudentProfile) -> str:
+    return hashlib.sha1(json.dumps(profile._asdict(), sort_keys=True, default=str).encode("utf-8")).hexdigest()[:16]
+
+
+def read_checkpoint(output_path:str) -> dict:
+    """
+    Returns {record id: record} for the records already in the output (the last one for repeated ids).
+    A partially written last line, left by an interrupted run, is removed.
+    """
+    if not os.path.isfile(output_path):
+        return {}
+
+    with open(output_path, "rb+") as f:
+        content = f.read()
+        if content and not content.endswith(b"\n"):
+            content = content[:content.rfind(b"\n") + 1]
+            f.seek(len(content))
+            f.truncate()
+
+    records = {}
+    for line in content.decode("utf-8").splitlines():
+        if line.strip():
+            record = json.loads(line)
+            records[record['id']] = record
+    return records
+
+
+def generate_one(agent, record_id:str, profile:StudentProfile, relevant_docs:list) -> dict:
+    "Generates and assesses the goals of one student. Errors are returned as records, so they are retried on resume."
+    record = {'id': record_id, 'profile': profile._asdict()}
+    start = time.perf_counter()
+    try:
+        response, relevant_docs = agent.generate_iep_goals(profile, relevant_docs=relevant_docs)
+        record['goals'] = response.content
+        record['sources'] = list(dict.fromkeys(citation.get('source') for doc in relevant_docs
+                                                for citation in ChunkDeduplicator.citations(doc.metadata)))
+        if isinstance(response, SystemMessage):
+            record['status'] = "no_documents"
+        else:
+            record['status'] = "ok"
+            record['cached'] = 'cache' in response.response_metadata
+            assessment = GoalAssessment.evaluate_iep_goal(response.content, profile, relevant_docs)
+            record['assessment'] = assessment
+            record['score'] = None if assessment is None else sum(assessment.values())
+    except Exception as e:
+        record['status'] = "error"
+        record['error'] = f"{type(e).__name__}: {e}"
+    record['seconds'] = round(time.perf_counter() - start, 3)
+    return record
+
+
+def run_batch(agent, records:Iterable[tuple], output_path:str, max_workers:int=4, resume:bool=True
+                , hybrid:bool=True, category_quotas:dict=DEFAULT_CATEGORY_QUOTAS) -> dict:
+    """
+    Generates the goals of (record id, StudentProfile) records with an My_IEP_Goal_Generator, appending one
+    JSON record per student to output_path as they complete. Students whose retrieval or generation fails get a
+    record with status "error", and the others are still generated.
+
+    Args:
+        max_workers (int): Maximum number of concurrent chat model calls.
+        resume (bool): Skip the students already generated in output_path. Otherwise output_path is overwritten.
+        hybrid, category_quotas: Retrieval settings (see RAGUtils.retrieve_relevant_documents).
+
+    Returns:
+        dict: Number of records per status, 'skipped' (already done) and 'retrievals' (distinct retrievals run).
+    """
+    done = read_checkpoint(output_path) if resume else {}
+    done = {record_id for record_id, record in done.items() if record.get('status') in DONE_STATUSES}
+    if not resume and os.path.exists(output_path):
+        os.remove(output_path)
+    if os.path.dirname(output_path):
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+
+    statuses = {}
+    skipped = 0
+    documents = {}
+
+    def write(records, f):
+        for record in records:
+            f.write(json.dumps(record, default=str) + "\n")
+            f.flush()
+            statuses[record['status']] = statuses.get(record['status'], 0) + 1
+        print(f"{sum(statuses.values())} students done", flush=True)
+
+    with open(output_path, "a", encoding="utf-8") as f, ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = set()
+        for record_id, profile in records:
+            if record_id in done:
+                skipped += 1
+                continue
+
+            ## Students with the same career suggestions share the same retrieved documents
+            key = " ".join(str(profile.career_suggestions).lower().split())
+            if not key in documents:
+                try:
+                    documents[key] = agent.retrieve_documents(profile.career_suggestions, hybrid=hybrid
+                                                                , category_quotas=category_quotas)
+                except Exception as e:
+                    ## Recorded like generation errors, so the student is retried on resume and the batch goes on.
+                    ## The retrieval is tried again for the next student with the same career suggestions.
+                    write([{'id': record_id, 'profile': profile._asdict(), 'status': "error"
+                            , 'error': f"Retrieval failed: {type(e).__name__}: {e}"}], f)
+                    continue
+
+            pending.add(executor.submit(generate_one, agent, record_id, profile, documents[key]))
+            ## Bounds the number of queued students, so results are written while the roster is read
+            if len(pending) >= 2 * max_workers:
+                completed, pending = wait(pending, return_when=FIRST_COMPLETED)
+                write([future.result() for future in completed], f)
+
+        if pending:
+            completed, _ = wait(pending)
+            write([future.result() for future in completed], f)
+
+    return dict(statuses, skipped=skipped, retrievals=len(documents))
+
+
+def write_parquet(output_path:str, parquet_path:str):
+    "Writes the final record of each student in the JSONL output to a Parquet file (one column per assessment criterion)."
+    import pandas as pd
+
+    records = list(read_checkpoint(output_path).values())
+    df = pd.json_normalize(records)
+    df.to_parquet(parquet_path, index=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("roster", help="CSV or JSONL file of student profiles")
+    parser.add_argument("--output", required=True, help="JSONL file of results, also used as checkpoint")
+    parser.add_argument("--parquet", help="Also write the results to this Parquet file")
+    parser.add_argument("--workers", type=int, default=4, help="Maximum number of concurrent chat model calls")
+    parser.add_argument("--no-resume", action="store_true", help="Overwrite the output instead of resuming")
+    parser.add_argument("--model", default="gpt-4")
+    parser.add_argument("--open-ai-key", default=os.environ.get("OPENAI_API_KEY"))
+    parser.add_argument("--vstore-path", help="Snapshot root of the vector store (data/faiss_store by default)")
+    parser.add_argument("--embedding-backend", help="'openai' or 'hashing'")
+    parser.add_argument("--ingest-workers", type=int, default=os.cpu_count()
+                        , help="Worker processes parsing the source documents if the index has to be built")
+    parser.add_argument("--fake-llm", action="store_true", help="Use a fake chat model returning canned goals (no API calls)")
+    parser.add_argument("--response-cache", action="store_true", help="Reuse cached responses (see cache_utils.ResponseCache)")
+    args = parser.parse_args()
+
+    chat_model = None
+    if args.fake_llm:
+        from langchain_core.language_models import FakeListChatModel
+        chat_model = FakeListChatModel(responses=[FAKE_GOALS])
+    response_cache = None
+    if args.response_cache:
+        from cache_utils import ResponseCache
+        response_cache = ResponseCache()
+
+    agent = My_IEP_Goal_Generator(open_ai_key=args.open_ai_key, model=args.model, vstore_path=args.vstore_path
+                                    , embedding_backend=args.embedding_backend, chat_model=chat_model
+                                    , response_cache=response_cache, ingest_workers=args.ingest_workers)
+
+    records = read_roster(args.roster)
+    start = time.perf_counter()
+    counts = run_batch(agent, records, args.output, max_workers=args.workers, resume=not args.no_resume)
+    print(f"{len(records)} students in {time.perf_counter() - start:.1f}s: {counts}")
+
+    if args.parquet:
+        write_parquet(args.output, args.parquet)
+
+
+if __name__ == "__main__":
+    main()
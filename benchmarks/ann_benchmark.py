@@ -0,0 +1,148 @@
+"""
+Recall vs. latency vs. memory of the FAISS index types supported by index_utils, on a synthetic corpus.
+
+Usage:
+    python benchmarks/ann_benchmark.py --n 200000 --dim 1536 --k 10
+    python benchmarks/ann_benchmark.py --configs flat hnsw hnsw:sq8 ivf:fp16 ivfpq --nprobe 4 16 64 --json results.json
+
+The corpus is a mixture of Gaussian clusters, which is closer to real embeddings than uniform noise, and the
+queries are perturbed corpus vectors. Recall@k is measured against exact (flat) search. Latency is measured
+one query at a time, the way the app searches. Memory is the growth of the process resident set while the
+index is built, and the size of the serialized index.
+"""
+import argparse
+import gc
+import json
+import os
+import sys
+import time
+
+import faiss
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from index_utils import IndexUtils, index_config
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+
+DEFAULT_CONFIGS = ["flat", "flat:fp16", "flat:sq8", "hnsw", "hnsw:sq8", "ivf", "ivf:sq8", "ivfpq"]
+
+
+def rss_bytes() -> int:
+    "Resident set size of this process."
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def synthetic_corpus(n:int, dim:int, n_queries:int, n_clusters:int=256, seed:int=0):
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((n_clusters, dim)).astype(np.float32)
+    labels = rng.integers(0, n_clusters, size=n)
+    corpus = centers[labels] + 0.5 * rng.standard_normal((n, dim)).astype(np.float32)
+    picks = rng.choice(n, size=n_queries, replace=False)
+    queries = corpus[picks] + 0.25 * rng.standard_normal((n_queries, dim)).astype(np.float32)
+    return np.ascontiguousarray(corpus), np.ascontiguousarray(queries)
+
+
+def parse_config(spec:str) -> dict:
+    "'hnsw:sq8' -> index_config('hnsw', 'sq8')"
+    index_type, _, compression = spec.partition(":")
+    return index_config(index_type, compression or None)
+
+
+def recall_at_k(found:np.ndarray, truth:np.ndarray) -> float:
+    k = truth.shape[1]
+    hits = sum(len(set(f[f >= 0]) & set(t)) for f, t in zip(found, truth))
+    return hits / (k * len(truth))
+
+
+def benchmark(spec:str, corpus:np.ndarray, queries:np.ndarray, truth:np.ndarray, k:int, train_size:int
+                , nprobes:list, ef_searches:list) -> list:
+    config = dict(parse_config(spec), train_size=train_size)
+
+    gc.collect()
+    rss_before = rss_bytes()
+    start = time.perf_counter()
+    training_vectors = corpus[:IndexUtils.train_size(config)] if IndexUtils.train_size(config) else corpus[:1]
+    index, build_info = IndexUtils.build_index(config, training_vectors)
+    index.add(corpus)
+    build_seconds = time.perf_counter() - start
+    rss_growth = rss_bytes() - rss_before
+    index_bytes = len(faiss.serialize_index(index))
+
+    if config['type'] == "hnsw":
+        sweeps = [{'ef_search': ef} for ef in ef_searches]
+    elif config['type'] in ("ivf", "ivfpq"):
+        sweeps = [{'nprobe': nprobe} for nprobe in nprobes]
+    else:
+        sweeps = [{}]
+
+    results = []
+    for search_params in sweeps:
+        IndexUtils.set_search_params(index, **search_params)
+        found = np.empty((len(queries), k), dtype=np.int64)
+        latencies = np.empty(len(queries))
+        for i in range(len(queries)):
+            start = time.perf_counter()
+            _, found[i:i + 1] = index.search(queries[i:i + 1], k)
+            latencies[i] = time.perf_counter() - start
+
+        results.append({
+            'config': spec
+            , 'factory': build_info['factory']
+            , 'search_params': search_params
+            , f'recall@{k}': round(recall_at_k(found, truth), 4)
+            , 'p50_ms': round(1000 * float(np.percentile(latencies, 50)), 3)
+            , 'p99_ms': round(1000 * float(np.percentile(latencies, 99)), 3)
+            , 'build_s': round(build_seconds, 2)
+            , 'train_s': build_info['train_seconds']
+            , 'rss_growth_mb': round(rss_growth / 2**20, 1)
+            , 'index_mb': round(index_bytes / 2**20, 1)
+        })
+        print(" | ".join(f"{key}={value}" for key, value in results[-1].items()), flush=True)
+
+    del index
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--n", type=int, default=100000, help="Number of corpus vectors")
+    parser.add_argument("--dim", type=int, default=1536, help="Vector dimension (1536 for text-embedding-ada-002)")
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--train-size", type=int, default=50000, help="Vectors used to train IVF/PQ/SQ8 indexes")
+    parser.add_argument("--configs", nargs="+", default=DEFAULT_CONFIGS, help="index_type[:compression] specs")
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 4, 16, 64])
+    parser.add_argument("--ef-search", type=int, nargs="+", default=[16, 64, 256])
+    parser.add_argument("--threads", type=int, default=1, help="FAISS OpenMP threads")
+    parser.add_argument("--json", help="Write the results to this file")
+    args = parser.parse_args()
+
+    faiss.omp_set_num_threads(args.threads)
+    print(f"Generating {args.n} x {args.dim} corpus and {args.queries} queries...", flush=True)
+    corpus, queries = synthetic_corpus(args.n, args.dim, args.queries)
+
+    exact = faiss.IndexFlatL2(args.dim)
+    exact.add(corpus)
+    _, truth = exact.search(queries, args.k)
+    del exact
+
+    results = []
+    for spec in args.configs:
+        results.extend(benchmark(spec, corpus, queries, truth, args.k, args.train_size, args.nprobe, args.ef_search))
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({'args': vars(args), 'results': results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
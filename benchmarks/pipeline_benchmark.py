@@ -0,0 +1,312 @@
+"""
+Latency of the stages of the IEP goal pipeline, fully offline: the local hashing embeddings replace the
+OpenAI embeddings and a fake chat model returns canned goals, so results only depend on the code and the machine.
+
+Usage:
+    python benchmarks/pipeline_benchmark.py --json results.json
+    python benchmarks/pipeline_benchmark.py --quick --stages retrieve format_prompt
+    python benchmarks/pipeline_benchmark.py --json new.json --compare baseline.json --threshold 1.2
+    python benchmarks/pipeline_benchmark.py --compare baseline.json new.json
+
+Stages:
+    extract_content     DataProcessor.extract_content on each bundled OOH profile (data/career_profiles)
+    parse_pdf           DataProcessor.parse_pdf of the Iowa standards PDF, without splitting
+    chunk               Splitting of the PDF pages with the default text splitter
+    dedup               ChunkDeduplicator (exact and MinHash near-duplicates) on the chunks of the local corpus
+    index_build         RAGUtils.create_and_save_embeddings of the local corpus, for each --corpus-sizes
+    index_load          RAGUtils.load_vectorstore of the snapshots built by index_build
+    retrieve            RAGUtils.retrieve_relevant_documents for each --corpus-sizes and --k (dense and hybrid),
+                        without the retrieval cache
+    format_prompt       RAGUtils.format_iep_prompt with the retrieved documents
+    generate            RAGUtils.generate_iep_goals with the fake chat model (no response cache)
+    assess              GoalAssessment.evaluate_iep_goal, one goal at a time
+    assess_batch        GoalAssessment.evaluate_iep_goals on --assess-batch goals (reported per goal)
+
+The corpus is made of the local sources only (the IDEA regulations are a web page). Corpus sizes larger than
+the corpus repeat its chunks as copies of their source. The results are written as JSON with the environment
+(commit, Python and library versions), and --compare prints the ratio of the median latency of every stage to a previous run, and
+exits with status 1 if a stage is slower than --threshold times the baseline.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from langchain_core.documents import Document
+from langchain_core.language_models import FakeListChatModel
+
+from batch_iep import FAKE_GOALS
+from data_utils import DataProcessor, STATE_STANDARDS_PDF
+from dedup_utils import ChunkDeduplicator
+from embedding_utils import embedding_config
+from iep_goal_generator import GoalAssessment
+from rag_utils import RAGUtils, StudentProfile
+from retrieval_utils import DEFAULT_CATEGORY_QUOTAS
+from snapshot_utils import SnapshotUtils
+
+
+
+STAGES = ["extract_content", "parse_pdf", "chunk", "dedup", "index_build", "index_load", "retrieve"
+            , "format_prompt", "generate", "assess", "assess_batch"]
+
+PROFILE = StudentProfile(name="Jordan", age=17, grade=11, career_interest_or_category="retail, customer service"
+                            , learning_preferences="Visual, hands-on", onnet_results="Enterprising, Conventional"
+                            , career_suggestions="Retail Sales Workers", preferred_employers="Target")
+
+QUERIES = ["Retail Sales Workers", "Delivery Truck Drivers and Driver/Sales Workers", "Data Scientists"
+            , "Physicians and Surgeons", "Computer and Information Research Scientists"
+            , "employability skills and transition planning", "customer service standards grade 11"]
+
+
+def measure(fn, repeat:int, warmup:int=1, per_call:int=1) -> dict:
+    """
+    Calls fn warmup times, then repeat times, and returns its latency statistics in milliseconds.
+    per_call divides the latencies, for calls that process per_call items.
+    """
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(warmup):
+            fn()
+        latencies = np.empty(repeat)
+        for i in range(repeat):
+            start = time.perf_counter()
+            fn()
+            latencies[i] = (time.perf_counter() - start) / per_call
+
+    latencies *= 1000
+    return {
+        'n': repeat
+        , 'mean_ms': round(float(latencies.mean()), 4)
+        , 'p50_ms': round(float(np.percentile(latencies, 50)), 4)
+        , 'p95_ms': round(float(np.percentile(latencies, 95)), 4)
+        , 'min_ms': round(float(latencies.min()), 4)
+    }
+
+
+def local_corpus() -> list:
+    "Chunks of the local sources, with their ids, as the index build would stream them."
+    sources = [source for source in DataProcessor.list_sources() if source['source_doc']]
+    with contextlib.redirect_stdout(io.StringIO()):
+        chunks = [doc for source in sources for doc in DataProcessor.iter_source_documents(source)]
+    return list(DataProcessor.with_chunk_ids(chunks))
+
+
+def scaled_corpus(corpus:list, size:int) -> list:
+    "The first size chunks of the corpus, repeated as copies of their source (with their own ids) if it is too small."
+    chunks = []
+    for i in range(size):
+        doc = corpus[i % len(corpus)]
+        copy = i // len(corpus)
+        if copy == 0:
+            chunks.append(doc)
+        else:
+            metadata = dict(doc.metadata, source=f"{doc.metadata.get('source')}#copy{copy}")
+            chunks.append(Document(id=f"{doc.id}-{copy}", page_content=doc.page_content, metadata=metadata))
+    return chunks
+
+
+def student_info(profile:StudentProfile, docs:list) -> dict:
+    "Prompt inputs of IEP_RAG_PROMT, as My_IEP_Goal_Generator builds them."
+    return {
+        "student_name": profile.name,
+        "student_age": profile.age,
+        "student_grade": profile.grade,
+        "career_interest_or_category": profile.career_interest_or_category,
+        "learning_preferences": profile.learning_preferences,
+        "onnet_results": profile.onnet_results,
+        "career_suggestions": profile.career_suggestions,
+        "preferred_employers": profile.preferred_employers,
+        "retrieved_docs": docs
+    }
+
+
+def run(args) -> dict:
+    stages = set(args.stages)
+    results = {}
+
+    def record(stage:str, stats:dict, **params):
+        name = stage + "".join(f"[{key}={value}]" for key, value in params.items())
+        results[name] = dict(stats, stage=stage, params=params)
+        print(f"{name:<45} n={stats['n']:<5} mean={stats['mean_ms']:.3f}ms p50={stats['p50_ms']:.3f}ms "
+                f"p95={stats['p95_ms']:.3f}ms", flush=True)
+
+    if "extract_content" in stages:
+        profiles = [source for source in DataProcessor.list_sources() if source['info_category'] == "career_profile"]
+        for source in profiles:
+            metadata = {'source': source['source'], 'source_doc': source['source_doc'], 'info_category': source['info_category']}
+            record("extract_content", measure(lambda: DataProcessor.extract_content(source['source_doc'], from_url=False
+                                                                                    , metadata=metadata), args.repeat)
+                    , file=os.path.basename(source['source_doc']))
+
+    pages = None
+    if "parse_pdf" in stages or "chunk" in stages:
+        pages = DataProcessor.parse_pdf(STATE_STANDARDS_PDF, split=False, info_category="state_standards")
+    if "parse_pdf" in stages:
+        record("parse_pdf", measure(lambda: DataProcessor.parse_pdf(STATE_STANDARDS_PDF, split=False, info_category="state_standards")
+                                    , max(1, args.repeat // 10), warmup=0), pages=len(pages))
+    if "chunk" in stages:
+        splitter = DataProcessor._default_text_splitter()
+        record("chunk", measure(lambda: splitter.split_documents(pages), args.repeat), pages=len(pages))
+
+    if "dedup" in stages:
+        ## Copies, since the deduplicator sets metadata['sources'] on the chunks it keeps
+        chunks = [Document(page_content=doc.page_content, metadata=dict(doc.metadata)) for doc in local_corpus()]
+        record("dedup", measure(lambda: list(ChunkDeduplicator().filter(chunks)), max(1, args.repeat // 10))
+                , chunks=len(chunks))
+
+    needs_index = stages & {"index_build", "index_load", "retrieve", "format_prompt", "generate", "assess", "assess_batch"}
+    if not needs_index:
+        return results
+
+    corpus = local_corpus()
+    sizes = [size or len(corpus) for size in args.corpus_sizes]
+    embedding = embedding_config("hashing")
+    with tempfile.TemporaryDirectory() as store_root:
+        vectorstores = {}
+        for size in sizes:
+            chunks = scaled_corpus(corpus, size)
+            store_path = os.path.join(store_root, str(size))
+            manifest = SnapshotUtils.build_manifest(sources=[], embedding=embedding, chunking=DataProcessor.chunking_params()
+                                                    , corpus_size=size)
+            build = lambda: RAGUtils.create_and_save_embeddings(chunks, None, store_path=store_path, manifest=manifest
+                                                                , keep_last=1, use_cache=False)
+            stats = measure(build, max(1, args.repeat // 10), warmup=0)
+            if "index_build" in stages:
+                record("index_build", stats, chunks=size)
+            load = lambda: RAGUtils.load_vectorstore(store_path, expected_manifest=manifest)
+            stats = measure(load, max(1, args.repeat // 10))
+            if "index_load" in stages:
+                record("index_load", stats, chunks=size)
+            with contextlib.redirect_stdout(io.StringIO()):
+                vectorstores[size] = load()
+
+        if "retrieve" in stages:
+            for size, vectorstore in vectorstores.items():
+                for k in args.k:
+                    for hybrid in (False, True):
+                        queries = iter(QUERIES * (args.repeat + 1))
+                        retrieve = lambda: RAGUtils.retrieve_relevant_documents(vectorstore, next(queries), k=k
+                                                                                , hybrid=hybrid, use_cache=False)
+                        record("retrieve", measure(retrieve, args.repeat), chunks=size, k=k, hybrid=hybrid)
+
+        ## The following stages run on the full corpus, with the documents the app would retrieve
+        vectorstore = vectorstores[max(sizes)]
+        docs = RAGUtils.retrieve_relevant_documents(vectorstore, PROFILE.career_suggestions, hybrid=True
+                                                    , category_quotas=DEFAULT_CATEGORY_QUOTAS, use_cache=False)
+        info = student_info(PROFILE, docs)
+
+        if "format_prompt" in stages:
+            record("format_prompt", measure(lambda: RAGUtils.format_iep_prompt(info), args.repeat), docs=len(docs))
+            record("format_prompt", measure(lambda: RAGUtils.format_iep_prompt(info, context_budget=None), args.repeat)
+                    , docs=len(docs), packed=False)
+
+        if "generate" in stages:
+            chat_model = FakeListChatModel(responses=[FAKE_GOALS])
+            record("generate", measure(lambda: RAGUtils.generate_iep_goals(chat_model, info), args.repeat), docs=len(docs))
+
+        if "assess" in stages:
+            record("assess", measure(lambda: GoalAssessment.evaluate_iep_goal(FAKE_GOALS, PROFILE, docs), args.repeat)
+                    , docs=len(docs))
+
+        if "assess_batch" in stages:
+            goals = [FAKE_GOALS] * args.assess_batch
+            record("assess_batch", measure(lambda: GoalAssessment.evaluate_iep_goals(goals, PROFILE, docs)
+                                            , max(1, args.repeat // 10), per_call=len(goals))
+                    , docs=len(docs), goals=len(goals))
+
+    return results
+
+
+def environment() -> dict:
+    import faiss
+    import langchain_core
+
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True
+                                , cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        'commit': commit
+        , 'created_at': time.strftime("%Y-%m-%dT%H:%M:%S")
+        , 'python': platform.python_version()
+        , 'platform': platform.platform()
+        , 'processor': platform.processor() or platform.machine()
+        , 'cpu_count': os.cpu_count()
+        , 'numpy': np.__version__
+        , 'faiss': faiss.__version__
+        , 'langchain_core': langchain_core.__version__
+    }
+
+
+def compare(baseline:dict, current:dict, threshold:float) -> list:
+    """
+    Prints the median latency of every stage of current against baseline.
+
+    Returns:
+        list: Names of the stages slower than threshold times their baseline.
+    """
+    print(f"\nBaseline {baseline['environment'].get('commit')} vs current {current['environment'].get('commit')}")
+    regressions = []
+    for name, stats in current['results'].items():
+        base = baseline['results'].get(name)
+        if base is None:
+            print(f"{name:<45} {stats['p50_ms']:>10.3f}ms   (new)")
+            continue
+        ratio = stats['p50_ms'] / base['p50_ms'] if base['p50_ms'] > 0 else float("inf")
+        flag = ""
+        if ratio > threshold:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        print(f"{name:<45} {base['p50_ms']:>10.3f}ms -> {stats['p50_ms']:>10.3f}ms  x{ratio:.2f}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES)
+    parser.add_argument("--repeat", type=int, default=50, help="Measured calls per stage (a tenth for the slow stages)")
+    parser.add_argument("--quick", action="store_true", help="Fewer calls and a single corpus size, for smoke tests")
+    parser.add_argument("--k", type=int, nargs="+", default=[3, 10, 30])
+    parser.add_argument("--corpus-sizes", type=int, nargs="+", default=[250, 0, 5000]
+                        , help="Numbers of chunks indexed (0 for the local corpus as it is)")
+    parser.add_argument("--assess-batch", type=int, default=1000, help="Goals per evaluate_iep_goals call")
+    parser.add_argument("--json", help="Write the results to this file")
+    parser.add_argument("--compare", nargs="+", metavar="JSON"
+                        , help="Baseline results to compare this run with, or a baseline and a current result to compare without running")
+    parser.add_argument("--threshold", type=float, default=1.2, help="Slowdown ratio reported as a regression by --compare")
+    args = parser.parse_args()
+
+    if args.quick:
+        args.repeat = min(args.repeat, 10)
+        args.corpus_sizes = [0]
+        args.assess_batch = min(args.assess_batch, 100)
+
+    if args.compare and len(args.compare) == 2:
+        with open(args.compare[0], "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        with open(args.compare[1], "r", encoding="utf-8") as f:
+            current = json.load(f)
+        sys.exit(1 if compare(baseline, current, args.threshold) else 0)
+
+    current = {'environment': environment(), 'args': vars(args), 'results': run(args)}
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(current, f, indent=2)
+
+    if args.compare:
+        with open(args.compare[0], "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        sys.exit(1 if compare(baseline, current, args.threshold) else 0)
+
+
+if __name__ == "__main__":
+    main()
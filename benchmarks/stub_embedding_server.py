@@ -0,0 +1,85 @@
+"""
+Local stand-in for the OpenAI embeddings endpoint, used to exercise AsyncEmbeddingEngine without the API.
+
+Usage:
+    python benchmarks/stub_embedding_server.py --port 8765 --latency 0.2 --error-rate 0.1
+    OPENAI_BASE_URL=http://127.0.0.1:8765/v1 OPENAI_API_KEY=stub python my_script.py
+
+Vectors are derived from a hash of the input, so the same text always gets the same vector.
+A fraction of requests (--error-rate) fail with 429 or 503 to exercise the backoff logic.
+"""
+import argparse
+import base64
+import hashlib
+import json
+import random
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+
+
+def stub_vector(item, dim:int, encoding_format:str="float"):
+    seed = int.from_bytes(hashlib.sha256(json.dumps(item).encode("utf-8")).digest()[:8], "little")
+    vector = np.random.default_rng(seed).standard_normal(dim).astype(np.float32)
+    vector /= np.linalg.norm(vector)
+    ## The openai client asks for base64 by default, which is also much cheaper to serialize
+    if encoding_format == "base64":
+        return base64.b64encode(vector.tobytes()).decode("ascii")
+    return vector.tolist()
+
+
+def make_handler(dim:int, latency:float, error_rate:float):
+
+    class StubEmbeddingHandler(BaseHTTPRequestHandler):
+
+        def _send(self, status:int, payload:dict, headers:dict=None):
+            body = json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            if not self.path.rstrip("/").endswith("/embeddings"):
+                return self._send(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            inputs = request.get("input", [])
+            if not isinstance(inputs, list) or (inputs and isinstance(inputs[0], int)):
+                inputs = [inputs]
+
+            time.sleep(latency)
+            if random.random() < error_rate:
+                status = random.choice([429, 503])
+                return self._send(status, {"error": {"message": "stub failure", "type": "stub"}}, headers={"retry-after": "0.1"})
+
+            self._send(200, {
+                "object": "list"
+                , "model": request.get("model", "stub")
+                , "data": [{"object": "embedding", "index": i, "embedding": stub_vector(item, dim, request.get("encoding_format", "float"))} for i, item in enumerate(inputs)]
+                , "usage": {"prompt_tokens": 0, "total_tokens": 0}
+            })
+
+        def log_message(self, *args):
+            pass
+
+    return StubEmbeddingHandler
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--latency", type=float, default=0.2, help="Seconds of simulated latency per request.")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests that fail with 429/503.")
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(args.dim, args.latency, args.error_rate))
+    print(f"Stub embedding server listening on http://{args.host}:{args.port}/v1")
+    server.serve_forever()
@@ -0,0 +1,331 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+from diskcache import Cache
+
+
+
+PARENT_DIR = Path(__file__).resolve().parent
+
+DEFAULT_RESPONSE_CACHE_PATH = os.path.join(PARENT_DIR, "data/response_cache")
+DEFAULT_RESPONSE_CACHE_SIZE_LIMIT = 2 ** 28  # 256 MB
+DEFAULT_RESPONSE_TTL = 7 * 24 * 3600  # 1 week
+
+
+class LRUCache:
+    """
+    Thread-safe in-memory cache with least-recently-used eviction and an optional time-to-live.
+
+    Args:
+        max_size (int): Maximum number of entries; the least recently used entry is evicted beyond that.
+        ttl (float): Seconds after which an entry expires, or None to keep entries until evicted.
+    """
+
+    _MISSING = object()
+
+    def __init__(self, max_size:int=1024, ttl:float=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+
+    def __contains__(self, key):
+        return self.get(key, self._MISSING, count=False) is not self._MISSING
+
+
+    def get(self, key, default=None, count:bool=True):
+        "Returns the cached value for key (marking it as recently used), or default."
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl is not None and time.monotonic() - entry[1] > self.ttl:
+                del self._entries[key]
+                entry = None
+
+            if entry is None:
+                if count:
+                    self.misses += 1
+                return default
+
+            self._entries.move_to_end(key)
+            if count:
+                self.hits += 1
+            return entry[0]
+
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+
+    def get_or_set(self, key, compute):
+        "Returns the cached value for key, or computes it with compute(), caches and returns it."
+        value = self.get(key, self._MISSING)
+        if value is self._MISSING:
+            value = compute()
+            self.set(key, value)
+        return value
+
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            return default if entry is None else entry[0]
+
+
+    def clear(self):
+        "Removes all entries and resets the hit/miss counters."
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits
+                , 'misses': self.misses
+                , 'hit_rate': self.hits / lookups if lookups else 0.0
+                , 'entries': len(self._entries)
+                , 'max_size': self.max_size
+                , 'ttl': self.ttl
+            }
+
+
+
+class ResponseCache:
+    """
+    On-disk cache of generated responses, keyed by hash(prompt, model, index version).
+
+    Entries expire after ttl seconds and are evicted least-recently-used first once the cache grows beyond
+    size_limit bytes. Each entry keeps its provenance (model, index version, prompt hash, sources of the
+    retrieved documents, creation time), which is returned with it.
+
+    With semantic_threshold and embed (a function text -> vector), a second tier also returns the response
+    of a previous request whose profile text is at least that cosine-similar, provided it was generated by the
+    same model, against the same index version and with the same context (e.g. the student name and the
+    retrieved documents, which the response depends on verbatim).
+
+    Args:
+        directory (str): Cache directory (data/response_cache by default).
+        size_limit (int): Maximum size of the cache in bytes.
+        ttl (float): Seconds after which an entry expires, or None to keep entries until evicted.
+        semantic_threshold (float): Minimum cosine similarity of a semantic hit, or None to disable the semantic tier.
+        embed (callable): Embeds the profile texts of the semantic tier.
+    """
+
+    def __init__(self, directory:str=None, size_limit:int=DEFAULT_RESPONSE_CACHE_SIZE_LIMIT
+                    , ttl:float=DEFAULT_RESPONSE_TTL, semantic_threshold:float=None, embed=None):
+        if directory is None:
+            directory = DEFAULT_RESPONSE_CACHE_PATH
+        if semantic_threshold is not None and embed is None:
+            raise ValueError("The semantic tier needs an embed function.")
+        self.directory = directory
+        self.ttl = ttl
+        self.semantic_threshold = semantic_threshold
+        self.embed = embed
+        self.cache = Cache(directory, size_limit=size_limit, eviction_policy="least-recently-used")
+        self._lock = threading.Lock()
+        ## scope -> ([entry keys], matrix of their normalized profile vectors), loaded from disk on first use
+        self._semantic_index = None
+        self.hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+
+
+    @staticmethod
+    def key(prompt:str, model:str, index_version) -> str:
+        return hashlib.sha256(f"{model}\0{index_version}\0{prompt}".encode("utf-8")).hexdigest()
+
+
+    @staticmethod
+    def scope(model:str, index_version, context:list) -> str:
+        "Requests with the same scope can share a response if their profile texts are similar."
+        return hashlib.sha256("\0".join(map(str, [model, index_version] + list(context))).encode("utf-8")).hexdigest()
+
+
+    def __len__(self):
+        return len(self.cache)
+
+
+    def get(self, prompt:str, model:str, index_version, profile_text:str=None, context:list=None):
+        """
+        Returns (response, provenance) for an identical prompt or, with the semantic tier, for a similar
+        profile_text with the same context, or None.
+        """
+        entry = self.cache.get(ResponseCache.key(prompt, model, index_version))
+        if entry is not None:
+            with self._lock:
+                self.hits += 1
+            return entry['response'], dict(entry['provenance'], tier="exact")
+
+        if self.semantic_threshold is not None and profile_text is not None:
+            match = self._semantic_lookup(ResponseCache.scope(model, index_version, context or []), profile_text)
+            if match is not None:
+                entry, similarity = match
+                with self._lock:
+                    self.hits += 1
+                    self.semantic_hits += 1
+                return entry['response'], dict(entry['provenance'], tier="semantic", similarity=round(similarity, 4))
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+
+    def set(self, prompt:str, model:str, index_version, response, sources:list=None
+                , profile_text:str=None, context:list=None) -> dict:
+        "Caches response and returns its provenance."
+        key = ResponseCache.key(prompt, model, index_version)
+        provenance = {
+            'key': key
+            , 'model': model
+            , 'index_version': str(index_version)
+            , 'prompt_hash': hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+            , 'sources': list(dict.fromkeys(sources or []))
+            , 'created_at': time.time()
+        }
+        entry = {'response': response, 'provenance': provenance}
+
+        if self.semantic_threshold is not None and profile_text is not None:
+            entry['scope'] = ResponseCache.scope(model, index_version, context or [])
+            entry['vector'] = _unit_vector(self.embed(profile_text))
+            with self._lock:
+                if self._semantic_index is not None:
+                    self._add_semantic(self._semantic_index, entry['scope'], key, entry['vector'])
+
+        self.cache.set(key, entry, expire=self.ttl)
+        return provenance
+
+
+    def _semantic_lookup(self, scope:str, profile_text:str):
+        with self._lock:
+            if self._semantic_index is None:
+                self._semantic_index = self._load_semantic_index()
+            if len(self._semantic_index.get(scope, ([], None))[0]) == 0:
+                return None
+
+        ## Embedding may be a network call, so it is done without holding the lock
+        vector = _unit_vector(self.embed(profile_text))
+        with self._lock:
+            keys, matrix = self._semantic_index.get(scope, ([], None))
+            if len(keys) == 0:
+                return None
+            similarities = matrix @ vector
+            order = np.argsort(-similarities)
+
+        for i in order:
+            if similarities[i] < self.semantic_threshold:
+                return None
+            entry = self.cache.get(keys[i])
+            ## Expired and evicted entries are dropped from the in-memory index lazily
+            if entry is None:
+                self._drop_semantic(scope, keys[i])
+                continue
+            return entry, float(similarities[i])
+        return None
+
+
+    def _load_semantic_index(self) -> dict:
+        semantic_index = {}
+        for key in self.cache.iterkeys():
+            entry = self.cache.get(key)
+            if entry is not None and 'vector' in entry:
+                self._add_semantic(semantic_index, entry['scope'], key, entry['vector'])
+        return semantic_index
+
+
+    @staticmethod
+    def _add_semantic(semantic_index:dict, scope:str, key:str, vector:np.ndarray):
+        keys, matrix = semantic_index.get(scope, ([], None))
+        if key in keys:
+            matrix[keys.index(key)] = vector
+            return
+        matrix = vector[None, :] if matrix is None else np.vstack([matrix, vector])
+        semantic_index[scope] = (keys + [key], matrix)
+
+
+    def _drop_semantic(self, scope:str, key:str):
+        with self._lock:
+            if self._semantic_index is None:
+                return
+            keys, matrix = self._semantic_index.get(scope, ([], None))
+            if key in keys:
+                i = keys.index(key)
+                if len(keys) == 1:
+                    del self._semantic_index[scope]
+                else:
+                    self._semantic_index[scope] = (keys[:i] + keys[i + 1:], np.delete(matrix, i, axis=0))
+
+
+    def invalidate(self, model:str=None, index_version=None) -> int:
+        """
+        Removes the entries generated by model and/or against index_version (all entries if both are None).
+        Entries of older index versions are never returned anyway; this frees their space early.
+
+        Returns:
+            int: Number of entries removed.
+        """
+        removed = 0
+        for key in list(self.cache.iterkeys()):
+            entry = self.cache.get(key)
+            if entry is None:
+                continue
+            provenance = entry['provenance']
+            if (model is None or provenance['model'] == model) and (index_version is None or provenance['index_version'] == str(index_version)):
+                removed += int(self.cache.delete(key))
+        with self._lock:
+            self._semantic_index = None
+        return removed
+
+
+    def clear(self):
+        "Removes all entries and resets the hit/miss counters."
+        self.cache.clear()
+        with self._lock:
+            self._semantic_index = None
+            self.hits = 0
+            self.semantic_hits = 0
+            self.misses = 0
+
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits
+                , 'semantic_hits': self.semantic_hits
+                , 'misses': self.misses
+                , 'hit_rate': self.hits / lookups if lookups else 0.0
+                , 'entries': len(self.cache)
+                , 'size_bytes': self.cache.volume()
+                , 'ttl': self.ttl
+            }
+
+
+    def close(self):
+        self.cache.close()
+
+
+
+def _unit_vector(vector) -> np.ndarray:
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
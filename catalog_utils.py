@@ -0,0 +1,336 @@
+import difflib
+import html
+import json
+import os
+import re
+from collections import namedtuple
+from pathlib import Path
+
+from cache_utils import LRUCache
+from fetch_utils import get_fetcher
+
+
+
+PARENT_DIR = Path(__file__).resolve().parent
+
+DEFAULT_CATALOG_DIR = os.path.join(PARENT_DIR, "data/career_profiles")
+DEFAULT_CATALOG_CACHE = os.path.join(PARENT_DIR, "data/occupation_catalog.json")
+CATALOG_CACHE_VERSION = 1
+
+## Minimum trigram similarity (Dice coefficient) for a fuzzy match
+DEFAULT_FUZZY_THRESHOLD = 0.6
+
+## Occupation Outlook Handbook page structure
+_TITLE_PATTERN = re.compile(r"<h1[^>]*>(.*?)</h1>", re.S | re.I)
+_HTML_TITLE_PATTERN = re.compile(r"<title>(.*?)</title>", re.S | re.I)
+_CANONICAL_PATTERN = re.compile(r"<link[^>]*rel=\"canonical\"[^>]*href=\"([^\"]+)\"", re.I)
+## Rows of the employment projections table: detailed occupation title, then its SOC code
+_PROJECTION_ROW_PATTERN = re.compile(r"<th>\s*<p[^>]*>\s*(?:<strong>)?([^<]*)(?:</strong>)?\s*</p>\s*</th>\s*<td[^>]*>\s*(\d{2}-\d{4})\s*</td>", re.I)
+## Links to the O*NET summary of each detailed occupation
+_ONET_PATTERN = re.compile(r"onetonline\.org/link/summary/(\d{2}-\d{4})(?:\.\d+)?\"[^>]*>([^<]*)</a>", re.I)
+_TAG_PATTERN = re.compile(r"<[^>]+>")
+
+_WORD_PATTERN = re.compile(r"[a-z0-9]+")
+## Separators between the occupations of a free-text list such as career_suggestions
+_SUGGESTION_SEPARATORS = re.compile(r"[,;\n]|\band\/or\b|\bor\b", re.I)
+
+
+Occupation = namedtuple("Occupation", [
+    "key",          # Identifier, e.g. 'retail_salesperson'
+    "title",        # Title of the OOH profile, e.g. 'Retail Sales Workers'
+    "source_doc",   # Local HTML file of the profile
+    "source",       # URL of the profile
+    "soc_codes",    # SOC codes of the detailed occupations covered by the profile, e.g. ['41-2022', '41-2031']
+    "aliases"       # Other names of the occupation, e.g. ['Retail salespersons', 'Parts Salespersons']
+])
+
+
+def normalize_name(name:str) -> str:
+    "Lower-cased words without punctuation or plural endings, e.g. 'Driver/Sales Workers' -> 'driver sale worker'."
+    words = []
+    for word in _WORD_PATTERN.findall(name.lower().replace("_", " ")):
+        if len(word) > 3 and word.endswith("ies"):
+            word = word[:-3] + "y"
+        elif len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+            word = word[:-1]
+        words.append(word)
+    return " ".join(words)
+
+
+def _trigrams(name:str) -> set:
+    padded = f"  {name} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def _clean(fragment:str) -> str:
+    return " ".join(html.unescape(_TAG_PATTERN.sub(" ", fragment)).split())
+
+
+def parse_profile(path:str) -> dict:
+    """
+    Extracts the title, canonical URL, SOC codes and detailed occupation titles of an OOH profile page
+    with regular expressions, without parsing the whole document.
+    """
+    with open(path, "r", encoding="utf-8", errors="replace") as f:
+        page = f.read()
+
+    title = _TITLE_PATTERN.search(page)
+    if title is not None:
+        title = _clean(title.group(1))
+    else:
+        html_title = _HTML_TITLE_PATTERN.search(page)
+        title = _clean(html_title.group(1)).split(":")[0].strip() if html_title else Path(path).stem
+    canonical = _CANONICAL_PATTERN.search(page)
+
+    soc_codes = {}
+    for pattern, title_group, code_group in ((_PROJECTION_ROW_PATTERN, 1, 2), (_ONET_PATTERN, 2, 1)):
+        for match in pattern.finditer(page):
+            soc_codes.setdefault(match.group(code_group), []).append(_clean(match.group(title_group)))
+
+    return {
+        'title': title
+        , 'source': canonical.group(1) if canonical else None
+        , 'soc_codes': sorted(soc_codes)
+        , 'aliases': _unique_names(alias for names in soc_codes.values() for alias in names)
+    }
+
+
+def _unique_names(names) -> list:
+    "Drops empty names and names that only differ by case, punctuation or plural endings from an earlier one."
+    unique = {}
+    for name in names:
+        normalized = normalize_name(name)
+        if normalized:
+            unique.setdefault(normalized, name)
+    return list(unique.values())
+
+
+
+class OccupationCatalog:
+    """
+    Catalog of the career profiles available to the pipeline, searchable by key, title, alias or SOC code.
+
+    Names are looked up in a dict of normalized names first, then as a subset of the words of a known name, then by
+    trigram similarity (confirmed with difflib), and resolved names are cached, so resolving free-text career
+    suggestions takes microseconds. The catalog only holds metadata: the profile contents are loaded when they are
+    needed (see DataProcessor.load_occupation).
+    """
+
+    def __init__(self, occupations:list, fuzzy_threshold:float=DEFAULT_FUZZY_THRESHOLD):
+        self.occupations = {occ.key: occ for occ in occupations}
+        self.fuzzy_threshold = fuzzy_threshold
+
+        ## normalized name -> key. Earlier occupations win conflicts, so curated keys and titles take precedence.
+        self._names = {}
+        for occ in occupations:
+            for name in [occ.key, occ.title] + list(occ.aliases) + list(occ.soc_codes):
+                self._names.setdefault(normalize_name(name), occ.key)
+
+        self._name_list = list(self._names)
+        self._word_index = {}
+        for i, name in enumerate(self._name_list):
+            for word in set(name.split()):
+                self._word_index.setdefault(word, set()).add(i)
+        self._name_trigrams = [_trigrams(name) for name in self._name_list]
+        self._trigram_index = {}
+        for i, trigrams in enumerate(self._name_trigrams):
+            for trigram in trigrams:
+                self._trigram_index.setdefault(trigram, []).append(i)
+
+        self._lookups = LRUCache(max_size=4096)
+
+
+    def __len__(self):
+        return len(self.occupations)
+
+
+    def __iter__(self):
+        return iter(self.occupations.values())
+
+
+    def __contains__(self, name:str):
+        return self.lookup(name) is not None
+
+
+    def keys(self) -> list:
+        return list(self.occupations)
+
+
+    def get(self, key:str):
+        return self.occupations.get(key)
+
+
+    def lookup(self, name:str, fuzzy:bool=True):
+        "Returns the Occupation with this key, title, alias or SOC code (or the closest one if fuzzy), or None."
+        if name in self.occupations:
+            return self.occupations[name]
+
+        cache_key = (name, fuzzy)
+        key = self._lookups.get(cache_key, False)
+        if key is False:
+            normalized = normalize_name(name)
+            key = self._names.get(normalized)
+            if key is None and fuzzy and normalized:
+                key = self._partial_lookup(normalized) or self._fuzzy_lookup(normalized)
+            self._lookups.set(cache_key, key)
+        return None if key is None else self.occupations[key]
+
+
+    def _partial_lookup(self, normalized:str):
+        "Shortest name containing all the words of the query, e.g. 'delivery driver' -> 'delivery truck driver'."
+        matches = None
+        for word in normalized.split():
+            ids = self._word_index.get(word)
+            if not ids:
+                return None
+            matches = set(ids) if matches is None else matches & ids
+            if not matches:
+                return None
+        best = min(matches, key=lambda i: (len(self._name_list[i]), i))
+        return self._names[self._name_list[best]]
+
+
+    def _fuzzy_lookup(self, normalized:str):
+        query = _trigrams(normalized)
+        overlaps = {}
+        for trigram in query:
+            for i in self._trigram_index.get(trigram, ()):
+                overlaps[i] = overlaps.get(i, 0) + 1
+        if not overlaps:
+            return None
+
+        ## Dice coefficient on trigrams, then difflib to break near ties between the best candidates
+        scored = sorted(((2.0 * n / (len(query) + len(self._name_trigrams[i])), i) for i, n in overlaps.items()), reverse=True)
+        best_score = scored[0][0]
+        if best_score < self.fuzzy_threshold:
+            return None
+        candidates = [i for score, i in scored[:5] if score >= best_score - 0.05]
+        best = max(candidates, key=lambda i: difflib.SequenceMatcher(None, normalized, self._name_list[i]).ratio())
+        return self._names[self._name_list[best]]
+
+
+    def resolve(self, text:str, fuzzy:bool=True) -> list:
+        """
+        Resolves a free-text list of occupations (e.g. the career_suggestions of a student profile,
+        'Retail Salesperson, Delivery driver') to catalog entries, in order and without duplicates.
+        Parts that do not match any occupation are ignored.
+        """
+        if not text:
+            return []
+        resolved = {}
+        for part in _SUGGESTION_SEPARATORS.split(str(text)):
+            part = part.strip()
+            occ = self.lookup(part, fuzzy=fuzzy) if part else None
+            if occ is not None:
+                resolved.setdefault(occ.key, occ)
+        return list(resolved.values())
+
+
+    def download(self, fetcher=None, keys:list=None, max_workers:int=8) -> dict:
+        """
+        Downloads the OOH profile pages of the occupations (all, or those in keys) from their source URL to their
+        source_doc file, concurrently through an HTTPFetcher (fetch_utils.get_fetcher() by default). Pages are
+        revalidated with conditional requests, so only the pages that changed on bls.gov are transferred, and
+        files are only rewritten when their content changed, which keeps the snapshots of the others valid.
+
+        Returns:
+            dict: {key: 'updated', 'unchanged' or 'error: <message>'}. Call discover again to pick up the updates.
+        """
+        if fetcher is None:
+            fetcher = get_fetcher()
+        occupations = [occ for occ in self if occ.source and (keys is None or occ.key in keys)]
+        results = fetcher.fetch_many([occ.source for occ in occupations], max_workers=max_workers)
+
+        outcomes = {}
+        for occ in occupations:
+            result = results[occ.source]
+            if result.content is None:
+                outcomes[occ.key] = f"error: {result.error}"
+                continue
+            current = None
+            if os.path.isfile(occ.source_doc):
+                with open(occ.source_doc, "rb") as f:
+                    current = f.read()
+            if current == result.content:
+                outcomes[occ.key] = "unchanged"
+                continue
+            os.makedirs(os.path.dirname(occ.source_doc), exist_ok=True)
+            tmp_path = f"{occ.source_doc}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(result.content)
+            os.replace(tmp_path, occ.source_doc)
+            outcomes[occ.key] = "updated"
+        return outcomes
+
+
+    @staticmethod
+    def _key_for(title:str, taken:set) -> str:
+        key = "_".join(_WORD_PATTERN.findall(title.lower())) or "occupation"
+        candidate, n = key, 2
+        while candidate in taken:
+            candidate, n = f"{key}_{n}", n + 1
+        return candidate
+
+
+    @staticmethod
+    def discover(directory:str=None, seeds:dict=None, cache_path:str=None, **kwargs):
+        """
+        Builds the catalog from the OOH profile pages (*.html) in directory.
+
+        Args:
+            directory (str): Directory of the profile pages (data/career_profiles by default).
+            seeds (dict): Curated {key: {'source_doc': path, 'source': url}} entries, such as
+                data_utils.APPLICABLE_OCCUPATIONS. Their keys are used for the matching files, and come first
+                in the catalog, in their order. The other files follow in file name order.
+            cache_path (str): JSON file caching the parsed metadata of each file; only new or modified files
+                are parsed again. None disables the cache.
+        """
+        if directory is None:
+            directory = DEFAULT_CATALOG_DIR
+        seeds = seeds or {}
+
+        cache = {}
+        if cache_path is not None and os.path.isfile(cache_path):
+            try:
+                with open(cache_path, "r", encoding="utf-8") as f:
+                    stored = json.load(f)
+                if stored.get('version') == CATALOG_CACHE_VERSION:
+                    cache = stored.get('files', {})
+            except (OSError, ValueError):
+                cache = {}
+
+        paths = sorted(str(path) for path in Path(directory).glob("*.html")) if os.path.isdir(directory) else []
+        seed_keys = {os.path.abspath(seed['source_doc']): key for key, seed in seeds.items()}
+        ordered = [os.path.abspath(seed['source_doc']) for seed in seeds.values()]
+        ordered += [os.path.abspath(path) for path in paths if not os.path.abspath(path) in seed_keys]
+
+        files = {}
+        occupations = []
+        taken = set(seeds)
+        for path in ordered:
+            if not os.path.isfile(path):
+                continue
+            stat = os.stat(path)
+            name = os.path.relpath(path, PARENT_DIR)
+            entry = cache.get(name)
+            if entry is None or entry.get('size') != stat.st_size or entry.get('mtime_ns') != stat.st_mtime_ns:
+                entry = dict(parse_profile(path), size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+            files[name] = entry
+
+            key = seed_keys.get(path)
+            if key is None:
+                key = OccupationCatalog._key_for(entry['title'], taken)
+                taken.add(key)
+            source = seeds[key]['source'] if key in seeds else entry['source']
+            aliases = _unique_names([key.replace("_", " ")] + entry['aliases']) if key in seeds else entry['aliases']
+            occupations.append(Occupation(key=key, title=entry['title'], source_doc=path, source=source
+                                            , soc_codes=entry['soc_codes'], aliases=aliases))
+
+        if cache_path is not None and files != cache:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            tmp_path = f"{cache_path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({'version': CATALOG_CACHE_VERSION, 'files': files}, f, indent=1)
+            os.replace(tmp_path, cache_path)
+
+        return OccupationCatalog(occupations, **kwargs)
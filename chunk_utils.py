@@ -0,0 +1,393 @@
+import bisect
+import re
+from collections import namedtuple
+from typing import Dict, List
+
+from langchain_community.docstore.base import AddableMixin, Docstore
+from langchain_core.documents.base import Document
+
+
+
+DEFAULT_CHUNK_SIZE = 500
+
+## Chunks end on paragraph or section boundaries, so they do not need to overlap
+DEFAULT_CHUNK_OVERLAP = 0
+
+## Separators tried in turn to split a paragraph that is longer than a chunk: paragraphs, lines, sentences, words
+_SEPARATORS = [re.compile(r"\n\s*\n"), re.compile(r"\n"), re.compile(r"(?<=[.!?;:])\s+"), re.compile(r"\s+")]
+
+
+ChunkRef = namedtuple("ChunkRef", [
+    "source_id",    # Source text the chunk is part of (see TextStore)
+    "start",        # Offset of the chunk in the source text (its 'start_index')
+    "end"           # Offset of the end of the chunk
+])
+
+
+class StructureChunker:
+    """
+    Splits documents into chunks that follow their structure, with the same split_documents interface as the
+    LangChain text splitters.
+
+    A document is first cut into sections at its headings: metadata['headings'], a list of (offset, level, title)
+    (see DataProcessor.extract_content), or else the matches of heading_patterns. A heading closes the sections of
+    the same or a deeper level, and a heading without title closes them without opening a new one. The paragraphs of
+    a section are then packed into chunks of at most chunk_size, and paragraphs that are too long are split on
+    lines, sentences and words. A section only shares a chunk with the previous one if it is a sibling (or a
+    descendant of a sibling) and the chunk so far is shorter than min_chunk_size, so small sections are grouped
+    and larger ones start their own chunk.
+
+    Each chunk gets its offset in the document ('start_index'), its position among the chunks of the document
+    ('chunk_index') and its section path ('section', e.g. 'Retail Sales Workers > How to Become a Retail Sales
+    Worker > Training'; the common part of the paths of the sections it spans). The chunks cover all the text of
+    the document but the whitespace at their boundaries, so consecutive chunks are only separated by whitespace.
+    The 'headings' are not copied to the chunks.
+
+    Args:
+        chunk_size (int): Maximum length of a chunk, measured with length_function.
+        chunk_overlap (int): Maximum length of the trailing paragraphs of a chunk repeated at the start of the next
+            chunk of the same section.
+        min_chunk_size (int): Chunks shorter than this take in the next section (4/5 of chunk_size by default).
+        heading_patterns (list): (level, regex) pairs used to find the headings of documents without
+            metadata['headings']. The title is the 'title' group of the match, or else the whole match.
+        length_function (callable): Length of a text (len by default).
+    """
+
+    def __init__(self, chunk_size:int=DEFAULT_CHUNK_SIZE, chunk_overlap:int=DEFAULT_CHUNK_OVERLAP, min_chunk_size:int=None
+                    , heading_patterns:list=None, length_function=len):
+        if chunk_overlap >= chunk_size:
+            raise ValueError(f"chunk_overlap ({chunk_overlap}) must be smaller than chunk_size ({chunk_size}).")
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.min_chunk_size = chunk_size * 4 // 5 if min_chunk_size is None else min_chunk_size
+        self.heading_patterns = [(level, re.compile(pattern, re.MULTILINE) if isinstance(pattern, str) else pattern)
+                                    for level, pattern in heading_patterns or []]
+        self.length_function = length_function
+
+
+    def split_documents(self, documents:List[Document]) -> List[Document]:
+        chunks = []
+        for doc in documents:
+            metadata = {key: value for key, value in doc.metadata.items() if key != 'headings'}
+            for chunk_index, (start, end, path) in enumerate(self.split_text(doc.page_content, doc.metadata.get('headings'))):
+                chunks.append(Document(page_content=doc.page_content[start:end]
+                                        , metadata=dict(metadata, start_index=start, chunk_index=chunk_index
+                                                        , section=" > ".join(path))))
+        return chunks
+
+
+    def split_text(self, text:str, headings:list=None) -> list:
+        "Returns the chunks of text as (start, end, section path) tuples, in order."
+        if headings is None:
+            headings = self.find_headings(text)
+
+        chunks = []
+        current = None      # [start, end, path of its first section, paths, paragraphs]
+        for start, end, path in StructureChunker.sections(text, headings):
+            for unit_start, unit_end in self._paragraphs(text, start, end):
+                if current is not None and self._length(text, current[0], unit_end) <= self.chunk_size \
+                        and (path == current[3][-1] or self._can_join(current, path, text)):
+                    current[1] = unit_end
+                    current[4].append((unit_start, unit_end))
+                    if path != current[3][-1]:
+                        current[3].append(path)
+                    continue
+
+                if current is not None:
+                    chunks.append(current)
+                    if path == current[3][-1]:
+                        unit_start = self._overlap_start(text, current[4], unit_start, unit_end)
+                current = [unit_start, unit_end, path, [path], [(unit_start, unit_end)]]
+        if current is not None:
+            chunks.append(current)
+
+        return [(start, end, _common_prefix(paths)) for start, end, _, paths, _ in chunks]
+
+
+    def find_headings(self, text:str) -> list:
+        "(offset, level, title) of the matches of heading_patterns in text, in order."
+        headings = []
+        for level, pattern in self.heading_patterns:
+            for match in pattern.finditer(text):
+                title = match.group('title') if 'title' in pattern.groupindex else match.group(0)
+                headings.append((match.start(), level, " ".join(title.split())))
+        return sorted(headings, key=lambda heading: (heading[0], heading[1]))
+
+
+    @staticmethod
+    def sections(text:str, headings:list) -> list:
+        "(start, end, path) of the sections of text delimited by headings; path is the tuple of the enclosing titles."
+        sections = []
+        stack = []
+        path = ()
+        position = 0
+        for offset, level, title in sorted(headings, key=lambda heading: heading[0]):
+            if offset > position:
+                sections.append((position, offset, path))
+                position = offset
+            stack = [entry for entry in stack if entry[0] < level]
+            if title:
+                stack.append((level, title))
+            path = tuple(entry[1] for entry in stack)
+        if len(text) > position:
+            sections.append((position, len(text), path))
+        return sections
+
+
+    def _can_join(self, current:list, path:tuple, text:str) -> bool:
+        first = current[2]
+        return self._length(text, current[0], current[1]) < self.min_chunk_size \
+                and len(path) >= len(first) and path[:max(len(first) - 1, 0)] == first[:-1]
+
+
+    def _overlap_start(self, text:str, paragraphs:list, start:int, end:int) -> int:
+        "Start of the next chunk, moved back over the trailing paragraphs of the previous chunk that fit in chunk_overlap."
+        for paragraph_start, _ in reversed(paragraphs):
+            if self._length(text, paragraph_start, paragraphs[-1][1]) > self.chunk_overlap \
+                    or self._length(text, paragraph_start, end) > self.chunk_size:
+                break
+            start = paragraph_start
+        return start
+
+
+    def _paragraphs(self, text:str, start:int, end:int, depth:int=0) -> list:
+        "(start, end) of the paragraphs of text[start:end], without surrounding whitespace, each at most chunk_size long."
+        while start < end and text[start].isspace():
+            start += 1
+        while end > start and text[end - 1].isspace():
+            end -= 1
+        if start == end:
+            return []
+        if self._length(text, start, end) <= self.chunk_size:
+            return [(start, end)]
+        if depth == len(_SEPARATORS):
+            ## A single word longer than a chunk
+            return [(position, min(position + self.chunk_size, end)) for position in range(start, end, self.chunk_size)]
+
+        ## Lines, sentences and words are packed back together by split_text
+        paragraphs = []
+        position = start
+        for match in _SEPARATORS[depth].finditer(text, start, end):
+            paragraphs.extend(self._paragraphs(text, position, match.start(), depth + 1))
+            position = match.end()
+        paragraphs.extend(self._paragraphs(text, position, end, depth + 1))
+        return paragraphs
+
+
+    def _length(self, text:str, start:int, end:int) -> int:
+        if self.length_function is len:
+            return end - start
+        return self.length_function(text[start:end])
+
+
+
+class TextStore:
+    """
+    Keeps the text of every source once: the chunks added for a source are merged back into runs of contiguous
+    text (overlapping chunks share their overlap), and each chunk is a ChunkRef (source id, start, end) into them.
+    The text of a source is released when its last chunk is.
+
+    A chunk that contradicts the text already stored at its offsets (e.g. a modified chunk added while older chunks
+    of the source are still in use) is stored in a run of its own, under a private source id.
+    """
+
+    def __init__(self):
+        self._runs = {}         # source id -> [[start, text]], sorted, neither overlapping nor adjacent
+        self._refcounts = {}    # source id -> number of chunks
+        self._n_private = 0
+
+
+    def add(self, source_id:str, spans:list) -> list:
+        """
+        Adds chunks of a source, given as (start, text) pairs.
+
+        Returns:
+            list: The ChunkRef of each chunk, in the order of spans.
+        """
+        order = sorted(range(len(spans)), key=lambda i: spans[i][0])
+        refs = [None] * len(spans)
+
+        ## The chunks are first merged into new runs, joined once each, then into the runs already stored
+        run_start, parts, run_end, members = None, [], None, []
+        new_runs = []
+        for i in order:
+            start, text = spans[i]
+            end = start + len(text)
+            if run_start is not None and start <= run_end:
+                overlap = min(run_end, end) - start
+                if _tail(parts, run_end - start)[:overlap] == text[:overlap]:
+                    if end > run_end:
+                        parts.append(text[run_end - start:])
+                        run_end = end
+                    members.append(i)
+                    continue
+                refs[i] = self._add_private(start, text)
+                continue
+            if run_start is not None:
+                new_runs.append((run_start, "".join(parts), members))
+            run_start, parts, run_end, members = start, [text], end, [i]
+        if run_start is not None:
+            new_runs.append((run_start, "".join(parts), members))
+
+        for start, text, members in new_runs:
+            stored_id = source_id if self._merge(source_id, start, text) else self._new_private(start, text)
+            for i in members:
+                refs[i] = ChunkRef(stored_id, spans[i][0], spans[i][0] + len(spans[i][1]))
+                self._refcounts[stored_id] = self._refcounts.get(stored_id, 0) + 1
+        return refs
+
+
+    def text(self, ref:ChunkRef) -> str:
+        runs = self._runs[ref.source_id]
+        run_start, run_text = runs[bisect.bisect_right(runs, ref.start, key=lambda run: run[0]) - 1]
+        return run_text[ref.start - run_start:ref.end - run_start]
+
+
+    def release(self, ref:ChunkRef):
+        "Releases a chunk; the text of its source is dropped with its last chunk."
+        self._refcounts[ref.source_id] -= 1
+        if self._refcounts[ref.source_id] == 0:
+            del self._refcounts[ref.source_id]
+            del self._runs[ref.source_id]
+
+
+    def n_chars(self) -> int:
+        "Number of characters stored."
+        return sum(len(text) for runs in self._runs.values() for _, text in runs)
+
+
+    def _merge(self, source_id:str, start:int, text:str) -> bool:
+        "Merges a run into the runs of a source. Returns False, without changing them, if it contradicts them."
+        runs = self._runs.setdefault(source_id, [])
+        end = start + len(text)
+        first = bisect.bisect_left(runs, start, key=lambda run: run[0] + len(run[1]))
+        last = bisect.bisect_right(runs, end, key=lambda run: run[0])
+        touching = runs[first:last]
+        for run_start, run_text in touching:
+            overlap_start, overlap_end = max(start, run_start), min(end, run_start + len(run_text))
+            if run_text[overlap_start - run_start:overlap_end - run_start] != text[overlap_start - start:overlap_end - start]:
+                return False
+        if touching:
+            merged_start = min(start, touching[0][0])
+            pieces = []
+            position = merged_start
+            for run_start, run_text in touching:
+                if run_start > position:
+                    pieces.append(text[position - start:run_start - start])
+                pieces.append(run_text[max(position, run_start) - run_start:])
+                position = max(position, run_start + len(run_text))
+            if end > position:
+                pieces.append(text[position - start:])
+            runs[first:last] = [[merged_start, "".join(pieces)]]
+        else:
+            runs.insert(first, [start, text])
+        return True
+
+
+    def _new_private(self, start:int, text:str) -> str:
+        self._n_private += 1
+        source_id = f"\0private{self._n_private}"
+        self._runs[source_id] = [[start, text]]
+        return source_id
+
+
+    def _add_private(self, start:int, text:str) -> ChunkRef:
+        source_id = self._new_private(start, text)
+        self._refcounts[source_id] = 1
+        return ChunkRef(source_id, start, start + len(text))
+
+
+
+class OffsetDocstore(Docstore, AddableMixin):
+    """
+    Docstore of a FAISS vector store that keeps the text of the chunks in a TextStore: the text of each source is
+    stored once and the chunks are (source id, start, end) offsets into it, instead of one copy per chunk and
+    per overlap. Documents are rebuilt from their offsets and metadata when they are looked up.
+
+    Chunks are placed in their source by their metadata: 'source' (or 'source_doc'), 'page' and 'start_index'
+    (0 if missing, e.g. for an unsplit document).
+    """
+
+    def __init__(self):
+        self.texts = TextStore()
+        self._docs = {}     # id -> (ChunkRef, metadata)
+
+
+    def add(self, texts:Dict[str, Document]) -> None:
+        overlapping = set(texts).intersection(self._docs)
+        if overlapping:
+            raise ValueError(f"Tried to add ids that already exist: {overlapping}")
+        by_source = {}
+        for doc_id, doc in texts.items():
+            by_source.setdefault(_source_id(doc.metadata), []).append((doc_id, doc))
+        for source_id, docs in by_source.items():
+            refs = self.texts.add(source_id, [(doc.metadata.get('start_index') or 0, doc.page_content) for _, doc in docs])
+            for (doc_id, doc), ref in zip(docs, refs):
+                self._docs[doc_id] = (ref, doc.metadata)
+
+
+    def delete(self, ids:List) -> None:
+        ## All ids are checked before any is removed, so a failed delete leaves the store unchanged
+        missing = set(ids).difference(self._docs)
+        if missing:
+            raise ValueError(f"Tried to delete ids that do not exist: {sorted(missing)}")
+        for doc_id in dict.fromkeys(ids):
+            ref, _ = self._docs.pop(doc_id)
+            self.texts.release(ref)
+
+
+    def search(self, search:str):
+        entry = self._docs.get(search)
+        if entry is None:
+            return f"ID {search} not found."
+        ref, metadata = entry
+        return Document(id=search, page_content=self.texts.text(ref), metadata=metadata)
+
+
+    def __len__(self) -> int:
+        return len(self._docs)
+
+
+    def compact(self):
+        "Rebuilds the TextStore from the chunks in the store, dropping text that no chunk uses anymore."
+        documents = {doc_id: self.search(doc_id) for doc_id in self._docs}
+        self.texts = TextStore()
+        self._docs = {}
+        self.add(documents)
+
+
+    def stats(self) -> dict:
+        "Characters stored, and characters the chunks would take as separate copies."
+        return {
+            'chunks': len(self._docs)
+            , 'stored_chars': self.texts.n_chars()
+            , 'chunk_chars': sum(ref.end - ref.start for ref, _ in self._docs.values())
+        }
+
+
+
+def _source_id(metadata:dict) -> str:
+    source = metadata.get('source') or metadata.get('source_doc')
+    return f"{source}\0{metadata.get('page', '')}"
+
+
+def _tail(parts:list, n:int) -> str:
+    "The last n characters of the concatenation of parts, without joining all of them."
+    tail = []
+    length = 0
+    for part in reversed(parts):
+        if length >= n:
+            break
+        tail.append(part)
+        length += len(part)
+    return "".join(reversed(tail))[-n:] if n > 0 else ""
+
+
+def _common_prefix(paths:list) -> tuple:
+    prefix = paths[0]
+    for path in paths[1:]:
+        length = 0
+        while length < min(len(prefix), len(path)) and prefix[length] == path[length]:
+            length += 1
+        prefix = prefix[:length]
+    return prefix
@@ -0,0 +1,221 @@
+import os
+import re
+from collections import namedtuple
+from typing import List
+
+from langchain_core.documents.base import Document
+
+from dedup_utils import ChunkDeduplicator
+from embedding_utils import count_tokens, truncate_tokens
+
+
+
+## Token budget of the retrieved documents in the IEP_RAG_PROMT prompt
+DEFAULT_CONTEXT_BUDGET = 1500
+
+## Blocks sharing this fraction of the word shingles of the smaller one are near-duplicates
+DEFAULT_DUPLICATE_THRESHOLD = 0.8
+
+## Number of words per shingle of the near-duplicate detection
+_SHINGLE_SIZE = 3
+
+## Blocks that would be truncated to fewer tokens than this are left out instead
+_MIN_BLOCK_TOKENS = 40
+
+_WORD_PATTERN = re.compile(r"\w+")
+
+
+PackedContext = namedtuple("PackedContext", [
+    "text",             # Formatted context, placed in the prompt
+    "documents",        # Merged blocks included in the context, as Documents
+    "tokens",           # Tokens of text
+    "raw_tokens",       # Tokens of the unpacked documents, as they used to be placed in the prompt (str(list))
+    "n_chunks",         # Number of chunks packed
+    "n_merged",         # Chunks merged into an overlapping or adjacent chunk of the same source
+    "n_duplicates",     # Blocks dropped as near-duplicates
+    "n_truncated",      # Blocks truncated to fit the budget
+    "n_dropped"         # Blocks left out because the budget was exhausted
+])
+
+
+class ContextUtils:
+    """
+    Packs retrieved chunks into a compact prompt context: overlapping or adjacent chunks of the same source
+    are merged back into one block, near-duplicate blocks are dropped, and the blocks are formatted with a
+    one-line header and added until the token budget is reached.
+    """
+
+
+    @staticmethod
+    def pack(documents:List[Document], budget:int=DEFAULT_CONTEXT_BUDGET
+                , duplicate_threshold:float=DEFAULT_DUPLICATE_THRESHOLD) -> PackedContext:
+        """
+        Args:
+            documents (list): Retrieved chunks, best first.
+            budget (int): Maximum number of tokens of the context (see embedding_utils.count_tokens).
+            duplicate_threshold (float): Overlap coefficient of word shingles above which a block is dropped
+                as a near-duplicate of a better-ranked one. None keeps all blocks.
+
+        Returns:
+            PackedContext: The context, its blocks and the statistics of the packing.
+        """
+        documents = [doc for doc in documents if doc is not None]
+        blocks = ContextUtils.merge_chunks(documents)
+        n_merged = len(documents) - len(blocks)
+
+        n_duplicates = 0
+        if duplicate_threshold is not None:
+            unique, shingles = [], []
+            for block in blocks:
+                block_shingles = ContextUtils.shingles(block.page_content)
+                if any(ContextUtils.overlap(block_shingles, other) >= duplicate_threshold for other in shingles):
+                    n_duplicates += 1
+                    continue
+                unique.append(block)
+                shingles.append(block_shingles)
+            blocks = unique
+
+        ## Blocks are selected one category at a time in turn, so a small budget is not spent on the first
+        ## category alone, then formatted in their ranking order
+        selected = {}
+        remaining = budget
+        n_truncated = 0
+        for i in ContextUtils._round_robin(blocks):
+            header = ContextUtils.header(blocks[i])
+            tokens = count_tokens(f"{header}\n{blocks[i].page_content}\n\n")
+            if tokens <= remaining:
+                selected[i] = blocks[i]
+                remaining -= tokens
+            elif remaining - count_tokens(f"{header}\n\n\n") >= _MIN_BLOCK_TOKENS:
+                text = truncate_tokens(blocks[i].page_content, remaining - count_tokens(f"{header}\n\n\n"))
+                selected[i] = Document(id=blocks[i].id, page_content=text, metadata=blocks[i].metadata)
+                remaining -= count_tokens(f"{header}\n{text}\n\n")
+                n_truncated += 1
+
+        packed = [selected[i] for i in sorted(selected)]
+        text = "\n\n".join(f"[{n}] {ContextUtils.header(block)}\n{block.page_content}" for n, block in enumerate(packed, start=1))
+        return PackedContext(text=text, documents=packed, tokens=count_tokens(text), raw_tokens=count_tokens(str(documents))
+                                , n_chunks=len(documents), n_merged=n_merged, n_duplicates=n_duplicates
+                                , n_truncated=n_truncated, n_dropped=len(blocks) - len(selected))
+
+
+    @staticmethod
+    def stats(packed:PackedContext) -> dict:
+        "Statistics of a packed context, including the tokens saved compared to the unpacked documents."
+        stats = packed._asdict()
+        del stats['text'], stats['documents']
+        stats['tokens_saved'] = packed.raw_tokens - packed.tokens
+        return stats
+
+
+    @staticmethod
+    def merge_chunks(documents:List[Document]) -> List[Document]:
+        """
+        Merges the chunks of the same source and page whose text overlaps or is adjacent (according to their
+        start_index, see DataProcessor._default_text_splitter and chunk_utils.StructureChunker), removing the
+        repeated overlap. Consecutive chunks of a StructureChunker (by chunk_index) are only separated by
+        whitespace, which is not stored with them: they are joined with a single space. Each merged block takes
+        the rank of its best chunk. Chunks without start_index are kept as they are.
+        """
+        groups = {}
+        for rank, doc in enumerate(documents):
+            key = (doc.metadata.get('source'), doc.metadata.get('source_doc'), doc.metadata.get('page'))
+            if doc.metadata.get('start_index') is None:
+                key = (rank,)
+            groups.setdefault(key, []).append((rank, doc))
+
+        blocks = []
+        for chunks in groups.values():
+            chunks.sort(key=lambda chunk: chunk[1].metadata.get('start_index', 0))
+            rank, doc = chunks[0]
+            start, text = doc.metadata.get('start_index', 0), doc.page_content
+            last = doc
+            for next_rank, next_doc in chunks[1:]:
+                next_start = next_doc.metadata['start_index']
+                if next_start <= start + len(text):
+                    ## Overlapping or adjacent: append the part of the next chunk that is not already in the block
+                    text += next_doc.page_content[start + len(text) - next_start:]
+                elif ContextUtils._consecutive(last, next_doc):
+                    text += " " + next_doc.page_content
+                    ## Keeps start + len(text) at the end of the block in the source, for the overlap of the next chunk
+                    start = next_start + len(next_doc.page_content) - len(text)
+                else:
+                    blocks.append((rank, ContextUtils._block(doc, text)))
+                    rank, doc, start, text = next_rank, next_doc, next_start, next_doc.page_content
+                rank = min(rank, next_rank)
+                last = next_doc
+            blocks.append((rank, ContextUtils._block(doc, text)))
+
+        return [block for _, block in sorted(blocks, key=lambda block: block[0])]
+
+
+    @staticmethod
+    def _consecutive(doc:Document, next_doc:Document) -> bool:
+        index, next_index = doc.metadata.get('chunk_index'), next_doc.metadata.get('chunk_index')
+        return index is not None and next_index == index + 1
+
+
+    @staticmethod
+    def _block(doc:Document, text:str) -> Document:
+        if text == doc.page_content:
+            return doc
+        return Document(id=doc.id, page_content=text, metadata=doc.metadata)
+
+
+    @staticmethod
+    def header(doc:Document) -> str:
+        """
+        One-line description of a block, e.g. 'career_profile | https://www.bls.gov/ooh/... ' or 'state_standards | standards.pdf, p. 12'.
+        Chunks that stand for duplicates removed from other sources (see dedup_utils.ChunkDeduplicator) cite them too,
+        and chunks split on the structure of their source end with their section (see chunk_utils.StructureChunker).
+        """
+        citations = [ContextUtils.citation(source) for source in ChunkDeduplicator.citations(doc.metadata)]
+        citations = list(dict.fromkeys(citations))
+        header = f"{doc.metadata.get('info_category')} | {citations[0]}"
+        if len(citations) > 1:
+            header += f" (also in {'; '.join(citations[1:])})"
+        if doc.metadata.get('section'):
+            header += f" | {doc.metadata['section']}"
+        return header
+
+
+    @staticmethod
+    def citation(metadata:dict) -> str:
+        "Source of a chunk (URL or file name) and its page, e.g. 'standards.pdf, p. 12'."
+        source = metadata.get('source') or metadata.get('source_doc') or "unknown source"
+        if not "://" in source:
+            source = os.path.basename(source)
+        page = metadata.get('page_label', metadata.get('page'))
+        if page is not None:
+            source = f"{source}, p. {page}"
+        return source
+
+
+    @staticmethod
+    def shingles(text:str) -> set:
+        words = _WORD_PATTERN.findall(text.lower())
+        if len(words) < _SHINGLE_SIZE:
+            return {tuple(words)}
+        return {tuple(words[i:i + _SHINGLE_SIZE]) for i in range(len(words) - _SHINGLE_SIZE + 1)}
+
+
+    @staticmethod
+    def overlap(a:set, b:set) -> float:
+        "Overlap coefficient |a & b| / min(|a|, |b|): 1.0 when one set is contained in the other."
+        if not a or not b:
+            return 0.0
+        return len(a & b) / min(len(a), len(b))
+
+
+    @staticmethod
+    def _round_robin(blocks:List[Document]) -> list:
+        "Indices of blocks, taking the best remaining block of each info_category in turn."
+        by_category = {}
+        for i, block in enumerate(blocks):
+            by_category.setdefault(block.metadata.get('info_category'), []).append(i)
+        order = []
+        queues = list(by_category.values())
+        while queues:
+            order.extend(queue.pop(0) for queue in queues)
+            queues = [queue for queue in queues if queue]
+        return order
@@ -1,17 +1,54 @@
 import requests
 from bs4 import BeautifulSoup
+import hashlib
+import math
+import multiprocessing
 import os
+import time
+import warnings
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
+from bs4.element import CData, NavigableString, Tag
+from pypdf import PdfReader
+
 from langchain_community.document_loaders import PyPDFLoader
 from langchain.schema import Document
-from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+from catalog_utils import OccupationCatalog, DEFAULT_CATALOG_DIR, DEFAULT_CATALOG_CACHE
+from chunk_utils import StructureChunker, DEFAULT_CHUNK_SIZE, DEFAULT_CHUNK_OVERLAP
+from dedup_utils import ChunkDeduplicator, DEFAULT_DEDUP_THRESHOLD, DEFAULT_NUM_PERM
+from fetch_utils import HTTPFetcher, get_fetcher
+from metrics_utils import METRICS
 
 
 
 
 PARENT_DIR = Path(__file__).resolve().parent
 
+STATE_STANDARDS_PDF = os.path.join(PARENT_DIR, "data/State_Educational_Standards_IOWA _k-12.pdf")
+
+## (level, regex) of the headings of the state standards pages: the literacy at the top of every page, the grade
+## bands, the essential concepts (by their code, e.g. 21.9-12.ES.4), the grades, illustrations and anchor standards
+STANDARDS_HEADING_PATTERNS = [
+    (1, r"^(?P<title>Employability Skills|[A-Z]\w+ Literacy)[ \t]*$")
+    , (2, r"^(?P<title>(?:Elementary|Middle|High School) \([^)\n]*\))")
+    , (2, r"^Essential Concept and/or Skill:[^\n]*(?:\n[^\n]+){0,3}?\((?P<title>21\.[\w.-]+)\)")
+    , (3, r"^(?P<title>(?:Kindergarten|[A-Z][a-z]+ Grade)\b[^\n]*)")
+    , (3, r"^(?P<title>Illustration):")
+    , (4, r"^• (?P<title>Anchor Standard: [^\n]*)")
+]
+
+IDEA_URL = "https://sites.ed.gov/idea/regs/b/d/300.320/b"
+
+## Use the (much faster) lxml parser backend when it is installed
+try:
+    from lxml import etree as lxml_etree
+    HTML_PARSER = "lxml"
+except ImportError:
+    HTML_PARSER = "html.parser"
+
 
 APPLICABLE_OCCUPATIONS ={
     "retail_salesperson": {
@@ -47,217 +84,753 @@ APPLICABLE_OCCUPATIONS ={
 
 }
 
+## Built on first use from the profiles in DEFAULT_CATALOG_DIR, with APPLICABLE_OCCUPATIONS as curated entries
+_CATALOG = None
+
 
 
 
 class DataProcessor:
 
     @staticmethod
-    def extract_content(source, from_url=True, metadata=None):
+    def extract_content(source, from_url=True, metadata=None, fetcher:HTTPFetcher=None, headings:bool=False):
         """
         Extracts text from <p>, <h3>, <h5> and <table> tags from a URL or local HTML file.
+        The page is parsed with lxml when it is installed, and walked once (see _TextBlockExtractor).
 
         Args:
             source (str): URL or file path to the HTML content.
             from_url (bool): True if source is a URL; False if it's a local file.
+            fetcher (HTTPFetcher): Fetches URLs through its session and cache (the shared fetch_utils.get_fetcher() by default),
+                so unchanged pages are not downloaded again and cached pages are used offline.
+            headings (bool): Records the section structure of the page in metadata['headings'], as (offset, level, title)
+                for the StructureChunker. Tables and divs, which follow the text, are placed back under the heading
+                that precedes them in the page.
 
         Returns:
             str: Combined readable content from paragraphs, headers, and tables.
 
         """
 
-        def is_inside_nav(tag):
-            return any(parent.name == "nav" for parent in tag.parents)
-
-        # if True:
-        try:
-            # Load HTML
-            if from_url:
-                headers = {
-                    "User-Agent": (
-                        "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
-                        "AppleWebKit/537.36 (KHTML, like Gecko) "
-                        "Chrome/114.0.0.0 Safari/537.36"
-                    )
-                }
-                response = requests.get(source, headers=headers)
-                response.raise_for_status()
-                html = response.content
-            else:
-                if not os.path.exists(source):
-                    return f"Error: File not found: {source}"
-                with open(source, "r", encoding="utf-8") as f:
-                    html = f.read()
-
-            soup = BeautifulSoup(html, "html.parser")
-            output = []
-
-            # Get paragraphs and headers
-            for tag in soup.find_all(["h1", "h2","h3", "h5", "h6", "p", "br", "li"]): #, "a"
-                if tag.name == "p" and "visually-hidden" in tag.get("class", []):
-                    continue
-                elif tag.name == "li" and not "" in tag.get("class", []):
-                    continue
-                
-                text = tag.get_text(separator=" ", strip=True)
-                if text:
-                    output.append(text)
-
-            # Get tables
-            for table in soup.find_all("table"):
-                rows = []
-                for tr in table.find_all("tr"):
-                    cells = [td.get_text(strip=True) for td in tr.find_all(["td", "th"])]
-                    if cells:
-                        rows.append(" | ".join(cells))
-                if rows:
-                    output.append("\n".join(rows))
-
-            # # Extract from <div> with class "order-2 flex-grow-1"
-            for div in soup.find_all("div", class_="order-2 flex-grow-1"):
-
-                if not ("visually-hidden" in div.get("class", []) or "dropdown-menu" in div.get("class", [])):
-                    if not is_inside_nav(div):
-                        text = div.get_text(separator=" ", strip=True)
-                        if text:
-                            output.append(text)
-
-            for div in soup.find_all("div", class_="reportsection"):
-                if not is_inside_nav(div):
-                    text = div.get_text(separator=" ", strip=True)
-                    if text:
-                        output.append(text)
-
-            if metadata is None:
+        with METRICS.span("ingest", kind="html", source=source if from_url else os.path.basename(source)) as span:
+            # if True:
+            try:
+                # Load HTML
                 if from_url:
-                    metadata = {'source': source, 'source_doc':None}
+                    html = (fetcher or get_fetcher()).get(source)
                 else:
-                    metadata = {'source': None, 'source_doc': source}
-        
-            return Document(page_content="\n\n".join(output[:]), metadata=metadata)
-
-        except requests.exceptions.RequestException as e:
-            return f"Error fetching content from URL: {e}"
-        except Exception as e:
-            return f"Unexpected error: {e}"
+                    if not os.path.exists(source):
+                        span.error = "File not found"
+                        return f"Error: File not found: {source}"
+                    with open(source, "r", encoding="utf-8") as f:
+                        html = f.read()
+
+                blocks = _extract_structured_blocks(html)
+                output = [block[0] for block in blocks]
+
+                if metadata is None:
+                    if from_url:
+                        metadata = {'source': source, 'source_doc':None}
+                    else:
+                        metadata = {'source': None, 'source_doc': source}
+                if headings:
+                    metadata = dict(metadata, headings=_heading_marks(blocks, separator="\n\n"))
+
+                span.set(chars=sum(len(block) for block in output))
+                return Document(page_content="\n\n".join(output[:]), metadata=metadata)
+
+            except requests.exceptions.RequestException as e:
+                span.error = f"{type(e).__name__}: {e}"
+                return f"Error fetching content from URL: {e}"
+            except Exception as e:
+                span.error = f"{type(e).__name__}: {e}"
+                return f"Unexpected error: {e}"
 
 
     @staticmethod
     def parse_pdf(pdf_pathname, split=True, **kwargs ):
-        
-        loader = PyPDFLoader(pdf_pathname)  # Replace with your PDF file path
-        documents = loader.load()
+        """
+        Loads a PDF (one Document per page) and optionally splits it into chunks.
 
+        kwargs:
+            info_category (str): Added to the metadata of every page.
+            text_splitter: Splitter to use instead of the default StructureChunker (see _default_text_splitter).
+            max_workers (int): When larger than 1, page ranges are extracted in parallel on a process pool.
+            pages_per_task (int): Number of pages per parallel task (default: spread evenly over the workers).
+        """
         info_category=kwargs.get('info_category', None)
+        max_workers = kwargs.get('max_workers', 1)
 
-        if not info_category is None:
-            for d in documents:
-                d.metadata['info_category'] = info_category
-
+        text_splitter = None
         if split:
             text_splitter = kwargs.get('text_splitter', None)
             if text_splitter is None:
-                text_splitter = kwargs.get('text_splitter', 
-                                                RecursiveCharacterTextSplitter(
-                                                    chunk_size=500,  # Maximum characters per chunk
-                                                    chunk_overlap=100,  # Overlap to maintain context between chunks
-                                                    length_function=len
-                                                )
-                                            )  
+                text_splitter = DataProcessor._default_text_splitter()
 
-            chunks = text_splitter.split_documents(documents)
+        if max_workers is not None and max_workers > 1:
+            tasks = DataProcessor._pdf_tasks(pdf_pathname, max_workers, text_splitter=text_splitter
+                                                , info_category=info_category, pages_per_task=kwargs.get('pages_per_task'))
+            with _process_pool(max_workers) as executor:
+                return [doc for docs in _iter_ordered(executor, tasks, window=len(tasks)) for doc in docs]
 
+        return list(DataProcessor._iter_pdf_pages(pdf_pathname, info_category=info_category, text_splitter=text_splitter))
 
 
-            return chunks
-        else:
-            return documents
+    @staticmethod
+    def _default_text_splitter(**kwargs):
+        """
+        Splits on the structure of the documents: the headings of the career profiles (see extract_content) and
+        the STANDARDS_HEADING_PATTERNS of the state standards. Chunks record their offset in their page
+        ('start_index'), which makes chunk ids stable (see chunk_id), their position in it ('chunk_index') and
+        their section path ('section').
+        """
+        return StructureChunker(
+                    chunk_size=kwargs.get('chunk_size', DEFAULT_CHUNK_SIZE),  # Maximum characters per chunk
+                    chunk_overlap=kwargs.get('chunk_overlap', DEFAULT_CHUNK_OVERLAP),
+                    heading_patterns=STANDARDS_HEADING_PATTERNS,
+                    length_function=kwargs.get('length_function', len)
+                )
 
 
     @staticmethod
-    def collect_and_process_documents(occupations:[str, list]=None, **kwargs):
+    def _iter_pdf_pages(pdf_pathname, info_category=None, text_splitter=None):
+        "Yields the pages of a PDF (or their chunks) one page at a time."
+        loader = PyPDFLoader(pdf_pathname)  # Replace with your PDF file path
+        pages = loader.lazy_load()
+        ## Timed by hand, since spans cannot stay open across the yields of a generator
+        n_pages, parse_s, split_s = 0, 0.0, 0.0
+        while True:
+            start = time.perf_counter()
+            page = next(pages, None)
+            parse_s += time.perf_counter() - start
+            if page is None:
+                break
+            n_pages += 1
+            if not info_category is None:
+                page.metadata['info_category'] = info_category
+            if text_splitter is None:
+                yield page
+            else:
+                start = time.perf_counter()
+                chunks = text_splitter.split_documents([page])
+                split_s += time.perf_counter() - start
+                yield from chunks
+
+        METRICS.record_span("ingest", parse_s, kind="pdf", source=os.path.basename(pdf_pathname), pages=n_pages)
+        if text_splitter is not None:
+            METRICS.record_span("chunk", split_s, source=os.path.basename(pdf_pathname), pages=n_pages)
+
+
+    @staticmethod
+    def _pdf_tasks(pdf_pathname, max_workers:int, text_splitter=None, info_category=None, pages_per_task=None):
+        "Returns one (function, args) task per page range of the PDF, in page order."
+        n_pages = len(PdfReader(pdf_pathname).pages)
+        if pages_per_task is None:
+            pages_per_task = max(1, math.ceil(n_pages / max_workers))
+
+        return [(_load_pdf_pages, (pdf_pathname, start, min(start + pages_per_task, n_pages), info_category, text_splitter))
+                    for start in range(0, n_pages, pages_per_task)]
+
+
+    @staticmethod
+    def get_catalog(refresh:bool=False) -> OccupationCatalog:
+        """
+        Returns the occupation catalog: the career profiles found in data/career_profiles, with the entries of
+        APPLICABLE_OCCUPATIONS first and under their keys. File metadata is cached in data/occupation_catalog.json,
+        so only new or modified profiles are parsed. refresh rebuilds the catalog (e.g. after adding profiles).
+        """
+        global _CATALOG
+        if _CATALOG is None or refresh:
+            _CATALOG = OccupationCatalog.discover(DEFAULT_CATALOG_DIR, seeds=APPLICABLE_OCCUPATIONS, cache_path=DEFAULT_CATALOG_CACHE)
+        return _CATALOG
+
+
+    @staticmethod
+    def refresh_career_profiles(fetcher:HTTPFetcher=None, occupations:[str, list]=None) -> dict:
+        """
+        Downloads the career profiles whose page changed on bls.gov (see OccupationCatalog.download) and reloads
+        the catalog. The next index load then updates the changed sources only (see RAGUtils.update_vectorstore).
+
+        Returns:
+            dict: {occupation key: 'updated', 'unchanged' or 'error: <message>'}
+        """
+        keys = None if occupations is None else [occ.key for occ in DataProcessor._resolve_occupations(occupations)]
+        outcomes = DataProcessor.get_catalog().download(fetcher=fetcher, keys=keys)
+        DataProcessor.get_catalog(refresh=True)
+        return outcomes
 
-        if occupations is None:
-            occupations = [occ for occ in APPLICABLE_OCCUPATIONS]
 
+    @staticmethod
+    def _resolve_occupations(occupations:[str, list]=None) -> list:
+        "Returns the catalog entries for occupation keys, titles, aliases or SOC codes (all occupations if None)."
+        catalog = DataProcessor.get_catalog()
+        if occupations is None:
+            return list(catalog)
         elif isinstance(occupations, str):
             occupations=[occupations]
 
+        resolved = []
+        for occupation in occupations:
+            occ = catalog.lookup(occupation, fuzzy=False)
+            assert not occ is None, f"The occupation you provided is not supported: '{occupation}'. It must be a key, title, alias or SOC code of the occupation catalog, e.g. {catalog.keys()[:5]}"
+            resolved.append(occ)
+        return resolved
 
-        text_splitter = kwargs.get('text_splitter', None)
 
-        if text_splitter is None:
-            chunk_size = kwargs.get('chunk_size', 500)
-            chunk_overlap = kwargs.get('chunk_overlap', 100)
-            length_function=kwargs.get('chunk_overlap', len)
+    @staticmethod
+    def load_occupation(occupation:str, split:bool=True, **kwargs) -> list:
+        """
+        Loads the career profile of one occupation of the catalog (given by key, title, alias or SOC code,
+        with fuzzy matching) on demand.
 
-            text_splitter = RecursiveCharacterTextSplitter(
-                chunk_size=chunk_size,  # Maximum characters per chunk
-                chunk_overlap=chunk_overlap,  # Overlap to maintain context between chunks
-                length_function=length_function
-            )
+        Returns:
+            list: The profile as a single Document, or its chunks if split is True.
+        """
+        occ = DataProcessor.get_catalog().lookup(occupation)
+        assert not occ is None, f"No occupation of the catalog matches '{occupation}'."
+        text_splitter = None
+        if split:
+            text_splitter = kwargs.get('text_splitter', None) or DataProcessor._default_text_splitter(**kwargs)
+        return _extract_and_split_profile(occ.source_doc, DataProcessor._career_profile_metadata(occ), text_splitter)
 
 
-        occ_metadata_ = {}
-        occ_metadata_['career_profile']  = None
-        occ_metadata_['state_standards'] = None
-        # occ_metadata_['iep_goals_and_transition_templates'] = None
-        occ_metadata_['idea'] = None
+    @staticmethod
+    def _career_profile_metadata(occupation) -> dict:
+        return {
+                'source_doc': occupation.source_doc
+                ,  'source': occupation.source
+                , 'info_category': 'career_profile'
+            }
 
-        career_docs = []
 
-        for occupation in occupations:
-            assert occupation in APPLICABLE_OCCUPATIONS, f"The occupation you provided is not supported. It must be one of the following: {list(APPLICABLE_OCCUPATIONS.keys())}"
+    @staticmethod
+    def list_sources(occupations:[str, list]=None):
+        """
+        Lists the sources that collect_and_process_documents reads, without parsing them.
+
+        Returns:
+            list: dicts with 'source_doc', 'source' and 'info_category' keys.
+        """
+        sources = []
+        for occupation in DataProcessor._resolve_occupations(occupations):
+            sources.append(DataProcessor._career_profile_metadata(occupation))
+
+        sources.append({'source_doc': STATE_STANDARDS_PDF, 'source': None, 'info_category': 'state_standards'})
+        sources.append({'source_doc': None, 'source': IDEA_URL, 'info_category': 'idea'})
 
-            
+        return sources
 
-            ## Retrieve Job occupation data from BLS
-            jobpro =  DataProcessor.extract_content(source=APPLICABLE_OCCUPATIONS[occupation]['source_doc'], 
-                metadata = {
-                            'source_doc': APPLICABLE_OCCUPATIONS[occupation]['source_doc']
-                            ,  'source': APPLICABLE_OCCUPATIONS[occupation]['source']
-                            , 'info_category': 'career_profile'
 
-                        }
-                    , from_url=False)
+    @staticmethod
+    def chunking_params(**kwargs) -> dict:
+        "Returns the text extraction and splitter parameters collect_and_process_documents uses for the given kwargs."
+        return {
+            'splitter': 'StructureChunker'
+            , 'chunk_size': kwargs.get('chunk_size', DEFAULT_CHUNK_SIZE)
+            , 'chunk_overlap': kwargs.get('chunk_overlap', DEFAULT_CHUNK_OVERLAP)
+            , 'html_parser': HTML_PARSER
+            , 'add_start_index': True
+            , 'dedup_threshold': kwargs.get('dedup_threshold', DEFAULT_DEDUP_THRESHOLD)
+            , 'dedup_num_perm': kwargs.get('dedup_num_perm', DEFAULT_NUM_PERM)
+        }
+
+
+    @staticmethod
+    def source_key(metadata:dict) -> str:
+        """
+        Identifies the source document of a chunk (or a record of list_sources): its URL, or else the path of the
+        local file relative to the project.
+        """
+        source = metadata.get('source') or metadata.get('source_doc')
+        if source and os.path.isabs(source):
+            source = os.path.relpath(source, PARENT_DIR)
+        return source
+
+
+    @staticmethod
+    def chunk_id(chunk:Document, ordinal:int=0) -> str:
+        """
+        Stable id of a chunk, derived from its source, page and start offset, so re-parsing a source gives its
+        chunks the same ids. ordinal (the position of the chunk in its source) is used for chunks without a
+        'start_index', e.g. those of splitters that do not record offsets.
+        """
+        offset = chunk.metadata.get('start_index', f"#{ordinal}")
+        key = f"{DataProcessor.source_key(chunk.metadata)}\0{chunk.metadata.get('page', '')}\0{offset}"
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+    @staticmethod
+    def with_chunk_ids(chunks):
+        "Yields the chunks with their id set to chunk_id (chunks that already have an id are left as they are)."
+        ordinals = {}
+        for chunk in chunks:
+            source = DataProcessor.source_key(chunk.metadata)
+            ordinal = ordinals.get(source, 0)
+            ordinals[source] = ordinal + 1
+            if chunk.id is None:
+                chunk.id = DataProcessor.chunk_id(chunk, ordinal)
+            yield chunk
+
+
+    @staticmethod
+    def iter_source_documents(source:dict, split:bool=True, **kwargs):
+        """
+        Yields the chunks of a single source, a record of list_sources, exactly as iter_documents does for the
+        whole corpus. Used to add or refresh one source in an existing index (see VectorStoreUtils.upsert_source).
+        Duplicates are only removed within the source: chunks repeated in other sources are kept until the next full build.
+        """
+        chunks = DataProcessor._iter_source_chunks(source, split=split, **kwargs)
+        if split:
+            chunks = DataProcessor._deduplicate(chunks, **kwargs)
+        yield from DataProcessor.with_chunk_ids(chunks)
+
+
+    @staticmethod
+    def _iter_source_chunks(source:dict, split:bool=True, **kwargs):
+        category = source.get('info_category')
+        text_splitter = None
+        if split and category == 'career_profile':
+            text_splitter = kwargs.get('text_splitter', None) or DataProcessor._default_text_splitter(**kwargs)
+        elif split:
+            ## As in iter_documents, the state standards are always split with the default splitter
+            text_splitter = DataProcessor._default_text_splitter()
+
+        if category == 'career_profile':
+            source_doc = source['source_doc']
+            if not os.path.isabs(source_doc):
+                source_doc = os.path.join(PARENT_DIR, source_doc)
+            metadata = {'source_doc': source_doc, 'source': source['source'], 'info_category': category}
+            yield from _extract_and_split_profile(source_doc, metadata, text_splitter)
+
+        elif category == 'state_standards':
+            source_doc = source['source_doc']
+            if not os.path.isabs(source_doc):
+                source_doc = os.path.join(PARENT_DIR, source_doc)
+            yield from DataProcessor._iter_pdf_pages(source_doc, info_category=category, text_splitter=text_splitter)
+
+        elif category == 'idea':
+            idea_ = DataProcessor.extract_content(source=source['source'], from_url=True)
+            if not isinstance(idea_, Document):
+                raise ValueError(f"Sec. 300.320 (b) of IDEA could not be retrieved: {idea_}")
+            idea_.metadata['info_category'] = category
+            yield idea_
+
+        else:
+            raise ValueError(f"Unknown info category: {category}")
+
+
+    @staticmethod
+    def iter_documents(occupations:[str, list]=None, split:bool=True, **kwargs):
+        """
+        Yields the corpus one chunk at a time (or one source document / PDF page at a time if split is False):
+        the career profiles, then the state standards, then Sec. 300.320 (b) of IDEA.
+
+        Only a bounded number of sources is held in memory at once, so the corpus can be streamed straight
+        into the index (see RAGUtils.create_and_save_embeddings).
+
+        occupations are keys, titles, aliases or SOC codes of the occupation catalog (see get_catalog); all by default.
+
+        kwargs:
+            text_splitter, chunk_size, chunk_overlap, length_function: Splitter for the career profiles.
+                The state standards are always split with the default splitter and the IDEA page is not split.
+            max_workers (int): Number of worker processes (default: 1, parsing in the calling process). With more,
+                career profiles and PDF page ranges are parsed in parallel, a few tasks ahead of the consumer, and
+                yielded in order.
+            dedup_threshold (float): Chunks whose word shingles have an estimated Jaccard similarity of at least
+                dedup_threshold with an earlier chunk are dropped, as are exact duplicates; the kept chunk cites the
+                sources of its duplicates in metadata['sources'] (see dedup_utils.ChunkDeduplicator). None only drops
+                exact duplicates. Chunks are only deduplicated if split is True.
+            dedup_num_perm (int): Number of MinHash permutations.
+            deduplicator (ChunkDeduplicator): Deduplicator to use instead, e.g. to read its stats() afterwards.
+        """
+        chunks = DataProcessor._iter_corpus_chunks(occupations, split=split, **kwargs)
+        if split:
+            chunks = DataProcessor._deduplicate(chunks, **kwargs)
+        yield from chunks
 
-            # print("jobpro: ", jobpro)
-            career_docs.append(jobpro)
-        # print("Career Docs: ", len(career_docs) )
-        # print(career_docs[-1])
-        occ_metadata_['career_profile'] = text_splitter.split_documents(career_docs)
-        # print(len(occ_metadata_['career_profile']))
 
+    @staticmethod
+    def _deduplicate(chunks, **kwargs):
+        "Filters chunks through a ChunkDeduplicator configured by kwargs (see iter_documents), and reports the removals."
+        deduplicator = kwargs.get('deduplicator', None)
+        if deduplicator is None:
+            deduplicator = ChunkDeduplicator(threshold=kwargs.get('dedup_threshold', DEFAULT_DEDUP_THRESHOLD)
+                                                , num_perm=kwargs.get('dedup_num_perm', DEFAULT_NUM_PERM))
+        yield from deduplicator.filter(chunks)
+        stats = deduplicator.stats()
+        print(f"Deduplication removed {stats['removed']} of {stats['chunks']} chunks "
+                f"({stats['exact_duplicates']} exact, {stats['near_duplicates']} near-duplicates)")
+
+
+    @staticmethod
+    def _iter_corpus_chunks(occupations:[str, list]=None, split:bool=True, **kwargs):
+        "The chunks of iter_documents, before deduplication."
+        occupations = DataProcessor._resolve_occupations(occupations)
+
+        text_splitter = standards_splitter = None
+        if split:
+            text_splitter = kwargs.get('text_splitter', None)
+            if text_splitter is None:
+                text_splitter = DataProcessor._default_text_splitter(**kwargs)
+            standards_splitter = DataProcessor._default_text_splitter()
 
-        ## Retrieve State educational standards for employment skills
-        occ_metadata_['state_standards'] = DataProcessor.parse_pdf( os.path.join(PARENT_DIR, "data/State_Educational_Standards_IOWA _k-12.pdf") , info_category = 'state_standards')
-        # for d in occ_metadata_['state_standards']:
-        #     d['metatada']['info_category'] = 'state_standards'
+        max_workers = kwargs.get('max_workers', 1)
 
+        if max_workers is None or max_workers <= 1:
+            for occupation in occupations:
+                ## Retrieve Job occupation data from BLS
+                yield from _extract_and_split_profile(occupation.source_doc
+                                                        , DataProcessor._career_profile_metadata(occupation), text_splitter)
+
+            ## Retrieve State educational standards for employment skills
+            yield from DataProcessor._iter_pdf_pages(STATE_STANDARDS_PDF, info_category='state_standards', text_splitter=standards_splitter)
+
+        else:
+            ## One task per career profile and one per PDF page range. Results are yielded in submission order,
+            ## so chunk order and metadata are the same as in the sequential path.
+            tasks = [(_extract_and_split_profile, (occupation.source_doc
+                                                    , DataProcessor._career_profile_metadata(occupation), text_splitter))
+                        for occupation in occupations]
+            tasks += DataProcessor._pdf_tasks(STATE_STANDARDS_PDF, max_workers, text_splitter=standards_splitter
+                                                , info_category='state_standards')
+
+            with _process_pool(max_workers) as executor:
+                for docs in _iter_ordered(executor, tasks, window=2 * max_workers):
+                    yield from docs
 
         ## Retrieve a sample for IEP goals and transition planning        
-        # occ_metadata_['iep_goals_and_transition_templates'] = DataProcessor.parse_pdf( os.path.join(PARENT_DIR, "data/Sample_IEP_Transition_Plan_Understood.pdf") , info_category='iep_goals_and_transition_templates')
+        # yield from DataProcessor._iter_pdf_pages( os.path.join(PARENT_DIR, "data/Sample_IEP_Transition_Plan_Understood.pdf") , info_category='iep_goals_and_transition_templates')
 
         ## Retrieve Sec. 300.320 (b) from the Indiviual with Diabilities Education Act
-        idea_ = DataProcessor.extract_content(source="https://sites.ed.gov/idea/regs/b/d/300.320/b", from_url=True)
+        idea_ = DataProcessor.extract_content(source=IDEA_URL, from_url=True)
         # print(f"idea_ {idea_.__class__}", idea_)
 
         if isinstance(idea_, Document):
             idea_.metadata['info_category'] = 'idea'
-            occ_metadata_['idea'] = [idea_]
-        elif isinstance(idea_, list):
-            for k in idea_:
-                k.metadata['info_category'] = 'idea'
-                occ_metadata_['idea'] = idea_
-
-
-        # occ_metadata_['idea'].extend([idea_])
+            yield idea_
+        else:
+            warnings.warn(f"Sec. 300.320 (b) of IDEA could not be retrieved: {idea_}")
 
-        return occ_metadata_
 
+    @staticmethod
+    def collect_and_process_documents(occupations:[str, list]=None, **kwargs):
+        """
+        Collects the chunks yielded by iter_documents, grouped by info category
+        ('career_profile', 'state_standards' and 'idea'; None for a category without documents).
+        """
+        occ_metadata_ = {}
+        occ_metadata_['career_profile']  = None
+        occ_metadata_['state_standards'] = None
+        # occ_metadata_['iep_goals_and_transition_templates'] = None
+        occ_metadata_['idea'] = None
 
-        
+        for chunk in DataProcessor.iter_documents(occupations, **kwargs):
+            category = chunk.metadata.get('info_category')
+            if occ_metadata_.get(category) is None:
+                occ_metadata_[category] = []
+            occ_metadata_[category].append(chunk)
 
+        return occ_metadata_
 
 
 
+## Process pool tasks. These live at module level so they can be pickled.
+
+def _iter_ordered(executor, tasks:list, window:int):
+    """
+    Runs (function, args) tasks on an executor and yields their results in task order,
+    keeping at most `window` tasks submitted ahead of the consumer.
+    """
+    pending = deque()
+    for func, args in tasks:
+        pending.append(executor.submit(_traced, func, args))
+        if len(pending) >= window:
+            yield _adopt(pending.popleft().result())
+    while pending:
+        yield _adopt(pending.popleft().result())
+
+
+def _traced(func, args:tuple) -> tuple:
+    "Runs a task in a worker process and returns its result with the spans it recorded (see _adopt)."
+    METRICS.reset()
+    result = func(*args)
+    return result, METRICS.recent_spans()
+
+
+def _adopt(traced:tuple):
+    result, spans = traced
+    METRICS.adopt_spans(spans)
+    return result
+
+
+def _process_pool(max_workers:int) -> ProcessPoolExecutor:
+    ## Workers are spawned rather than forked: ingestion may run in a process with other threads (e.g. the
+    ## background warm-up of the app), whose locks a forked child would inherit in whatever state they were in
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn"))
+
+
+def _extract_and_split_profile(source_doc:str, metadata:dict, text_splitter=None):
+    "Extracts one local career profile and splits it into chunks (if a splitter is given)."
+    jobpro = DataProcessor.extract_content(source=source_doc, metadata=metadata, from_url=False
+                                            , headings=isinstance(text_splitter, StructureChunker))
+    if not isinstance(jobpro, Document):
+        warnings.warn(f"Career profile {source_doc} could not be extracted: {jobpro}")
+        return []
+    if text_splitter is None:
+        return [jobpro]
+    with METRICS.span("chunk", source=os.path.basename(source_doc)) as span:
+        chunks = text_splitter.split_documents([jobpro])
+        span.set(chunks=len(chunks))
+    return chunks
+
+
+def _load_pdf_pages(pdf_pathname:str, start:int, end:int, info_category:str=None, text_splitter=None):
+    """
+    Loads pages [start, end) of a PDF, with the same text and metadata as PyPDFLoader, and optionally splits them.
+    """
+    start_time = time.perf_counter()
+    ## PyPDFLoader parses lazily: taking the first page gives the document-level metadata without parsing the rest
+    doc_metadata = next(PyPDFLoader(pdf_pathname).lazy_load()).metadata
+
+    reader = PdfReader(pdf_pathname)
+    documents = []
+    for page_number in range(start, end):
+        metadata = dict(doc_metadata)
+        metadata['page'] = page_number
+        metadata['page_label'] = reader.page_labels[page_number]
+        if not info_category is None:
+            metadata['info_category'] = info_category
+        text = reader.pages[page_number].extract_text(extraction_mode="plain").strip()
+        documents.append(Document(page_content=text, metadata=metadata))
+
+    METRICS.record_span("ingest", time.perf_counter() - start_time, kind="pdf", source=os.path.basename(pdf_pathname), pages=end - start)
+    if text_splitter is not None:
+        with METRICS.span("chunk", source=os.path.basename(pdf_pathname), pages=end - start):
+            return text_splitter.split_documents(documents)
+    return documents
+
+
+
+## HTML text extraction
+
+_TEXT_BLOCK_TAGS = {"h1", "h2", "h3", "h5", "h6", "p", "br", "li"}
+_HEADING_TAGS = {"h1", "h2", "h3", "h5", "h6"}
+## OOH section headings end with the label of their help link
+_OOH_HEADING_SUFFIX = "About this section"
+_TEXT_TYPES = (NavigableString, CData)
+## Tags whose content BeautifulSoup's get_text() leaves out
+_NON_TEXT_TAGS = {"script", "style", "template"}
+
+
+class _Collector:
+    "Text gathered for one output block while the page is walked."
+    __slots__ = ("parts", "children", "tag", "anchor")
+
+    def __init__(self, tag:str=None, anchor:int=-1):
+        self.parts = []
+        self.children = []
+        self.tag = tag
+        self.anchor = anchor      # for tables and divs, the index of the text block before them
+
+
+class _TextBlockExtractor:
+    """
+    Collects the text blocks of a page from a single walk over it, in this order:
+        1. headers, paragraphs and list items (except hidden paragraphs),
+        2. tables, one "cell | cell" line per row,
+        3. <div class="order-2 flex-grow-1"> and <div class="reportsection"> content outside of <nav>.
+
+    The walker calls start()/end() for every element and data() for every text node. Each text node is appended
+    to the blocks that are open when it is reached, and <nav> context is tracked on the way down, instead of
+    searching the tree once per block type and walking the parents of every div. Div blocks only receive text
+    that is not already part of a header, paragraph, list item or table, so that content is not emitted twice.
+    """
+
+    def __init__(self):
+        self.text_blocks, self.tables, self.flex_divs, self.report_divs = [], [], [], []
+        self.open_text, self.open_tables, self.open_rows, self.open_cells = [], [], [], []
+        self.open_divs = []      # innermost div block last
+        self.pushed = []         # per open element, the stacks its start() pushed to
+        self.nav_depth = 0
+
+
+    def start(self, name:str, classes:list):
+        pushed = []
+        if name in _TEXT_BLOCK_TAGS:
+            if not ((name == "p" and "visually-hidden" in classes) or (name == "li" and not "" in classes)):
+                collector = _Collector(name)
+                self.text_blocks.append(collector)
+                self.open_text.append(collector)
+                pushed.append(self.open_text)
+        elif name == "table":
+            collector = _Collector(name, len(self.text_blocks) - 1)
+            self.tables.append(collector)
+            self.open_tables.append(collector)
+            pushed.append(self.open_tables)
+        elif name == "tr":
+            ## A row belongs to every enclosing table, like table.find_all("tr")
+            collector = _Collector()
+            for table in self.open_tables:
+                table.children.append(collector)
+            self.open_rows.append(collector)
+            pushed.append(self.open_rows)
+        elif name in ("td", "th"):
+            collector = _Collector()
+            for row in self.open_rows:
+                row.children.append(collector)
+            self.open_cells.append(collector)
+            pushed.append(self.open_cells)
+        elif name == "div" and self.nav_depth == 0:
+            class_str = " ".join(classes)
+            collector = None
+            if class_str == "order-2 flex-grow-1" or "order-2 flex-grow-1" in classes:
+                if not ("visually-hidden" in classes or "dropdown-menu" in classes):
+                    collector = _Collector(name, len(self.text_blocks) - 1)
+                    self.flex_divs.append(collector)
+            elif class_str == "reportsection" or "reportsection" in classes:
+                collector = _Collector(name, len(self.text_blocks) - 1)
+                self.report_divs.append(collector)
+            if collector is not None:
+                self.open_divs.append(collector)
+                pushed.append(self.open_divs)
+        elif name == "nav":
+            self.nav_depth += 1
+
+        self.pushed.append(pushed)
+
+
+    def end(self, name:str):
+        for open_blocks in self.pushed.pop():
+            open_blocks.pop()
+        if name == "nav":
+            self.nav_depth -= 1
+
+
+    def data(self, text:str):
+        text = text.strip()
+        if text:
+            for collector in self.open_text:
+                collector.parts.append(text)
+            for collector in self.open_cells:
+                collector.parts.append(text)
+            if self.open_divs and not self.open_text and not self.open_tables:
+                self.open_divs[-1].parts.append(text)
+
+
+    def structured_blocks(self) -> list:
+        """
+        The blocks as (text, heading, path) tuples, in output order. heading is (level, title) for headers, path
+        the headings (level, title) in effect where a table or div appears in the page, and both are None otherwise.
+        """
+        output = []
+        paths = []      # per text block, the headings in effect after it
+        path = ()
+        for block in self.text_blocks:
+            text = " ".join(block.parts)
+            heading = None
+            if text and block.tag in _HEADING_TAGS:
+                heading = (int(block.tag[1]), _heading_title(text))
+                path = tuple(entry for entry in path if entry[0] < heading[0]) + (heading,)
+            paths.append(path)
+            if text:
+                output.append((text, heading, None))
+
+        for table in self.tables:
+            rows = [" | ".join("".join(cell.parts) for cell in row.children) for row in table.children if row.children]
+            if rows:
+                output.append(("\n".join(rows), None, paths[table.anchor] if table.anchor >= 0 else ()))
+
+        for block in self.flex_divs + self.report_divs:
+            text = " ".join(block.parts)
+            if text:
+                output.append((text, None, paths[block.anchor] if block.anchor >= 0 else ()))
+
+        return output
+
+
+
+def _heading_title(text:str) -> str:
+    title = " ".join(text.split())
+    if title.endswith(_OOH_HEADING_SUFFIX):
+        title = title[:-len(_OOH_HEADING_SUFFIX)].rstrip()
+    return title
+
+
+def _heading_marks(blocks:list, separator:str) -> list:
+    """
+    (offset, level, title) of the headings of the text made of the structured blocks joined with separator
+    (see _TextBlockExtractor.structured_blocks). Tables and divs are output after the text, so the headings they
+    appeared under are repeated before them, after a (offset, 1, None) mark that closes the previous sections.
+    """
+    marks = []
+    path = ()
+    offset = 0
+    for text, heading, block_path in blocks:
+        if heading is not None:
+            marks.append((offset, heading[0], heading[1]))
+            path = tuple(entry for entry in path if entry[0] < heading[0]) + (heading,)
+        elif block_path is not None and block_path != path:
+            marks.append((offset, 1, None))
+            marks.extend((offset, level, title) for level, title in block_path)
+            path = block_path
+        offset += len(text) + len(separator)
+    return marks
+
+
+
+def _walk_soup(soup, extractor:_TextBlockExtractor):
+    "Feeds a BeautifulSoup tree to the extractor, in document order."
+    ## Enter events are (node, False), exit events (node, True)
+    stack = [(child, False) for child in reversed(soup.contents)]
+    while stack:
+        node, exiting = stack.pop()
+        if not isinstance(node, Tag):
+            if type(node) in _TEXT_TYPES:
+                extractor.data(node)
+        elif exiting:
+            extractor.end(node.name)
+        else:
+            extractor.start(node.name, node.get("class", []))
+            stack.append((node, True))
+            stack.extend((child, False) for child in reversed(node.contents))
+
+
+def _walk_lxml(root, extractor:_TextBlockExtractor):
+    "Feeds an lxml tree to the extractor, in document order. Text nodes are the .text and .tail of elements."
+    stack = [(root, False)]
+    while stack:
+        element, exiting = stack.pop()
+        tag = element.tag
+        if exiting:
+            extractor.end(tag)
+        elif not isinstance(tag, str):
+            ## Comments and processing instructions: only the text after them counts
+            if element.tail:
+                extractor.data(element.tail)
+            continue
+        else:
+            extractor.start(tag, element.get("class", "").split())
+            if element.text and tag not in _NON_TEXT_TAGS:
+                extractor.data(element.text)
+            stack.append((element, True))
+            stack.extend((child, False) for child in reversed(element))
+            continue
+        if element.tail:
+            extractor.data(element.tail)
+
+
+def _extract_structured_blocks(html) -> list:
+    "Parses a page (with lxml when it is installed) and returns its structured blocks, see _TextBlockExtractor."
+    extractor = _TextBlockExtractor()
+    if HTML_PARSER == "lxml":
+        if isinstance(html, str):
+            html = html.encode("utf-8")
+            parser = lxml_etree.HTMLParser(encoding="utf-8")
+        else:
+            parser = lxml_etree.HTMLParser()
+        root = lxml_etree.fromstring(html, parser)
+        if root is not None:
+            _walk_lxml(root, extractor)
+    else:
+        _walk_soup(BeautifulSoup(html, HTML_PARSER), extractor)
+    return extractor.structured_blocks()
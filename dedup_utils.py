@@ -0,0 +1,181 @@
+import hashlib
+import re
+import time
+import zlib
+
+import numpy as np
+from langchain_core.documents.base import Document
+
+from metrics_utils import METRICS
+
+
+
+## Chunks whose estimated Jaccard similarity of word shingles reaches this are near-duplicates
+DEFAULT_DEDUP_THRESHOLD = 0.8
+
+## Number of MinHash permutations per chunk
+DEFAULT_NUM_PERM = 128
+
+## Number of words per shingle
+_SHINGLE_SIZE = 5
+
+## Probability that a pair of chunks at the threshold shares an LSH bucket, used to choose the bands
+_CANDIDATE_RECALL = 0.99
+
+## Hashes are taken modulo the Mersenne prime 2^61 - 1 and kept to 32 bits, as in datasketch
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_MAX_HASH = np.uint64((1 << 32) - 1)
+
+## Metadata fields that identify where a chunk comes from, copied to its 'sources'
+_CITATION_FIELDS = ("source", "source_doc", "page", "page_label", "info_category")
+
+_WORD_PATTERN = re.compile(r"\w+")
+
+
+class ChunkDeduplicator:
+    """
+    Removes duplicate chunks from a stream before they are embedded: exact duplicates (same text once whitespace
+    is normalized) are found by hash, near-duplicates with MinHash signatures of word shingles and LSH buckets.
+    LSH candidates are only dropped if their estimated Jaccard similarity to a kept chunk reaches threshold.
+
+    The first occurrence of a text is kept. Every kept chunk gets a metadata['sources'] list citing its own source,
+    and the sources of the duplicates dropped in its favour are appended to that list, so a chunk repeated across
+    pages still cites all of them (see citations). Provenance works by appending to the list of a chunk that has
+    already been yielded: the vector store docstore copies the metadata dict but shares the list, so it sees the
+    complete provenance once the stream is consumed. Only these lists are kept, by text hash and by LSH position,
+    not the chunks themselves, so memory does not grow with the text of the corpus.
+
+    Args:
+        threshold (float): Estimated Jaccard similarity at or above which a chunk is a near-duplicate.
+            None only removes exact duplicates.
+        num_perm (int): Number of MinHash permutations.
+        seed (int): Seed of the permutations.
+    """
+
+    def __init__(self, threshold:float=DEFAULT_DEDUP_THRESHOLD, num_perm:int=DEFAULT_NUM_PERM, seed:int=1):
+        if threshold is not None and not 0 < threshold <= 1:
+            raise ValueError(f"threshold must be in (0, 1]: {threshold}")
+        self.threshold = threshold
+        self.num_perm = num_perm
+        rng = np.random.RandomState(seed)
+        self._a = rng.randint(1, 1 << 61, size=num_perm, dtype=np.uint64)
+        self._b = rng.randint(0, 1 << 61, size=num_perm, dtype=np.uint64)
+        self.bands, self.rows = ChunkDeduplicator.lsh_params(threshold or 1.0, num_perm)
+
+        self._hashes = {}          # text hash -> 'sources' list of the kept chunk
+        self._buckets = [{} for _ in range(self.bands)]
+        self._signatures = []      # signatures of the kept chunks with shingles, by position in _sources
+        self._sources = []         # 'sources' lists of the kept chunks with shingles
+        self.n_chunks = self.n_exact = self.n_near = 0
+
+
+    @staticmethod
+    def lsh_params(threshold:float, num_perm:int) -> tuple:
+        """
+        (bands, rows) of the LSH index: the most rows per band (the fewest candidates) for which a pair at the
+        threshold still shares a bucket with probability _CANDIDATE_RECALL.
+        """
+        for rows in range(num_perm, 0, -1):
+            bands = num_perm // rows
+            if 1 - (1 - threshold ** rows) ** bands >= _CANDIDATE_RECALL:
+                return bands, rows
+        return num_perm, 1
+
+
+    def add(self, chunk:Document) -> bool:
+        "Adds a chunk. Returns True if it is kept, False if it is a duplicate of a kept chunk (which then cites its source)."
+        self.n_chunks += 1
+        text = " ".join(chunk.page_content.split())
+        text_hash = hashlib.sha1(text.encode("utf-8")).digest()
+        sources = self._hashes.get(text_hash)
+        if sources is not None:
+            self.n_exact += 1
+            ChunkDeduplicator._cite(sources, chunk)
+            return False
+
+        signature = None
+        if self.threshold is not None:
+            signature = self.signature(text)
+        if signature is not None:
+            band_keys = [signature[band * self.rows:(band + 1) * self.rows].tobytes() for band in range(self.bands)]
+            candidates = {pos for band, key in enumerate(band_keys) for pos in self._buckets[band].get(key, ())}
+            for pos in sorted(candidates):
+                if np.mean(self._signatures[pos] == signature) >= self.threshold:
+                    self.n_near += 1
+                    ChunkDeduplicator._cite(self._sources[pos], chunk)
+                    return False
+
+        sources = [ChunkDeduplicator._citation(chunk.metadata)]
+        chunk.metadata['sources'] = sources
+        self._hashes[text_hash] = sources
+        if signature is not None:
+            pos = len(self._sources)
+            self._sources.append(sources)
+            self._signatures.append(signature)
+            for band, key in enumerate(band_keys):
+                self._buckets[band].setdefault(key, []).append(pos)
+        return True
+
+
+    def filter(self, chunks):
+        "Yields the chunks that are not duplicates of an earlier one, and records the removals in METRICS."
+        n_chunks, n_exact, n_near = self.n_chunks, self.n_exact, self.n_near
+        ## Only the time spent deduplicating is measured, not the time spent producing the chunks
+        elapsed = 0.0
+        for chunk in chunks:
+            start = time.perf_counter()
+            kept = self.add(chunk)
+            elapsed += time.perf_counter() - start
+            if kept:
+                yield chunk
+
+        n_exact, n_near = self.n_exact - n_exact, self.n_near - n_near
+        METRICS.record_span("dedup", elapsed, chunks=self.n_chunks - n_chunks, exact=n_exact, near=n_near
+                            , threshold=self.threshold)
+        METRICS.inc("dedup_chunks_removed_total", n_exact, kind="exact")
+        METRICS.inc("dedup_chunks_removed_total", n_near, kind="near")
+
+
+    def signature(self, text:str):
+        "MinHash signature (num_perm uint32 values) of the word shingles of text, or None if it has no words."
+        words = _WORD_PATTERN.findall(text.lower())
+        if not words:
+            return None
+        shingles = {" ".join(words[i:i + _SHINGLE_SIZE]) for i in range(max(1, len(words) - _SHINGLE_SIZE + 1))}
+        ## crc32 is stable across processes (unlike hash()), and the permutations below rehash it
+        hashes = np.array([zlib.crc32(shingle.encode("utf-8")) for shingle in shingles], dtype=np.uint64)
+        ## Overflowing uint64 products wrap around, which is intended
+        with np.errstate(over="ignore"):
+            permuted = np.bitwise_and((np.outer(self._a, hashes) + self._b[:, None]) % _MERSENNE_PRIME, _MAX_HASH)
+        ## The hashes are kept to 32 bits, so the signatures kept for the whole build take half the space
+        return permuted.min(axis=1).astype(np.uint32)
+
+
+    def stats(self) -> dict:
+        return {
+            'chunks': self.n_chunks
+            , 'kept': self.n_chunks - self.n_exact - self.n_near
+            , 'removed': self.n_exact + self.n_near
+            , 'exact_duplicates': self.n_exact
+            , 'near_duplicates': self.n_near
+            , 'threshold': self.threshold
+        }
+
+
+    @staticmethod
+    def citations(metadata:dict) -> list:
+        "The sources a chunk cites: metadata['sources'] if it was deduplicated, else its own source."
+        return metadata.get('sources') or [ChunkDeduplicator._citation(metadata)]
+
+
+    @staticmethod
+    def _citation(metadata:dict) -> dict:
+        return {field: metadata[field] for field in _CITATION_FIELDS if metadata.get(field) is not None}
+
+
+    @staticmethod
+    def _cite(sources:list, duplicate:Document):
+        "Appends the source of a duplicate to the 'sources' list of the kept chunk."
+        citation = ChunkDeduplicator._citation(duplicate.metadata)
+        if not citation in sources:
+            sources.append(citation)
@@ -0,0 +1,439 @@
+import asyncio
+import hashlib
+import os
+import random
+import re
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, List
+
+import numpy as np
+from diskcache import Cache
+from langchain_core.embeddings import Embeddings
+
+from metrics_utils import METRICS
+
+
+
+PARENT_DIR = Path(__file__).resolve().parent
+
+DEFAULT_CACHE_PATH = os.path.join(PARENT_DIR, "data/embedding_cache")
+DEFAULT_CACHE_SIZE_LIMIT = 2 ** 30  # 1 GB
+
+DEFAULT_OPENAI_EMBEDDING_MODEL = "text-embedding-ada-002"
+
+_TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+
+## tiktoken encoding used by count_tokens (False when tiktoken is unavailable)
+_ENCODING = None
+
+
+class EmbeddingCache:
+    """
+    On-disk, content-addressed cache of embedding vectors, keyed by hash(model, text).
+
+    Entries are evicted least-recently-used first once the cache grows beyond size_limit bytes.
+    The cache can be shared by any number of index builds (and processes).
+    """
+
+    def __init__(self, directory:str=None, size_limit:int=DEFAULT_CACHE_SIZE_LIMIT):
+        if directory is None:
+            directory = DEFAULT_CACHE_PATH
+        self.directory = directory
+        self.cache = Cache(directory, size_limit=size_limit, eviction_policy="least-recently-used")
+        self.hits = 0
+        self.misses = 0
+
+
+    @staticmethod
+    def key(model:str, text:str) -> str:
+        return hashlib.sha256(f"{model}\0{text}".encode("utf-8")).hexdigest()
+
+
+    def get_many(self, model:str, texts:List[str]) -> list:
+        "Returns the cached vector of each text, or None where it is not cached."
+        vectors = []
+        for text in texts:
+            value = self.cache.get(EmbeddingCache.key(model, text))
+            if value is None:
+                self.misses += 1
+                vectors.append(None)
+            else:
+                self.hits += 1
+                vectors.append(np.frombuffer(value, dtype=np.float32).tolist())
+        return vectors
+
+
+    def set_many(self, model:str, texts:List[str], vectors:list):
+        with self.cache.transact():
+            for text, vector in zip(texts, vectors):
+                self.cache.set(EmbeddingCache.key(model, text), np.asarray(vector, dtype=np.float32).tobytes())
+
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits
+            , 'misses': self.misses
+            , 'hit_rate': self.hits / lookups if lookups else 0.0
+            , 'entries': len(self.cache)
+            , 'size_bytes': self.cache.volume()
+        }
+
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+
+
+    def close(self):
+        self.cache.close()
+
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Wraps an Embeddings model so that document embeddings are read from an EmbeddingCache,
+    and only the cache misses are sent to the underlying model.
+    """
+
+    def __init__(self, embeddings:Embeddings, cache:EmbeddingCache, model:str=None):
+        self.embeddings = embeddings
+        self.cache = cache
+        self.model = model or getattr(embeddings, "model", embeddings.__class__.__name__)
+
+
+    def _lookup(self, texts:List[str]):
+        vectors = self.cache.get_many(self.model, texts)
+        ## Deduplicate misses, so repeated chunks are only embedded once
+        missing = list(dict.fromkeys(text for text, vector in zip(texts, vectors) if vector is None))
+        return vectors, missing
+
+
+    def _merge(self, texts:List[str], vectors:list, missing:List[str], new_vectors:list) -> list:
+        self.cache.set_many(self.model, missing, new_vectors)
+        computed = dict(zip(missing, new_vectors))
+        return [vector if vector is not None else list(computed[text]) for text, vector in zip(texts, vectors)]
+
+
+    def embed_documents(self, texts:List[str]) -> List[List[float]]:
+        vectors, missing = self._lookup(texts)
+        new_vectors = self.embeddings.embed_documents(missing) if missing else []
+        return self._merge(texts, vectors, missing, new_vectors)
+
+
+    async def aembed_documents(self, texts:List[str]) -> List[List[float]]:
+        vectors, missing = self._lookup(texts)
+        new_vectors = await self.embeddings.aembed_documents(missing) if missing else []
+        return self._merge(texts, vectors, missing, new_vectors)
+
+
+    def embed_query(self, text:str) -> List[float]:
+        return self.embeddings.embed_query(text)
+
+
+    async def aembed_query(self, text:str) -> List[float]:
+        return await self.embeddings.aembed_query(text)
+
+
+
+def run_sync(coro):
+    """
+    Runs a coroutine to completion from synchronous code. When called from inside a running event loop
+    (e.g. a Jupyter notebook), the coroutine runs on its own loop in a worker thread.
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coro).result()
+
+
+
+def count_tokens(text:str) -> int:
+    "Counts tokens with tiktoken's cl100k_base encoding, or estimates them when tiktoken is unavailable."
+    global _ENCODING
+    if _ENCODING is None:
+        try:
+            import tiktoken
+            _ENCODING = tiktoken.get_encoding("cl100k_base")
+        except Exception:
+            _ENCODING = False
+    if _ENCODING is False:
+        return len(text) // 4 + 1
+    return len(_ENCODING.encode(text, disallowed_special=()))
+
+
+def truncate_tokens(text:str, max_tokens:int) -> str:
+    "Keeps the first max_tokens tokens of text (as counted by count_tokens)."
+    if count_tokens(text) <= max_tokens:
+        return text
+    if _ENCODING is False:
+        return text[:max(0, 4 * (max_tokens - 1))]
+    return _ENCODING.decode(_ENCODING.encode(text, disallowed_special=())[:max_tokens])
+
+
+
+class TokenRateLimiter:
+    "Token bucket that refills at tokens_per_minute; acquire() waits until enough tokens are available."
+
+    def __init__(self, tokens_per_minute:int):
+        self.capacity = tokens_per_minute
+        self.tokens = float(tokens_per_minute)
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+
+    async def acquire(self, n_tokens:int):
+        ## A single request larger than the bucket can only ever wait for a full bucket
+        n_tokens = min(n_tokens, self.capacity)
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.capacity / 60.0)
+                self.updated = now
+                if self.tokens >= n_tokens:
+                    self.tokens -= n_tokens
+                    return
+                await asyncio.sleep((n_tokens - self.tokens) * 60.0 / self.capacity)
+
+
+
+class AsyncEmbeddingEngine:
+    """
+    Embeds large numbers of texts in batches, with a bounded number of concurrent requests,
+    optional tokens-per-minute throttling and exponential backoff on rate limit (429) and server (5xx) errors.
+
+    When a cache is given, cached texts are never re-embedded and every completed batch is written to the
+    cache as soon as it returns. A build that fails part way through therefore resumes from where it stopped
+    when it is run again with the same cache.
+    """
+
+    def __init__(self, embeddings:Embeddings, batch_size:int=256, max_concurrency:int=4
+                    , tokens_per_minute:int=None, max_retries:int=6, initial_backoff:float=1.0, max_backoff:float=60.0
+                    , cache:EmbeddingCache=None, model:str=None):
+        self.embeddings = embeddings
+        self.batch_size = batch_size
+        self.max_concurrency = max_concurrency
+        self.tokens_per_minute = tokens_per_minute
+        self.max_retries = max_retries
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.cache = cache
+        self.model = model or getattr(embeddings, "model", embeddings.__class__.__name__)
+        self.n_requests = 0
+        self.n_retries = 0
+
+
+    @staticmethod
+    def is_retryable(exp:Exception) -> bool:
+        "True for rate limit (429), server (5xx), timeout and connection errors."
+        status = getattr(exp, "status_code", None)
+        if status is None:
+            status = getattr(getattr(exp, "response", None), "status_code", None)
+        if status is not None:
+            return status == 429 or 500 <= status < 600
+        return isinstance(exp, (asyncio.TimeoutError, ConnectionError, TimeoutError)) \
+                or exp.__class__.__name__ in ("APIConnectionError", "APITimeoutError")
+
+
+    @staticmethod
+    def _retry_after(exp:Exception):
+        headers = getattr(getattr(exp, "response", None), "headers", None) or {}
+        try:
+            return float(headers.get("retry-after"))
+        except (TypeError, ValueError):
+            return None
+
+
+    async def _embed_batch(self, batch:List[str]) -> list:
+        for attempt in range(self.max_retries + 1):
+            try:
+                self.n_requests += 1
+                return await self.embeddings.aembed_documents(batch)
+            except Exception as exp:
+                if attempt == self.max_retries or not AsyncEmbeddingEngine.is_retryable(exp):
+                    raise
+                self.n_retries += 1
+                delay = AsyncEmbeddingEngine._retry_after(exp)
+                if delay is None:
+                    ## Full backoff with jitter, so concurrent batches do not retry in lockstep
+                    delay = min(self.max_backoff, self.initial_backoff * 2 ** attempt) * random.uniform(0.5, 1.0)
+                await asyncio.sleep(delay)
+
+
+    async def aembed(self, texts:List[str], progress:Callable=None) -> List[List[float]]:
+        """
+        Embeds texts and returns their vectors in order.
+
+        Args:
+            texts (list): Texts to embed.
+            progress (callable): Optional callback called as progress(n_done, n_total) after every batch.
+        """
+        with METRICS.span("embed", model=self.model, texts=len(texts)) as span:
+            return await self._aembed(texts, progress, span)
+
+
+    async def _aembed(self, texts:List[str], progress:Callable, span) -> List[List[float]]:
+        if self.cache is not None:
+            cached = self.cache.get_many(self.model, texts)
+        else:
+            cached = [None] * len(texts)
+
+        vectors = {text: vector for text, vector in zip(texts, cached) if vector is not None}
+        missing = list(dict.fromkeys(text for text in texts if text not in vectors))
+        batches = [missing[i:i + self.batch_size] for i in range(0, len(missing), self.batch_size)]
+
+        n_tokens = sum(count_tokens(text) for text in missing)
+        span.set(cached=len(vectors), embedded=len(missing), tokens=n_tokens)
+        METRICS.inc("embedding_texts_total", len(texts) - len(missing), source="cache")
+        METRICS.inc("embedding_texts_total", len(missing), source="model")
+        METRICS.inc("embedding_tokens_total", n_tokens, model=self.model)
+
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        limiter = TokenRateLimiter(self.tokens_per_minute) if self.tokens_per_minute else None
+        n_done = [0]
+
+        async def run(batch):
+            async with semaphore:
+                if limiter is not None:
+                    await limiter.acquire(sum(count_tokens(text) for text in batch))
+                batch_vectors = await self._embed_batch(batch)
+            if self.cache is not None:
+                self.cache.set_many(self.model, batch, batch_vectors)
+            vectors.update(zip(batch, batch_vectors))
+            n_done[0] += len(batch)
+            if progress is not None:
+                progress(n_done[0], len(missing))
+
+        ## Let every batch finish (and be cached) before surfacing a failure, so a rerun redoes as little as possible
+        results = await asyncio.gather(*(run(batch) for batch in batches), return_exceptions=True)
+        errors = [res for res in results if isinstance(res, Exception)]
+        if errors:
+            raise errors[0]
+
+        return [list(vectors[text]) for text in texts]
+
+
+    def embed(self, texts:List[str], progress:Callable=None) -> List[List[float]]:
+        "Synchronous version of aembed."
+        return run_sync(self.aembed(texts, progress=progress))
+
+
+
+class HashingEmbeddings(Embeddings):
+    """
+    Local embedding model: hashed bag of words and word bigrams with sublinear term frequencies, L2-normalized.
+
+    Tokens are mapped to n_features dimensions with a stable hash (crc32), with a hash-derived sign to reduce
+    the bias from collisions. Vectors are built with NumPy for a whole batch at once. No network access, no
+    model download and no cost, which makes index builds, retrieval benchmarks and tests run in seconds.
+    Retrieval quality is lexical rather than semantic.
+    """
+
+    def __init__(self, n_features:int=1024, ngram_range:tuple=(1, 2), sublinear_tf:bool=True):
+        self.n_features = n_features
+        self.ngram_range = tuple(ngram_range)
+        self.sublinear_tf = sublinear_tf
+        self.model = f"hashing-{n_features}-ngram{self.ngram_range[0]}{self.ngram_range[1]}"
+        self._features = {}
+
+
+    def _feature(self, term:str):
+        "Returns the (column, sign) of a term, memoized since vocabularies are small compared to corpora."
+        feature = self._features.get(term)
+        if feature is None:
+            h = zlib.crc32(term.encode("utf-8"))
+            feature = (h % self.n_features, 1.0 if h & 0x80000000 else -1.0)
+            if len(self._features) < 1_000_000:
+                self._features[term] = feature
+        return feature
+
+
+    def _terms(self, text:str) -> list:
+        tokens = _TOKEN_PATTERN.findall(text.lower())
+        terms = []
+        for n in range(self.ngram_range[0], self.ngram_range[1] + 1):
+            if n == 1:
+                terms.extend(tokens)
+            else:
+                terms.extend(" ".join(tokens[i:i + n]) for i in range(len(tokens) - n + 1))
+        return terms
+
+
+    def embed_documents(self, texts:List[str]) -> List[List[float]]:
+        return self.embed_array(texts).tolist()
+
+
+    def embed_array(self, texts:List[str]) -> np.ndarray:
+        "Embeds texts into a (len(texts), n_features) float32 array."
+        rows, cols, signs = [], [], []
+        for row, text in enumerate(texts):
+            for term in self._terms(text):
+                col, sign = self._feature(term)
+                rows.append(row)
+                cols.append(col)
+                signs.append(sign)
+
+        flat = np.bincount(np.asarray(rows, dtype=np.int64) * self.n_features + np.asarray(cols, dtype=np.int64)
+                            , weights=np.asarray(signs, dtype=np.float64)
+                            , minlength=len(texts) * self.n_features)
+        matrix = flat.reshape(len(texts), self.n_features)
+        if self.sublinear_tf:
+            matrix = np.sign(matrix) * np.log1p(np.abs(matrix))
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return (matrix / norms).astype(np.float32)
+
+
+    def embed_query(self, text:str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+
+
+## Embedding backends that can be selected by name, with whether they call a remote API
+EMBEDDING_BACKENDS = {
+    "openai": {"remote": True}
+    , "hashing": {"remote": False}
+}
+DEFAULT_EMBEDDING_BACKEND = os.environ.get("RAG_IEP_EMBEDDING_BACKEND", "openai")
+
+
+def embedding_config(backend:str=None, model:str=None, **params) -> dict:
+    """
+    Returns the configuration of an embedding backend, as recorded in the snapshot manifest.
+
+    Args:
+        backend (str): 'openai' or 'hashing'. Defaults to $RAG_IEP_EMBEDDING_BACKEND, or 'openai'.
+        model (str): OpenAI embedding model name (ignored by the hashing backend).
+        params: Backend parameters (e.g. n_features for the hashing backend).
+    """
+    if backend is None:
+        backend = DEFAULT_EMBEDDING_BACKEND
+    if backend not in EMBEDDING_BACKENDS:
+        raise ValueError(f"Unknown embedding backend '{backend}'. It must be one of: {list(EMBEDDING_BACKENDS)}")
+
+    if backend == "hashing":
+        return {'backend': backend, 'model': HashingEmbeddings(**params).model, **params}
+    return {'backend': backend, 'model': model or DEFAULT_OPENAI_EMBEDDING_MODEL, **params}
+
+
+def make_embeddings(config:dict, open_ai_key:str=None, **kwargs) -> Embeddings:
+    "Builds the Embeddings model described by an embedding_config() dict (older manifests only have a 'model')."
+    config = dict(config)
+    backend = config.pop('backend', 'openai')
+    model = config.pop('model', None)
+    if backend == "hashing":
+        return HashingEmbeddings(**config)
+    if backend == "openai":
+        from langchain_openai import OpenAIEmbeddings
+        return OpenAIEmbeddings(model=model or DEFAULT_OPENAI_EMBEDDING_MODEL, api_key=open_ai_key, **config, **kwargs)
+    raise ValueError(f"Unknown embedding backend '{backend}'. It must be one of: {list(EMBEDDING_BACKENDS)}")
+
+
+def is_remote_backend(config:dict) -> bool:
+    return EMBEDDING_BACKENDS.get(config.get('backend', 'openai'), {}).get("remote", True)
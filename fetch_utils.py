@@ -0,0 +1,171 @@
+import os
+import threading
+import time
+import warnings
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import List
+
+import requests
+from diskcache import Cache
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+
+PARENT_DIR = Path(__file__).resolve().parent
+
+DEFAULT_HTTP_CACHE_PATH = os.path.join(PARENT_DIR, "data/http_cache")
+DEFAULT_HTTP_CACHE_SIZE_LIMIT = 2 ** 29  # 512 MB
+
+## (connect, read) timeouts in seconds
+DEFAULT_TIMEOUT = (5, 30)
+DEFAULT_RETRIES = 3
+DEFAULT_POOL_SIZE = 16
+
+## Serve cached pages only, without network access, when this environment variable is set to 1
+OFFLINE_ENV_VAR = "RAG_IEP_OFFLINE"
+
+USER_AGENT = (
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
+    "AppleWebKit/537.36 (KHTML, like Gecko) "
+    "Chrome/114.0.0.0 Safari/537.36"
+)
+
+## Fetcher shared by the data processing functions (see get_fetcher)
+_FETCHER = None
+_FETCHER_LOCK = threading.Lock()
+
+
+FetchResult = namedtuple("FetchResult", [
+    "url",
+    "content",      # Body of the page (bytes), or None on error
+    "status",       # 'fetched' (downloaded), 'not_modified' (revalidated), 'cached' (served from the cache without
+                    # revalidation: fresh, offline or after a network error) or 'error'
+    "changed",      # Whether the content differs from the previously cached one
+    "fetched_at",   # Time the content was last downloaded or revalidated
+    "error"         # Error message, if any
+])
+
+
+class HTTPFetcher:
+    """
+    Fetches web pages through a pooled requests Session with timeouts and retries (with exponential backoff on
+    connection errors, 429 and 5xx responses), and keeps the pages in an on-disk cache. Cached pages are
+    revalidated with conditional requests (If-None-Match / If-Modified-Since), so unchanged pages are not
+    downloaded again. In offline mode, or when the network fails, pages are served from the cache.
+
+    Args:
+        cache_dir (str): Cache directory (data/http_cache by default).
+        timeout (tuple): (connect, read) timeouts in seconds.
+        retries (int): Maximum number of retries per request.
+        backoff_factor (float): Retries wait backoff_factor * 2 ** (retry - 1) seconds.
+        pool_size (int): Maximum number of connections kept open per host.
+        offline (bool): Only serve cached pages. Defaults to the RAG_IEP_OFFLINE environment variable.
+        max_age (float): Seconds during which a cached page is served without revalidation (0 always revalidates).
+    """
+
+    def __init__(self, cache_dir:str=None, timeout:tuple=DEFAULT_TIMEOUT, retries:int=DEFAULT_RETRIES
+                    , backoff_factor:float=0.5, pool_size:int=DEFAULT_POOL_SIZE, offline:bool=None, max_age:float=0
+                    , size_limit:int=DEFAULT_HTTP_CACHE_SIZE_LIMIT):
+        if cache_dir is None:
+            cache_dir = DEFAULT_HTTP_CACHE_PATH
+        if offline is None:
+            offline = os.environ.get(OFFLINE_ENV_VAR, "0") == "1"
+        self.timeout = timeout
+        self.offline = offline
+        self.max_age = max_age
+        self.cache = Cache(cache_dir, size_limit=size_limit, eviction_policy="least-recently-used")
+
+        retry = Retry(total=retries, backoff_factor=backoff_factor, status_forcelist=(429, 500, 502, 503, 504)
+                        , allowed_methods=["GET", "HEAD"], respect_retry_after_header=True)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update({"User-Agent": USER_AGENT})
+
+
+    def fetch(self, url:str) -> FetchResult:
+        """
+        Returns the page at url, from the cache if it has not changed.
+
+        Raises:
+            requests.exceptions.RequestException: If the page can neither be downloaded nor served from the cache.
+        """
+        entry = self.cache.get(url)
+        if entry is not None and (self.offline or time.time() - entry['fetched_at'] < self.max_age):
+            return FetchResult(url, entry['content'], "cached", False, entry['fetched_at'], None)
+        if self.offline:
+            raise requests.exceptions.ConnectionError(f"Offline mode: {url} is not cached.")
+
+        headers = {}
+        if entry is not None:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+
+        try:
+            response = self.session.get(url, headers=headers, timeout=self.timeout)
+            if not (response.status_code == 304 and entry is not None):
+                response.raise_for_status()
+        except requests.exceptions.RequestException as exp:
+            if entry is None:
+                raise
+            warnings.warn(f"{url} could not be fetched, using the cached page from "
+                            f"{time.strftime('%Y-%m-%d %H:%M', time.localtime(entry['fetched_at']))}: {exp}")
+            return FetchResult(url, entry['content'], "cached", False, entry['fetched_at'], str(exp))
+
+        now = time.time()
+        if response.status_code == 304:
+            self.cache.set(url, dict(entry, fetched_at=now))
+            return FetchResult(url, entry['content'], "not_modified", False, now, None)
+
+        self.cache.set(url, {
+            'content': response.content
+            , 'etag': response.headers.get('ETag')
+            , 'last_modified': response.headers.get('Last-Modified')
+            , 'fetched_at': now
+        })
+        changed = entry is None or entry['content'] != response.content
+        return FetchResult(url, response.content, "fetched", changed, now, None)
+
+
+    def get(self, url:str) -> bytes:
+        "Returns the content of the page at url (see fetch)."
+        return self.fetch(url).content
+
+
+    def fetch_many(self, urls:List[str], max_workers:int=8) -> dict:
+        """
+        Fetches several pages concurrently over the pooled connections.
+
+        Returns:
+            dict: {url: FetchResult}, in the order of urls. Pages that could not be fetched have status 'error'.
+        """
+        def fetch(url):
+            try:
+                return self.fetch(url)
+            except requests.exceptions.RequestException as exp:
+                return FetchResult(url, None, "error", False, None, str(exp))
+
+        urls = list(dict.fromkeys(urls))
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(urls)))) as executor:
+            return dict(zip(urls, executor.map(fetch, urls)))
+
+
+    def close(self):
+        self.session.close()
+        self.cache.close()
+
+
+
+def get_fetcher() -> HTTPFetcher:
+    "Returns the HTTPFetcher shared by the data processing functions, created with the default settings on first use."
+    global _FETCHER
+    with _FETCHER_LOCK:
+        if _FETCHER is None:
+            _FETCHER = HTTPFetcher()
+        return _FETCHER
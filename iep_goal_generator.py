@@ -4,54 +4,315 @@ from langchain_openai import ChatOpenAI
 from langchain_core.messages import SystemMessage
 
 
-from rag_utils import RAGUtils, IEP_RAG_PROMT, IEP_CHAT_PROMPT, StudentProfile
+from rag_utils import RAGUtils, IEP_RAG_PROMT, IEP_CHAT_PROMPT, StudentProfile, DEFAULT_EMBEDDING_MODEL
 from data_utils import DataProcessor
-
+from snapshot_utils import SnapshotUtils
+from embedding_utils import embedding_config
+from index_utils import IndexUtils, DEFAULT_INDEX_CONFIG
+from retrieval_utils import StoreRetriever, RetrievalUtils
+from cache_utils import ResponseCache
+from context_utils import DEFAULT_CONTEXT_BUDGET
+from metrics_utils import METRICS
+
+import threading
+import time
 import warnings
 
 
 
 
+## Startup modes of My_IEP_Goal_Generator
+STARTUP_MODES = ["eager", "lazy", "background"]
+
+
 class My_IEP_Goal_Generator:
-    def __init__(self, open_ai_key:str, model:str = "gpt-4", vstore_path:str=None):
+    def __init__(self, open_ai_key:str, model:str = "gpt-4", vstore_path:str=None, rebuild:bool=False
+                    , embedding_model:str=DEFAULT_EMBEDDING_MODEL, embedding_backend:str=None
+                    , index_config:dict=None, index_search_params:dict=None
+                    , response_cache:ResponseCache=None, chat_model=None
+                    , context_budget:int=DEFAULT_CONTEXT_BUDGET, startup:str="eager", ingest_workers:int=1
+                    , expand_query:bool=False):
+        """
+        Args:
+            open_ai_key (str): OpenAI API key.
+            model (str): Chat model name.
+            vstore_path (str): Snapshot root (defaults to data/faiss_store) or a plain FAISS directory.
+                The newest snapshot matching the current documents, chunking and embedding model is loaded;
+                if only the source documents changed, the newest snapshot is updated source by source (see RAGUtils.update_vectorstore);
+                the index is only rebuilt (and saved as a new snapshot) when none matches or rebuild is True.
+                If the update or the rebuild fails (e.g. offline), the newest snapshot is used as it is.
+            rebuild (bool): Ignore existing snapshots and rebuild the index.
+            embedding_model (str): OpenAI embedding model name.
+            embedding_backend (str): 'openai', or 'hashing' for the local NumPy backend (no network, no cost).
+                Defaults to the RAG_IEP_EMBEDDING_BACKEND environment variable, or 'openai'.
+            index_config (dict): FAISS index type and build parameters (see index_utils.index_config). Defaults to exact flat search.
+            index_search_params (dict): Search parameters (nprobe, ef_search) overriding the ones saved with the snapshot.
+            response_cache (ResponseCache): Cache of the generated goals, keyed by prompt, model and index version.
+                None disables caching.
+            chat_model: Chat model to use instead of ChatOpenAI(model=model), e.g. a FakeListChatModel for tests and dry runs.
+            context_budget (int): Maximum number of tokens of the retrieved documents in the prompt (see ContextUtils.pack).
+                None inserts the documents unpacked.
+            startup (str): When the vector store is loaded or built: 'eager' (in the constructor), 'lazy' (when it
+                is first needed) or 'background' (on a background thread started by the constructor). Methods that
+                need the vector store wait until it is ready; status() reports the progress.
+            ingest_workers (int): Number of worker processes parsing the source documents when the index is built
+                (see DataProcessor.iter_documents). 1 parses them in the calling process.
+            expand_query (bool): Add the titles of the career profiles matching the career suggestions (see
+                OccupationCatalog.resolve) to the retrieval query, which helps keyword retrieval find them.
+                Changes the retrieved documents and the cache keys, so it is off by default.
+        """
+        if not startup in STARTUP_MODES:
+            raise ValueError(f"Unknown startup mode '{startup}'. Available modes: {', '.join(STARTUP_MODES)}.")
+
         # Initialize the language model
         self.open_ai_key = open_ai_key
-        self.chat_model = ChatOpenAI(model=model)
-        if vstore_path is None:
-            ## retrieve and process all documents
-            docs = DataProcessor.collect_and_process_documents()
-            docs = [di[-1] for di in docs.items()]
-            docs = [item for sublist in docs for item in sublist]
+        self.chat_model = chat_model if not chat_model is None else ChatOpenAI(model=model)
+        self.response_cache = response_cache
+        self.context_budget = context_budget
+        self.expand_query = expand_query
+        self.last_timings = {}
+        self.last_sources = []
+        if not response_cache is None:
+            METRICS.register_cache("response", response_cache)
+
+        self._settings = {
+            'vstore_path': vstore_path
+            , 'rebuild': rebuild
+            , 'embedding': embedding_config(embedding_backend, embedding_model)
+            , 'index_config': index_config or DEFAULT_INDEX_CONFIG
+            , 'index_search_params': index_search_params
+            , 'ingest_workers': ingest_workers
+        }
+        self.manifest = None
+        self._vectorstore = None
+        self._retriever = None
+        self._qa_chain = None
+        self._rag_k = None
+
+        self._init_lock = threading.Lock()
+        self._ready = threading.Event()
+        self._thread = None
+        self._status = {'state': 'pending', 'stage': "Not started", 'progress': 0.0, 'error': None
+                        , 'started_at': None, 'ready_at': None, 'source': None}
+
+        if startup == "eager":
+            self.warm_up(block=True)
+        elif startup == "background":
+            self.warm_up()
+
+
+    def warm_up(self, block:bool=False):
+        """
+        Starts loading or building the vector store on a background thread, if it has not started yet.
+        With block, waits until it is ready (see wait_until_ready).
+        """
+        with self._init_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._traced_initialize, name="iep-goal-generator-warm-up", daemon=True)
+                self._thread.start()
+        if block:
+            self.wait_until_ready()
+
+
+    def wait_until_ready(self, timeout:float=None):
+        "Starts the warm-up if needed and waits for it. Raises RuntimeError if it failed, TimeoutError after timeout seconds."
+        if not self._ready.is_set():
+            self.warm_up()
+            if not self._ready.wait(timeout):
+                raise TimeoutError(f"The IEP goal generator is not ready after {timeout}s ({self._status['stage']}).")
+        if self._status['state'] == "failed":
+            raise RuntimeError(f"The IEP goal generator could not start: {self._status['error']}")
+
+
+    def is_ready(self) -> bool:
+        return self._ready.is_set() and self._status['state'] == "ready"
+
+
+    def status(self) -> dict:
+        """
+        Readiness of the generator: 'state' ('pending', 'starting', 'ready' or 'failed'), current 'stage',
+        'progress' (0 to 1), 'error', 'elapsed_s' and, once ready, where the vector store came from ('source':
+        'snapshot', 'updated snapshot', 'stale snapshot' or 'build'), its 'snapshot_id' and number of 'chunks'.
+        """
+        status = dict(self._status)
+        if status['started_at'] is not None:
+            status['elapsed_s'] = round((status['ready_at'] or time.time()) - status['started_at'], 3)
+        if self._vectorstore is not None:
+            status['snapshot_id'] = (SnapshotUtils.get_manifest(self._vectorstore) or {}).get('snapshot_id')
+            status['chunks'] = len(self._vectorstore.index_to_docstore_id)
+        return status
+
+
+    def _set_stage(self, stage:str, progress:float, **kwargs):
+        self._status.update(stage=stage, progress=progress, **kwargs)
+        print(f"[{progress:.0%}] {stage}")
+
+
+    def _traced_initialize(self):
+        with METRICS.span("startup") as span:
+            self._initialize()
+            span.set(state=self._status['state'], source=self._status['source'])
+            span.error = self._status['error']
+
+
+    def _initialize(self):
+        "Loads, updates or builds the vector store (and the QA chain, if requested), recording the progress in status()."
+        settings = self._settings
+        vstore_path = settings['vstore_path']
+        self._status.update(state="starting", started_at=time.time())
+        try:
+            self._set_stage("Checking the source documents", 0.05)
+            ## Describes the index the current documents and settings would produce, without parsing anything
+            self.manifest = SnapshotUtils.build_manifest(sources=DataProcessor.list_sources()
+                                                        , embedding=settings['embedding']
+                                                        , chunking=DataProcessor.chunking_params()
+                                                        , index=settings['index_config'])
+
+            vectorstore = None
+            source = None
+            if not settings['rebuild']:
+                self._set_stage("Loading the vector store snapshot", 0.2)
+                vectorstore = RAGUtils.load_vectorstore(vstore_path, open_ai_key=self.open_ai_key
+                                                        , expected_manifest=self.manifest)
+                source = "snapshot"
+                if vectorstore is None:
+                    ## A snapshot of an older version of the sources is updated source by source instead of rebuilt
+                    vectorstore = RAGUtils.load_vectorstore(vstore_path, open_ai_key=self.open_ai_key
+                                                            , expected_manifest=self.manifest, ignore_corpus=True)
+                    if not vectorstore is None:
+                        self._set_stage("Updating the vector store snapshot", 0.4)
+                        try:
+                            RAGUtils.update_vectorstore(vectorstore, self.manifest, open_ai_key=self.open_ai_key
+                                                        , store_path=vstore_path)
+                            source = "updated snapshot"
+                        except Exception as exp:
+                            ## e.g. offline: the snapshot is reloaded, since the update may have been partially applied
+                            warnings.warn(f"The vector store could not be updated, using the last snapshot: {exp}")
+                            vectorstore = RAGUtils.load_vectorstore(vstore_path, open_ai_key=self.open_ai_key
+                                                                    , expected_manifest=self.manifest, ignore_corpus=True)
+                            source = "stale snapshot"
+
+            if vectorstore is None:
+                self._set_stage("Building the vector store", 0.5)
+                try:
+                    ## retrieve and process all documents, streaming the chunks into the vector store as they are parsed
+                    docs = DataProcessor.iter_documents(max_workers=settings['ingest_workers'])
+
+                    ## create and save a vector store
+                    vectorstore = RAGUtils.create_and_save_embeddings(documents=docs, open_ai_key=self.open_ai_key
+                                                                        , store_path=vstore_path, manifest=self.manifest
+                                                                        , index_search_params=settings['index_search_params'])
+                    source = "build"
+                except Exception as exp:
+                    ## Any snapshot, even of other documents or settings, is better than no vector store
+                    vectorstore = RAGUtils.load_vectorstore(vstore_path, open_ai_key=self.open_ai_key)
+                    if vectorstore is None:
+                        raise
+                    warnings.warn(f"The vector store could not be built, using the last snapshot: {exp}")
+                    source = "stale snapshot"
+
+            if source != "build" and not settings['index_search_params'] is None:
+                IndexUtils.set_search_params(vectorstore.index, **settings['index_search_params'])
+            self._vectorstore = vectorstore
+
+            ## Under the lock, so a QA chain requested meanwhile (see create_rag_pipeline) is built either here or there
+            with self._init_lock:
+                if not self._rag_k is None:
+                    self._set_stage("Building the QA chain", 0.9)
+                    self._build_rag_pipeline(self._rag_k)
+                self._set_stage("Ready", 1.0, state="ready", source=source, ready_at=time.time())
+                self._ready.set()
+        except Exception as exp:
+            self._status.update(state="failed", stage="Failed", error=f"{type(exp).__name__}: {exp}", ready_at=time.time())
+            warnings.warn(f"The IEP goal generator could not start: {exp}")
+            self._ready.set()
+
+
+    @property
+    def vectorstore(self):
+        "The FAISS vector store, once it is ready (see wait_until_ready)."
+        self.wait_until_ready()
+        return self._vectorstore
+
+
+    @vectorstore.setter
+    def vectorstore(self, vectorstore):
+        self._vectorstore = vectorstore
+
+
+    @property
+    def retriever(self):
+        self.wait_until_ready()
+        return self._retriever
+
+
+    @property
+    def qa_chain(self):
+        self.wait_until_ready()
+        return self._qa_chain
+
+
+    def _goal_query(self, career_suggestions:str) -> str:
+        ### Formulate a qurey to retrieve documents relevant to career suggetions, and IEP planning
+        titles = ""
+        if self.expand_query:
+            occupations = DataProcessor.get_catalog().resolve(career_suggestions)
+            if len(occupations) > 0:
+                titles = f" ({'; '.join(occ.title for occ in occupations)})"
+        query = f"IEP goals, IEP transition plan, disabilities act, academic standards, career profiles for {career_suggestions}{titles}."
+        print(f"query = {query}")
+        return query
+
+
+    def retrieve_documents(self, career_suggestions:str, k:int=5, min_sim_score=None, hybrid:bool=False, fetch_k:int=None
+                            , category_quotas:dict=None) -> list:
+        "Retrieves the documents used to generate goals for the given career suggestions."
+        return RAGUtils.retrieve_relevant_documents(vectorstore=self.vectorstore
+                                                    , query=self._goal_query(career_suggestions)
+                                                    , k=k
+                                                    , min_sim_score = min_sim_score
+                                                    , hybrid=hybrid
+                                                    , fetch_k=fetch_k
+                                                    , category_quotas=category_quotas
+                                                )
+
+
+    async def aretrieve_documents(self, career_suggestions:str, k:int=5, min_sim_score=None, hybrid:bool=False, fetch_k:int=None
+                                    , category_quotas:dict=None) -> list:
+        "Async version of retrieve_documents."
+        return await RAGUtils.aretrieve_relevant_documents(vectorstore=self.vectorstore
+                                                            , query=self._goal_query(career_suggestions)
+                                                            , k=k
+                                                            , min_sim_score = min_sim_score
+                                                            , hybrid=hybrid
+                                                            , fetch_k=fetch_k
+                                                            , category_quotas=category_quotas
+                                                        )
+
+
+    def _prepare_goal_inputs(self, student_profile: StudentProfile, relevant_docs:list=None, **retrieval_kwargs):
+        """
+        Retrieves the documents for a student profile, unless relevant_docs are given.
+
+        Returns:
+            tuple: (prompt inputs of IEP_RAG_PROMT, or a SystemMessage explaining why goals cannot be generated, retrieved documents)
+        """
+        assert student_profile.career_interest_or_category is not None, "Please provide a non-null occupation" 
+        if relevant_docs is None:
+            relevant_docs = self.retrieve_documents(student_profile.career_suggestions, **retrieval_kwargs)
+        return self._goal_inputs(student_profile, relevant_docs)
 
-            # print(set(doc.metadata['info_category'] for doc in docs))
 
-            ## create and save a vector store
-            self.vectorstore = RAGUtils.create_and_save_embeddings(documents=docs, open_ai_key=self.open_ai_key)
-        else:
-            self.vectorstore = RAGUtils.load_vectorstore(vstore_path)
-        
-    
-    def generate_iep_goals(self, student_profile: StudentProfile, k:int=5, min_sim_score=None):
-        assert student_profile.career_interest_or_category is not None, "Please provide a non-null occupation" 
+    def _goal_inputs(self, student_profile: StudentProfile, relevant_docs:list):
+        "Checks the retrieved documents and builds the prompt inputs (see _prepare_goal_inputs)."
 
         ## We must make sure to have documents relevant to these categories.
         must_info_categories = ['career_profile', 'state_standards']
 
-        ### Formulate a qurey to retrieve documents relevant to career suggetions, and IEP planning
-        query = f"IEP goals, IEP transition plan, disabilities act, academic standards, career profiles for {student_profile.career_suggestions}."
-        print(f"query = {query}")
-        relevant_docs = RAGUtils.retrieve_relevant_documents(vectorstore=self.vectorstore
-                                                                , query=query
-                                                                , k=k
-                                                                , min_sim_score = min_sim_score                                                               
-                                                            )
-
-
-
 
         if relevant_docs is None or len(relevant_docs) == 0:
             ## The AI Agent returns a response that indicates no relevant document were found for the specified career interest or suggestion.
-            return SystemMessage(content=f"No relevant document were found for the specified career interest(s) or suggestion(s): {student_profile.career_suggestions}.")
+            return SystemMessage(content=f"No relevant document were found for the specified career interest(s) or suggestion(s): {student_profile.career_suggestions}."), []
         
         else:
             
@@ -87,30 +348,155 @@ class My_IEP_Goal_Generator:
                     "retrieved_docs": relevant_docs
                 }
 
+                return prompt_inputs, relevant_docs
+
+
+    def generate_iep_goals(self, student_profile: StudentProfile, k:int=5, min_sim_score=None, hybrid:bool=False, fetch_k:int=None
+                            , category_quotas:dict=None, relevant_docs:list=None):
+        """
+        Generates the IEP goals of a student profile.
+
+        relevant_docs (list): Documents already retrieved for the profile's career suggestions (see retrieve_documents),
+            e.g. shared by the students of a batch with the same suggestions. The retrieval arguments are then ignored.
+
+        Returns:
+            tuple: (AIMessage with the goals, or a SystemMessage if the documents needed are missing, retrieved documents)
+        """
+        with METRICS.span("generate_iep_goals", retrieved=relevant_docs is None) as span:
+            prompt_inputs, relevant_docs = self._prepare_goal_inputs(student_profile, relevant_docs=relevant_docs, k=k
+                                                                        , min_sim_score=min_sim_score, hybrid=hybrid
+                                                                        , fetch_k=fetch_k, category_quotas=category_quotas)
+            span.set(n_docs=len(relevant_docs))
+            if isinstance(prompt_inputs, SystemMessage):
+                span.set(outcome="missing_documents")
+                return prompt_inputs, relevant_docs
+
+            response = RAGUtils.generate_iep_goals(chat_model=self.chat_model, student_info=prompt_inputs
+                                                    , response_cache=self.response_cache
+                                                    , index_version=RetrievalUtils.index_version(self.vectorstore)
+                                                    , context_budget=self.context_budget)
+            span.set(outcome="cached" if 'cache' in response.response_metadata else "generated")
+
+        return response, relevant_docs
+
+
+    async def agenerate_iep_goals(self, student_profile: StudentProfile, k:int=5, min_sim_score=None, hybrid:bool=False, fetch_k:int=None
+                                    , category_quotas:dict=None, relevant_docs:list=None):
+        """
+        Async version of generate_iep_goals, with the same return value. The query is embedded asynchronously,
+        the index is searched in a worker thread and the chat model is called with ainvoke, so one event loop
+        can serve many concurrent requests.
+        """
+        assert student_profile.career_interest_or_category is not None, "Please provide a non-null occupation" 
+        with METRICS.span("generate_iep_goals", retrieved=relevant_docs is None, asynchronous=True) as span:
+            if relevant_docs is None:
+                relevant_docs = await self.aretrieve_documents(student_profile.career_suggestions, k=k, min_sim_score=min_sim_score
+                                                                , hybrid=hybrid, fetch_k=fetch_k, category_quotas=category_quotas)
+            prompt_inputs, relevant_docs = self._goal_inputs(student_profile, relevant_docs)
+            span.set(n_docs=len(relevant_docs))
+            if isinstance(prompt_inputs, SystemMessage):
+                span.set(outcome="missing_documents")
+                return prompt_inputs, relevant_docs
+
+            response = await RAGUtils.agenerate_iep_goals(chat_model=self.chat_model, student_info=prompt_inputs
+                                                            , response_cache=self.response_cache
+                                                            , index_version=RetrievalUtils.index_version(self.vectorstore)
+                                                    , context_budget=self.context_budget)
+            span.set(outcome="cached" if 'cache' in response.response_metadata else "generated")
+
+        return response, relevant_docs
+
+
+    def stream_iep_goals(self, student_profile: StudentProfile, k:int=5, min_sim_score=None, hybrid:bool=False, fetch_k:int=None
+                            , category_quotas:dict=None, timings:dict=None):
+        """
+        Streaming version of generate_iep_goals. The documents are retrieved right away; the goals are generated
+        as the returned iterator is consumed, and yielded token by token.
+
+        timings (dict): Receives the time to first token ('ttft_s') and total generation time ('total_s'), in
+            seconds, once the iterator is exhausted. Also kept in self.last_timings.
+
+        Returns:
+            tuple: (iterator over the text of the goals, retrieved documents)
+        """
+        self.last_timings = timings = {} if timings is None else timings
+        ## The span covers the retrieval and the generation, until the iterator is exhausted
+        span = METRICS.start_span("generate_iep_goals", retrieved=True, stream=True)
+        start = time.perf_counter()
+        with METRICS.use_span(span):
+            prompt_inputs, relevant_docs = self._prepare_goal_inputs(student_profile, k=k, min_sim_score=min_sim_score, hybrid=hybrid
+                                                                        , fetch_k=fetch_k, category_quotas=category_quotas)
+        timings['retrieval_s'] = time.perf_counter() - start
+        span.set(n_docs=len(relevant_docs))
+
+        if isinstance(prompt_inputs, SystemMessage):
+            timings.update(ttft_s=0.0, total_s=0.0, cached=None)
+            span.set(outcome="missing_documents")
+            METRICS.finish_span(span)
+            return iter([prompt_inputs.content]), relevant_docs
+
+        tokens = RAGUtils.stream_iep_goals(chat_model=self.chat_model, student_info=prompt_inputs
+                                            , response_cache=self.response_cache
+                                            , index_version=RetrievalUtils.index_version(self.vectorstore)
+                                            , timings=timings, context_budget=self.context_budget)
+        return METRICS.traced_iter(tokens, span), relevant_docs
 
-                response = RAGUtils.generate_iep_goals(chat_model=self.chat_model, student_info=prompt_inputs)
+    def create_rag_pipeline(self, k:int=3):
+        "Creates the QA chain of generate_response, now if the vector store is ready, or at the end of the warm-up."
+        with self._init_lock:
+            self._rag_k = k
+            build_now = self.is_ready()
+        if build_now:
+            self._build_rag_pipeline(k)
 
-                return response, relevant_docs
 
-    def create_rag_pipeline(self, k:int=3):
-        self.retriever = self.vectorstore.as_retriever(
-            search_type="similarity",  # Use semantic similarity for search
+    def _build_rag_pipeline(self, k:int):
+        self._retriever = StoreRetriever(
+            vectorstore=self._vectorstore,  # Semantic similarity search, skipping deleted chunks
             search_kwargs={"k": k}  # Return top k most relevant chunks
         )
 
-        self.qa_chain = RetrievalQA.from_chain_type(
+        self._qa_chain = RetrievalQA.from_chain_type(
                                 llm=self.chat_model,
                                 chain_type="stuff",  # "stuff" method: simply stuffs all retrieved documents into prompt
-                                retriever=self.retriever,
+                                retriever=self._retriever,
                                 chain_type_kwargs={"prompt": IEP_CHAT_PROMPT}
                             )
 
     def generate_response(self, message:str):
         message =  message + "Provide an answer in bullet point format, when applicable."
-        response = self.qa_chain.invoke({"query": message})
+        with METRICS.span("chat"):
+            response = self.qa_chain.invoke({"query": message})
+        return response
+
+
+    async def agenerate_response(self, message:str):
+        "Async version of generate_response."
+        message =  message + "Provide an answer in bullet point format, when applicable."
+        with METRICS.span("chat", asynchronous=True):
+            response = await self.qa_chain.ainvoke({"query": message})
         return response
 
 
+    def stream_response(self, message:str, timings:dict=None):
+        """
+        Streaming version of generate_response: yields the answer token by token. The source chunks are kept
+        in self.last_sources, and the time to first token and total time (from the retrieval) in timings and self.last_timings.
+        """
+        self.last_timings = timings = {} if timings is None else timings
+        return METRICS.traced_iter(self._stream_response(message, timings), METRICS.start_span("chat", stream=True))
+
+
+    def _stream_response(self, message:str, timings:dict):
+        start = time.perf_counter()
+        message =  message + "Provide an answer in bullet point format, when applicable."
+
+        ## Same prompt as the "stuff" chain of self.qa_chain
+        self.last_sources = self.retriever.invoke(message)
+        prompt = IEP_CHAT_PROMPT.format(context="\n\n".join(doc.page_content for doc in self.last_sources), question=message)
+        yield from RAGUtils.stream_text(self.chat_model, prompt, timings=timings, start=start)
+
+
     def launch_interactive_convo(self, print_source:bool=False, source_len:int=100):
         print("\n--- RAG Interactive Demo ---")
         print("Type 'exit' to end the demo")
@@ -122,17 +508,16 @@ class My_IEP_Goal_Generator:
 
             print(f"\n\nQuestion: { user_query}")  
 
-            ## Adding some instructions tor format the reponse
-            user_query = user_query + "Provide an answer in bullet point format, when applicable."
-
-            response = self.qa_chain.invoke({"query": user_query})
-
-            print(f"\nAnswer:\n--------\n{response['result']}")
+            ## Print the answer as it is generated
+            print("\nAnswer:\n--------")
+            for token in self.stream_response(user_query):
+                print(token, end="", flush=True)
+            print(f"\n\n(first token after {self.last_timings['ttft_s'] or 0:.2f}s, total {self.last_timings['total_s']:.2f}s)")
             
             if print_source:
                 # Optional: Display source chunks
                 print("\nSource chunks (for reference):")
-                docs = retriever.get_relevant_documents(user_query)
+                docs = self.last_sources
                 for i, doc in enumerate(docs):
                     print(f"Chunk {i+1}: {doc.page_content[:source_len]}...")
 
@@ -141,66 +526,164 @@ class My_IEP_Goal_Generator:
 
 import re
 
+import numpy as np
+
+
+## Criteria of GoalAssessment, in order
+ASSESSMENT_CRITERIA = ["Specific", "Measurable", "Achievable", "Relevant", "Time-bound"
+                        , "Aligned with Career Interest", "Aligned with Standards"]
+
+## Searches for sequences such as 90%, 90 percent, liker scale, etc., i.e.
+## r'([1-9]*[0-9][%|\spercent]|\bpercent\b|\d+\s*out\s*of\s*\d+|likert scale|as\smeasured\sby)'.
+## The alternatives are searched separately (see _achievable), with the same matches but without trying
+## every alternative at every position
+_ACHIEVABLE_DIGIT_PATTERN = re.compile(r'[0-9][%|\spercent]')
+_ACHIEVABLE_PERCENT_PATTERN = re.compile(r'\bpercent\b')
+_ACHIEVABLE_OUT_OF_PATTERN = re.compile(r'\d\s*out\s*of\s*\d')
+_ACHIEVABLE_MEASURED_PATTERN = re.compile(r'as\smeasured\sby')
+
+## Measurable words and profile terms are searched with substring tests: CPython's re tries every branch of an
+## alternation of literals at each candidate position, which is 3-4x slower than `in` on a whole goal. The time-bound
+## alternation is kept, since "by" makes it match early in the short-term objectives
+_MEASURABLE_WORDS = ("demonstrate", "perform", "complete", "respond")
+_TIME_BOUND_PATTERN = re.compile("|".join(map(re.escape, ["weeks", "months", "by", "after high school", "semester", "trimester", "by the end of"])))
+_STANDARDS_PATTERN = re.compile("|".join(map(re.escape, ["customer service", "21st century skills", "occupational outlook", "transition planning"])))
+
+
 class GoalAssessment:
     @staticmethod
     def evaluate_iep_goal(goal_as_text, student_profile, retrieved_docs):
-        evaluation = {
-            "Specific": False,
-            "Measurable": False,
-            "Achievable": False,
-            "Relevant": False,
-            "Time-bound": False,
-            "Aligned with Career Interest": False,
-            "Aligned with Standards": False
-        }
-        
-        ## Searches for sequences such as 90%, 90 percent, liker scale, etc.
-        re_pattern = r'([1-9]*[0-9][%|\spercent]|\bpercent\b|\d+\s*out\s*of\s*\d+|likert scale|as\smeasured\sby)'
+        if not GoalAssessment._assessable(goal_as_text):
+            return None
 
-        if not (goal_as_text is None or len(goal_as_text) ==0 
-                    or 'No relevant document could be found for' in goal_as_text):
-            goal_as_text = goal_as_text.lower()
+        evaluation = GoalAssessment._evaluate(goal_as_text.lower(), GoalAssessment._profile_matchers(student_profile)
+                                                , GoalAssessment._aligned_with_standards(retrieved_docs))
 
-            short_term_goals = goal_as_text.lower().split('short-term objectives:')[-1].split('alignment to standards:')[0]
-            # print(f"short_term_goals ({len(short_term_goals)}) :", short_term_goals)
-            annual_iep_goal = goal_as_text.lower().split('annual iep goal:')[-1].split('short-term objectives:')[0]
+        # Score summary
+        total_score = sum(evaluation.values())
+        print(f"Total Score: {total_score}/7")
 
-            # 1. SMART Criteria
-            evaluation["Specific"]   = student_profile.name.lower() in goal_as_text
-            evaluation["Measurable"] = any(word in goal_as_text for word in ["demonstrate", "perform", "complete", "respond"])
+        return evaluation
 
 
-            evaluation["Achievable"] = bool(re.search(re_pattern, annual_iep_goal + short_term_goals))
-            
-            # print(f"\n\n{[word for word in student_profile.career_interest_or_category.lower().split(',')]}\n\n")
-            evaluation["Relevant"]   = any(word in goal_as_text for word in student_profile.career_interest_or_category.lower().split(','))
+    @staticmethod
+    def evaluate_iep_goals(goals:list, student_profiles:list, retrieved_docs:list, index:list=None):
+        """
+        Scores many goals at once, with the same criteria and results as evaluate_iep_goal. The profile terms are
+        lower-cased once per profile and the standards alignment is computed once per distinct list of retrieved
+        documents. Each criterion is then checked over all the goals in turn, with no per-goal dict.
+
+        Args:
+            goals (list): Goal texts.
+            student_profiles (list): The StudentProfile of each goal, or a single StudentProfile for all of them.
+            retrieved_docs (list): The retrieved documents of each goal, or a single list of documents for all of them.
+            index (list): Index of the result (e.g. the record ids), defaults to a range.
+
+        Returns:
+            pandas.DataFrame: One row per goal and one nullable boolean column per criterion (see ASSESSMENT_CRITERIA),
+                plus the 'score' column. The rows of goals that cannot be assessed (evaluate_iep_goal returns None) are NA.
+        """
+        import pandas as pd
+
+        n = len(goals)
+        if isinstance(student_profiles, StudentProfile):
+            student_profiles = [student_profiles] * n
+        if not retrieved_docs or not isinstance(retrieved_docs[0], (list, tuple)):
+            retrieved_docs = [retrieved_docs] * n
+        assert len(student_profiles) == n and len(retrieved_docs) == n, "goals, student_profiles and retrieved_docs must have the same length"
+
+        ## Profiles and documents lists are usually shared by many goals (e.g. in batch_iep.run_batch): indexed by identity
+        matchers = {key: GoalAssessment._profile_matchers(student_profile)
+                        for key, student_profile in {id(student_profile): student_profile for student_profile in student_profiles}.items()}
+        standards = {key: GoalAssessment._aligned_with_standards(docs)
+                        for key, docs in {id(docs): docs for docs in retrieved_docs}.items()}
+
+        rows = [row for row, goal_as_text in enumerate(goals) if GoalAssessment._assessable(goal_as_text)]
+        texts = [goals[row].lower() for row in rows]
+        sections = [GoalAssessment._sections(text) for text in texts]
+        name, interests, career = zip(*[matchers[id(student_profiles[row])] for row in rows]) if rows else ((), (), ())
+
+        ## One criterion at a time over all the goals, in the order of ASSESSMENT_CRITERIA (see _evaluate)
+        columns = [
+            [term in text for term, text in zip(name, texts)]
+            , [any(word in text for word in _MEASURABLE_WORDS) for text in texts]
+            , [GoalAssessment._achievable(annual + short) for short, annual in sections]
+            , [any(word in text for word in words) for words, text in zip(interests, texts)]
+            , [_TIME_BOUND_PATTERN.search(short) is not None for short, _ in sections]
+            , [any(term in text for term in terms) for terms, text in zip(career, texts)]
+            , [standards[id(retrieved_docs[row])] for row in rows]
+        ]
+        values = np.zeros((n, len(ASSESSMENT_CRITERIA)), dtype=bool)
+        mask = np.ones(n, dtype=bool)
+        if rows:
+            values[rows] = np.array(columns, dtype=bool).T
+            mask[rows] = False
+
+        df = pd.DataFrame({criterion: pd.arrays.BooleanArray(values[:, i].copy(), mask.copy())
+                            for i, criterion in enumerate(ASSESSMENT_CRITERIA)}, index=index)
+        df['score'] = pd.array(np.where(mask, 0, values.sum(axis=1)), dtype="Int64")
+        df.loc[mask, 'score'] = pd.NA
+        return df
 
-            evaluation["Time-bound"] = any(word in short_term_goals for word in ["weeks", "months", "by", "after high school", "semester", "trimester", "by the end of"])
 
-            # 2. Student interest alignment
-            evaluation["Aligned with Career Interest"] = any(
-                term.lower() in goal_as_text for term in [
-                    student_profile.career_suggestions, 
-                    student_profile.preferred_employers,
-                    student_profile.onnet_results
-                ]
-            )
+    @staticmethod
+    def _assessable(goal_as_text) -> bool:
+        return not (goal_as_text is None or len(goal_as_text) == 0
+                        or 'No relevant document could be found for' in goal_as_text)
 
-            # 3. Standards alignment based on retrieved docs
-            standards_doc = [doc for doc in  retrieved_docs if doc.metadata['info_category']=='state_standards']
-            standards = " ".join(doc.page_content for doc in standards_doc).lower()
 
+    @staticmethod
+    def _profile_matchers(student_profile:StudentProfile) -> tuple:
+        """
+        (name, career interests, career terms) of a profile, lower-cased as they are searched in the goals.
+        Duplicate terms are only searched once.
+        """
+        return (student_profile.name.lower()
+                , tuple(dict.fromkeys(student_profile.career_interest_or_category.lower().split(',')))
+                , tuple(dict.fromkeys(term.lower() for term in [student_profile.career_suggestions
+                                                                , student_profile.preferred_employers
+                                                                , student_profile.onnet_results])))
 
-            evaluation["Aligned with Standards"] = any(
-                keyword in standards
-                for keyword in ["customer service", "21st century skills", "occupational outlook", "transition planning"]
-            )
 
-            # Score summary
-            total_score = sum(evaluation.values())
-            print(f"Total Score: {total_score}/7")
+    @staticmethod
+    def _sections(goal_as_text:str) -> tuple:
+        "(short-term objectives, annual IEP goal) of a lower-cased goal: the text after the last title of each, up to the next title."
+        return (goal_as_text.rpartition('short-term objectives:')[2].partition('alignment to standards:')[0]
+                , goal_as_text.rpartition('annual iep goal:')[2].partition('short-term objectives:')[0])
 
 
-            return evaluation
-        else:
-            return None
\ No newline at end of file
+    @staticmethod
+    def _evaluate(goal_as_text:str, matchers:tuple, aligned_with_standards:bool) -> dict:
+        "Criteria of a lower-cased goal (see _profile_matchers and _aligned_with_standards), as evaluate_iep_goals checks them."
+        name, interests, career = matchers
+        short_term_goals, annual_iep_goal = GoalAssessment._sections(goal_as_text)
+
+        return {
+            # 1. SMART Criteria
+            "Specific": name in goal_as_text,
+            "Measurable": any(word in goal_as_text for word in _MEASURABLE_WORDS),
+            "Achievable": GoalAssessment._achievable(annual_iep_goal + short_term_goals),
+            "Relevant": any(word in goal_as_text for word in interests),
+            "Time-bound": _TIME_BOUND_PATTERN.search(short_term_goals) is not None,
+            # 2. Student interest alignment
+            "Aligned with Career Interest": any(term in goal_as_text for term in career),
+            # 3. Standards alignment based on retrieved docs
+            "Aligned with Standards": aligned_with_standards
+        }
+
+
+    @staticmethod
+    def _achievable(text:str) -> bool:
+        "Whether text contains a measure such as 90%, 90 percent, 4 out of 5, a likert scale, etc."
+        return bool(_ACHIEVABLE_DIGIT_PATTERN.search(text)
+                    or ('percent' in text and _ACHIEVABLE_PERCENT_PATTERN.search(text))
+                    or ('out' in text and _ACHIEVABLE_OUT_OF_PATTERN.search(text))
+                    or 'likert scale' in text
+                    or ('measured' in text and _ACHIEVABLE_MEASURED_PATTERN.search(text)))
+
+
+    @staticmethod
+    def _aligned_with_standards(retrieved_docs:list) -> bool:
+        "Whether the state standards among the retrieved documents mention one of the standards keywords."
+        standards = " ".join(doc.page_content for doc in retrieved_docs if doc.metadata['info_category']=='state_standards').lower()
+        return _STANDARDS_PATTERN.search(standards) is not None
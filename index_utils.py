@@ -0,0 +1,227 @@
+import math
+import time
+
+import faiss
+import numpy as np
+
+
+
+INDEX_TYPES = ["flat", "hnsw", "ivf", "ivfpq"]
+
+## Vector compression: None keeps float32 vectors, 'fp16' halves them, 'sq8' stores one byte per dimension
+COMPRESSIONS = {None: "Flat", "fp16": "SQfp16", "sq8": "SQ8"}
+
+## Index used when nothing else is configured: exact search over float32 vectors
+DEFAULT_INDEX_CONFIG = {'type': 'flat', 'compression': None}
+
+## Number of vectors buffered to train IVF indexes and scalar quantizers before the index is built
+DEFAULT_TRAIN_SIZE = 50000
+
+DEFAULT_HNSW_M = 32
+DEFAULT_HNSW_EF_CONSTRUCTION = 200
+DEFAULT_HNSW_EF_SEARCH = 64
+DEFAULT_IVF_NPROBE = 16
+DEFAULT_PQ_NBITS = 8
+
+## k-means needs ~39 training points per centroid to produce good clusters
+_POINTS_PER_CENTROID = 39
+
+## Number of vectors reconstructed at a time by IndexUtils.search_subset
+_SUBSET_BATCH_SIZE = 16384
+
+
+def index_config(index_type:str="flat", compression:str=None, **params) -> dict:
+    """
+    Describes the FAISS index to build. It is recorded in the snapshot manifest, so a snapshot is only reused
+    for the same index configuration.
+
+    Args:
+        index_type (str): 'flat' (exact search), 'hnsw' (graph), 'ivf' (inverted lists) or 'ivfpq'
+            (inverted lists with product-quantized vectors).
+        compression (str): None, 'fp16' or 'sq8'. Not used with 'ivfpq', which compresses with PQ.
+        **params: Build parameters: hnsw_m, ef_construction (hnsw); nlist (ivf, ivfpq);
+            pq_m, pq_nbits (ivfpq); train_size (number of vectors used for training).
+            Unset parameters are chosen from the data at build time.
+    """
+    if not index_type in INDEX_TYPES:
+        raise ValueError(f"Unknown index type '{index_type}'. Available index types: {', '.join(INDEX_TYPES)}.")
+    if not compression in COMPRESSIONS:
+        raise ValueError(f"Unknown compression '{compression}'. Available compressions: fp16, sq8.")
+    if index_type == "ivfpq" and compression is not None:
+        raise ValueError("IVF-PQ indexes are already compressed by product quantization.")
+    return dict({'type': index_type, 'compression': compression}, **params)
+
+
+
+class IndexUtils:
+
+
+    @staticmethod
+    def train_size(config:dict) -> int:
+        "Number of vectors to collect before building the index (0 if it needs no training)."
+        if config['type'] in ("ivf", "ivfpq") or config.get('compression') == "sq8":
+            return config.get('train_size', DEFAULT_TRAIN_SIZE)
+        return 0
+
+
+    @staticmethod
+    def resolve_params(config:dict, dim:int, n_train:int) -> dict:
+        "Fills in the build parameters that were not set in config, for dim-dimensional vectors and n_train training vectors."
+        params = dict(config)
+        if config['type'] == "hnsw":
+            params.setdefault('hnsw_m', DEFAULT_HNSW_M)
+            params.setdefault('ef_construction', DEFAULT_HNSW_EF_CONSTRUCTION)
+
+        if config['type'] in ("ivf", "ivfpq"):
+            ## ~4 * sqrt(N) lists, but no more than the training set can support
+            params.setdefault('nlist', max(1, min(int(4 * math.sqrt(n_train)), n_train // _POINTS_PER_CENTROID)))
+
+        if config['type'] == "ivfpq":
+            if params.get('pq_m') is None:
+                params['pq_m'] = next(m for m in (64, 48, 32, 24, 16, 12, 8, 4, 2, 1) if dim % m == 0)
+            if dim % params['pq_m'] != 0:
+                raise ValueError(f"pq_m={params['pq_m']} must divide the vector dimension {dim}.")
+            ## Each sub-quantizer has 2**pq_nbits centroids, bounded by what the training set can support
+            params.setdefault('pq_nbits', max(1, min(DEFAULT_PQ_NBITS, int(math.log2(max(n_train // _POINTS_PER_CENTROID, 2))))))
+        return params
+
+
+    @staticmethod
+    def factory_string(params:dict) -> str:
+        "Returns the faiss.index_factory description of the resolved index parameters."
+        storage = COMPRESSIONS[params.get('compression')]
+        if params['type'] == "flat":
+            return storage
+        if params['type'] == "hnsw":
+            return f"HNSW{params['hnsw_m']}" + ("" if storage == "Flat" else f"_{storage}")
+        if params['type'] == "ivf":
+            return f"IVF{params['nlist']},{storage}"
+        return f"IVF{params['nlist']},PQ{params['pq_m']}x{params['pq_nbits']}"
+
+
+    @staticmethod
+    def build_index(config:dict, training_vectors:np.ndarray, metric:int=faiss.METRIC_L2):
+        """
+        Creates an empty FAISS index for config and trains it on training_vectors if it needs training.
+
+        Returns:
+            tuple: (index, build info for the manifest: factory string, resolved parameters, training size and time).
+        """
+        training_vectors = np.ascontiguousarray(training_vectors, dtype=np.float32)
+        n_train, dim = training_vectors.shape
+        params = IndexUtils.resolve_params(config, dim, n_train)
+        factory = IndexUtils.factory_string(params)
+
+        index = faiss.index_factory(dim, factory, metric)
+        if params['type'] == "hnsw":
+            index.hnsw.efConstruction = params['ef_construction']
+
+        needs_training = not index.is_trained
+        start = time.perf_counter()
+        if needs_training:
+            index.train(training_vectors)
+        train_seconds = time.perf_counter() - start
+
+        IndexUtils.prepare_index(index)
+        build_info = {
+            'factory': factory
+            , 'params': params
+            , 'dim': dim
+            , 'n_train': n_train if needs_training else 0
+            , 'train_seconds': round(train_seconds, 3)
+        }
+        return index, build_info
+
+
+    @staticmethod
+    def prepare_index(index):
+        "Enables reconstructing vectors by id from IVF indexes, which other parts of the pipeline rely on."
+        try:
+            ivf = faiss.extract_index_ivf(index)
+        except RuntimeError:
+            return
+        if ivf.direct_map.no():
+            ivf.make_direct_map()
+
+
+    @staticmethod
+    def set_search_params(index, nprobe:int=None, ef_search:int=None):
+        """
+        Sets the search-time accuracy/speed trade-off: nprobe inverted lists visited by IVF indexes,
+        ef_search candidates explored by HNSW indexes. Parameters that do not apply to the index are ignored.
+        """
+        if nprobe is not None:
+            try:
+                faiss.extract_index_ivf(index).nprobe = nprobe
+            except RuntimeError:
+                pass
+        if ef_search is not None and hasattr(index, "hnsw"):
+            index.hnsw.efSearch = ef_search
+
+
+    @staticmethod
+    def search(index, vectors:np.ndarray, k:int, selector=None):
+        """
+        Searches the index like index.search, but only among the positions accepted by selector (a faiss.IDSelector),
+        keeping the nprobe / ef_search currently set on the index.
+        """
+        if selector is None:
+            return index.search(vectors, k)
+
+        try:
+            ivf = faiss.extract_index_ivf(index)
+            params = faiss.SearchParametersIVF(sel=selector, nprobe=ivf.nprobe)
+        except RuntimeError:
+            if hasattr(index, "hnsw"):
+                params = faiss.SearchParametersHNSW(sel=selector, efSearch=index.hnsw.efSearch)
+            else:
+                params = faiss.SearchParameters(sel=selector)
+        return index.search(vectors, k, params=params)
+
+
+    @staticmethod
+    def search_subset(index, vectors:np.ndarray, k:int, positions:np.ndarray):
+        """
+        Exhaustive search among the given positions of the index, with the same results as index.search would give
+        if it only held them: the vectors are reconstructed from the index in batches (for PQ and SQ indexes, the
+        distances are those of their codes). Used when an approximate search with a selector finds fewer than k.
+        """
+        best_scores = np.empty((len(vectors), 0), dtype=np.float32)
+        best_positions = np.empty((len(vectors), 0), dtype=np.int64)
+        for start in range(0, len(positions), _SUBSET_BATCH_SIZE):
+            batch = np.asarray(positions[start:start + _SUBSET_BATCH_SIZE], dtype=np.int64)
+            scores, rows = faiss.knn(vectors, index.reconstruct_batch(batch), min(k, len(batch)), metric=index.metric_type)
+            best_scores = np.hstack([best_scores, scores])
+            best_positions = np.hstack([best_positions, np.where(rows >= 0, batch[np.maximum(rows, 0)], -1)])
+
+        order = np.argsort(best_scores if index.metric_type != faiss.METRIC_INNER_PRODUCT else -best_scores
+                            , axis=1, kind="stable")[:, :k]
+        scores = np.take_along_axis(best_scores, order, axis=1)
+        found = np.take_along_axis(best_positions, order, axis=1)
+        if found.shape[1] < k:
+            padding = k - found.shape[1]
+            scores = np.hstack([scores, np.full((len(vectors), padding), np.nan, dtype=np.float32)])
+            found = np.hstack([found, np.full((len(vectors), padding), -1, dtype=np.int64)])
+        return scores, found
+
+
+    @staticmethod
+    def get_search_params(index) -> dict:
+        "Returns the search parameters currently set on the index."
+        params = {}
+        try:
+            params['nprobe'] = faiss.extract_index_ivf(index).nprobe
+        except RuntimeError:
+            pass
+        if hasattr(index, "hnsw"):
+            params['ef_search'] = index.hnsw.efSearch
+        return params
+
+
+    @staticmethod
+    def default_search_params(config:dict) -> dict:
+        if config['type'] == "hnsw":
+            return {'ef_search': DEFAULT_HNSW_EF_SEARCH}
+        if config['type'] in ("ivf", "ivfpq"):
+            return {'nprobe': DEFAULT_IVF_NPROBE}
+        return {}
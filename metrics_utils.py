@@ -0,0 +1,369 @@
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+
+import numpy as np
+
+
+
+## Upper bounds (in seconds) of the buckets of the stage duration histograms
+DEFAULT_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+## Number of finished spans kept for recent_spans and stage_summary
+DEFAULT_MAX_SPANS = 2000
+
+## Writes every finished span as a JSON line to this file ('-' for stderr), when the environment variable is set
+LOG_ENV_VAR = "RAG_IEP_METRICS_LOG"
+
+## Prefix of the exported metric names
+PREFIX = "rag_iep"
+
+logger = logging.getLogger("rag_iep.metrics")
+
+## Span of the code being run, parent of the spans it opens (propagated to asyncio tasks and asyncio.to_thread)
+_CURRENT_SPAN = contextvars.ContextVar("rag_iep_current_span", default=None)
+
+
+class Span:
+    "A timed stage of a request. Spans opened while another one is open are its children, in the same trace."
+
+    __slots__ = ("name", "trace_id", "span_id", "parent_id", "attrs", "started_at", "start", "duration_s", "error")
+
+    def __init__(self, name:str, attrs:dict, parent=None):
+        self.name = name
+        self.trace_id = parent.trace_id if parent is not None else uuid.uuid4().hex[:16]
+        self.span_id = uuid.uuid4().hex[:8]
+        self.parent_id = parent.span_id if parent is not None else None
+        self.attrs = attrs
+        self.started_at = time.time()
+        self.start = None
+        self.duration_s = None
+        self.error = None
+
+
+    def set(self, **attrs):
+        "Adds attributes to the span, e.g. the number of documents found."
+        self.attrs.update(attrs)
+
+
+    def as_dict(self) -> dict:
+        return {
+            'span': self.name
+            , 'trace_id': self.trace_id
+            , 'span_id': self.span_id
+            , 'parent_id': self.parent_id
+            , 'started_at': round(self.started_at, 6)
+            , 'duration_s': None if self.duration_s is None else round(self.duration_s, 6)
+            , 'error': self.error
+            , **self.attrs
+        }
+
+
+
+class Metrics:
+    """
+    Thread-safe registry of the pipeline metrics:
+        - spans (Metrics.span): stage timings, exported as the {PREFIX}_stage_duration_seconds histogram by stage
+          and kept for recent_spans and stage_summary;
+        - counters (Metrics.inc), e.g. tokens;
+        - histograms (Metrics.observe);
+        - caches (Metrics.register_cache), whose stats() are exported as gauges.
+
+    Finished spans are logged as JSON lines by the 'rag_iep.metrics' logger (see configure_logging), and all metrics
+    can be exported as a Prometheus text snapshot (prometheus_text).
+    """
+
+    def __init__(self, buckets:tuple=DEFAULT_LATENCY_BUCKETS, max_spans:int=DEFAULT_MAX_SPANS):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._spans = deque(maxlen=max_spans)
+        self._caches = {}
+
+
+    @contextmanager
+    def span(self, name:str, **attrs):
+        """
+        Times the enclosed code as a stage of the current trace (a new trace if no span is open).
+
+        Usage:
+            with METRICS.span("search", k=5) as span:
+                ...
+                span.set(n_docs=len(docs))
+        """
+        span = self.start_span(name, **attrs)
+        try:
+            with self.use_span(span):
+                yield span
+        except BaseException as exp:
+            span.error = f"{type(exp).__name__}: {exp}"
+            raise
+        finally:
+            self.finish_span(span)
+
+
+    @staticmethod
+    def start_span(name:str, **attrs) -> Span:
+        "Opens a span, child of the current one, without making it current (see use_span, traced_iter and finish_span)."
+        span = Span(name, attrs, _CURRENT_SPAN.get())
+        span.start = time.perf_counter()
+        return span
+
+
+    @staticmethod
+    @contextmanager
+    def use_span(span:Span):
+        "Makes span the current span (the parent of the spans opened) in the enclosed code."
+        token = _CURRENT_SPAN.set(span)
+        try:
+            yield span
+        finally:
+            _CURRENT_SPAN.reset(token)
+
+
+    def finish_span(self, span:Span):
+        span.duration_s = time.perf_counter() - span.start
+        self._finish(span)
+
+
+    def traced_iter(self, iterable, span:Span):
+        """
+        Iterates over iterable (e.g. a stream of tokens) with span as the current span while each item is produced,
+        and finishes the span when the iteration ends. Spans cannot stay open across the yields of a generator,
+        since its consumer runs in between.
+        """
+        iterator = iter(iterable)
+        try:
+            while True:
+                with self.use_span(span):
+                    try:
+                        item = next(iterator)
+                    except StopIteration:
+                        return
+                yield item
+        except BaseException as exp:
+            if isinstance(exp, GeneratorExit):
+                span.set(interrupted=True)
+            else:
+                span.error = f"{type(exp).__name__}: {exp}"
+            raise
+        finally:
+            self.finish_span(span)
+
+
+    def record_span(self, name:str, duration_s:float, **attrs) -> Span:
+        "Records a stage timed by the caller (e.g. the time to the first token of a stream) as a child of the current span."
+        span = Span(name, attrs, _CURRENT_SPAN.get())
+        span.started_at -= duration_s
+        span.duration_s = duration_s
+        self._finish(span)
+        return span
+
+
+    def adopt_spans(self, spans:list):
+        "Records spans finished in another process (as returned by recent_spans) as children of the current span."
+        parent = _CURRENT_SPAN.get()
+        for record in spans:
+            record = dict(record)
+            name, started_at, duration_s, error = record.pop('span'), record.pop('started_at'), record.pop('duration_s'), record.pop('error')
+            for field in ('trace_id', 'span_id', 'parent_id'):
+                record.pop(field)
+            span = Span(name, record, parent)
+            span.started_at, span.duration_s, span.error = started_at, duration_s, error
+            self._finish(span)
+
+
+    @staticmethod
+    def current_span() -> Span:
+        return _CURRENT_SPAN.get()
+
+
+    def _finish(self, span:Span):
+        self.observe("stage_duration_seconds", span.duration_s, stage=span.name)
+        if span.error is not None:
+            self.inc("stage_errors_total", stage=span.name)
+        with self._lock:
+            self._spans.append(span)
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(json.dumps(span.as_dict(), default=str))
+
+
+    def inc(self, name:str, value:float=1, **labels):
+        "Adds value to the counter name (e.g. 'llm_tokens_total') with the given labels."
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+
+    def observe(self, name:str, value:float, buckets:tuple=None, **labels):
+        "Adds an observation to the histogram name, with the latency buckets by default."
+        key = (name, _label_key(labels))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                bounds = self.buckets if buckets is None else tuple(buckets)
+                histogram = self._histograms[key] = {'bounds': bounds, 'counts': [0] * len(bounds), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(histogram['bounds']):
+                if value <= bound:
+                    histogram['counts'][i] += 1
+                    break
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+
+    def register_cache(self, name:str, cache):
+        "Exports the stats() of a cache (hits, misses, hit_rate, entries, ...) under the cache=name label."
+        with self._lock:
+            self._caches[name] = cache
+
+
+    def recent_spans(self, limit:int=None, trace_id:str=None) -> list:
+        "The last finished spans (of one trace, if given), oldest first, as dicts."
+        with self._lock:
+            spans = [span for span in self._spans if trace_id is None or span.trace_id == trace_id]
+        if limit is not None:
+            spans = spans[-limit:]
+        return [span.as_dict() for span in spans]
+
+
+    def last_trace(self, root:str=None) -> list:
+        "The spans of the last finished trace (whose root span is named root, if given), oldest first."
+        with self._lock:
+            roots = [span for span in self._spans if span.parent_id is None and (root is None or span.name == root)]
+        if not roots:
+            return []
+        return self.recent_spans(trace_id=roots[-1].trace_id)
+
+
+    def stage_summary(self) -> dict:
+        "{stage: {'count', 'mean_s', 'p50_s', 'p95_s', 'max_s', 'errors'}} over the recent spans."
+        with self._lock:
+            spans = list(self._spans)
+        by_stage = {}
+        for span in spans:
+            by_stage.setdefault(span.name, []).append(span)
+
+        summary = {}
+        for stage, stage_spans in by_stage.items():
+            durations = np.array([span.duration_s for span in stage_spans])
+            summary[stage] = {
+                'count': len(durations)
+                , 'mean_s': round(float(durations.mean()), 4)
+                , 'p50_s': round(float(np.percentile(durations, 50)), 4)
+                , 'p95_s': round(float(np.percentile(durations, 95)), 4)
+                , 'max_s': round(float(durations.max()), 4)
+                , 'errors': sum(span.error is not None for span in stage_spans)
+            }
+        return summary
+
+
+    def cache_stats(self) -> dict:
+        with self._lock:
+            caches = dict(self._caches)
+        stats = {}
+        for name, cache in caches.items():
+            try:
+                stats[name] = cache.stats()
+            except Exception as exp:
+                ## e.g. a closed disk cache
+                stats[name] = {'error': str(exp)}
+        return stats
+
+
+    def snapshot(self) -> dict:
+        "All the metrics as a JSON-serializable dict."
+        with self._lock:
+            counters = [{'name': name, 'labels': dict(labels), 'value': value} for (name, labels), value in self._counters.items()]
+            histograms = [{'name': name, 'labels': dict(labels), 'count': h['count'], 'sum': round(h['sum'], 6)}
+                            for (name, labels), h in self._histograms.items()]
+        return {'counters': counters, 'histograms': histograms, 'stages': self.stage_summary(), 'caches': self.cache_stats()}
+
+
+    def prometheus_text(self) -> str:
+        "All the metrics in the Prometheus text exposition format."
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((key, dict(h, counts=list(h['counts']))) for key, h in self._histograms.items())
+
+        lines = []
+        declared = set()
+
+        def declare(name, metric_type):
+            if not name in declared:
+                declared.add(name)
+                lines.append(f"# TYPE {name} {metric_type}")
+
+        for (name, labels), value in counters:
+            metric = f"{PREFIX}_{name}"
+            declare(metric, "counter")
+            lines.append(f"{metric}{_labels(labels)} {_number(value)}")
+
+        for (name, labels), histogram in histograms:
+            metric = f"{PREFIX}_{name}"
+            declare(metric, "histogram")
+            cumulative = 0
+            for bound, count in zip(histogram['bounds'], histogram['counts']):
+                cumulative += count
+                lines.append(f"{metric}_bucket{_labels(labels + (('le', _number(bound)),))} {cumulative}")
+            lines.append(f"{metric}_bucket{_labels(labels + (('le', '+Inf'),))} {histogram['count']}")
+            lines.append(f"{metric}_sum{_labels(labels)} {_number(histogram['sum'])}")
+            lines.append(f"{metric}_count{_labels(labels)} {histogram['count']}")
+
+        cache_stats = sorted(self.cache_stats().items())
+        for stat in ("hits", "misses", "hit_rate", "entries", "size_bytes"):
+            for name, stats in cache_stats:
+                if isinstance(stats.get(stat), (int, float)):
+                    metric = f"{PREFIX}_cache_{stat}"
+                    declare(metric, "gauge")
+                    lines.append(f"{metric}{_labels((('cache', name),))} {_number(stats[stat])}")
+
+        return "\n".join(lines) + "\n"
+
+
+    def reset(self):
+        "Clears the counters, histograms and spans (the caches stay registered)."
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+            self._spans.clear()
+
+
+    @staticmethod
+    def configure_logging(path:str="-", level:int=logging.INFO):
+        "Writes the finished spans as JSON lines to path ('-' for stderr)."
+        handler = logging.StreamHandler() if path == "-" else logging.FileHandler(path, encoding="utf-8")
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        logger.addHandler(handler)
+        logger.setLevel(level)
+        logger.propagate = False
+
+
+
+def _label_key(labels:dict) -> tuple:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _labels(labels:tuple) -> str:
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, value in labels)
+    return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + "}"
+
+
+def _number(value:float) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+
+## Metrics of the process, shared by the whole pipeline
+METRICS = Metrics()
+
+if os.environ.get(LOG_ENV_VAR):
+    Metrics.configure_logging(os.environ[LOG_ENV_VAR])
@@ -1,56 +1,272 @@
+import asyncio
+import contextvars
+import json
+import operator
 import os
+import queue
+import threading
+import time
 from collections import namedtuple
+from functools import reduce
 from pathlib import Path
 from typing import List
 
 
+import numpy as np
 from langchain_community.vectorstores import FAISS
 from langchain_core.documents.base import Document
 
 from langchain.chains import RetrievalQA
-from langchain_openai import OpenAIEmbeddings, ChatOpenAI
+from langchain_openai import ChatOpenAI
 from langchain.prompts import PromptTemplate
 from langchain.schema  import HumanMessage
+from langchain_core.messages import message_chunk_to_message
 
 import warnings
 
+from snapshot_utils import SnapshotUtils, DEFAULT_STORE_PATH, INDEX_NAME, COMPATIBILITY_FIELDS
+from embedding_utils import EmbeddingCache, AsyncEmbeddingEngine, CachedEmbeddings, DEFAULT_OPENAI_EMBEDDING_MODEL
+from embedding_utils import embedding_config, make_embeddings, is_remote_backend
+from retrieval_utils import RetrievalUtils
+from index_utils import IndexUtils, DEFAULT_INDEX_CONFIG
+from vectorstore_utils import VectorStoreUtils
+from data_utils import DataProcessor
+from cache_utils import ResponseCache
+from context_utils import ContextUtils, DEFAULT_CONTEXT_BUDGET
+from chunk_utils import OffsetDocstore
+from dedup_utils import ChunkDeduplicator
+from embedding_utils import count_tokens
+from metrics_utils import METRICS
+
 
 
 PARENT_DIR = Path(__file__).resolve().parent
 
+DEFAULT_EMBEDDING_MODEL = DEFAULT_OPENAI_EMBEDDING_MODEL
+
 
 class RAGUtils:
 
 
     @staticmethod
-    def create_and_save_embeddings(documents, open_ai_key, store_path= None):
+    def create_and_save_embeddings(documents, open_ai_key, store_path= None, manifest:dict=None
+                                    , embedding_model:str=DEFAULT_EMBEDDING_MODEL, keep_last:int=3
+                                    , embedding_cache:EmbeddingCache=None, use_cache:bool=None
+                                    , embedding_backend:str=None
+                                    , batch_size:int=256, max_concurrency:int=4, tokens_per_minute:int=None
+                                    , prefetch_batches:int=2, index_config:dict=None, index_search_params:dict=None):
         """
-        Converts text chunks into embeddings using OpenAI, then stores them in a FAISS index for fast similarity search.
+        Converts text chunks into embeddings, then stores them in a FAISS index for fast similarity search.
+        The embedding model is the one described by manifest['embedding'] (see embedding_utils.embedding_config),
+        or else the embedding_backend ('openai' by default, or the local 'hashing' backend) and embedding_model.
+        The index is saved as a new snapshot under store_path (see SnapshotUtils.save_snapshot), together with
+        the manifest describing how it was built.
+
+        documents can be a list or any iterable of chunks (e.g. DataProcessor.iter_documents()). The chunks are
+        consumed in groups of batch_size * max_concurrency on a background thread, at most prefetch_batches groups
+        ahead of the embedding calls, and every group is appended to the index as soon as it is embedded.
+        Chunks are stored under stable ids (see DataProcessor.chunk_id), so single sources can later be
+        replaced or removed without a rebuild (see update_vectorstore).
+        Parsing and embedding therefore overlap, and memory use does not depend on the size of the corpus.
+
+        When use_cache is True (the default for remote backends), chunk embeddings are looked up in embedding_cache
+        (the shared on-disk cache in data/embedding_cache by default) and only the chunks that are not cached are embedded.
+        Embedding requests are sent in batches of batch_size, at most max_concurrency at a time, throttled to
+        tokens_per_minute (if given) and retried with exponential backoff (see AsyncEmbeddingEngine).
+
+        The FAISS index type is manifest['index'], or else index_config (see index_utils.index_config); exact
+        flat search by default. Indexes that need training (IVF, IVF-PQ, int8 compression) are trained on the
+        first train_size chunks before the rest is streamed in. The resolved build parameters are recorded in
+        the manifest ('index_build'), together with the search parameters ('index_search', e.g. nprobe or ef_search)
+        that are applied whenever the snapshot is loaded.
         """
         if store_path is None:
-            store_path = os.path.join(PARENT_DIR, "data/faiss_store")
+            store_path = DEFAULT_STORE_PATH
+        if manifest is None:
+            manifest = {'embedding': embedding_config(embedding_backend, embedding_model)}
+        config = manifest['embedding']
+        if index_config is None:
+            index_config = manifest.get('index', DEFAULT_INDEX_CONFIG)
+        if index_search_params is None:
+            index_search_params = IndexUtils.default_search_params(index_config)
+        if use_cache is None:
+            use_cache = is_remote_backend(config)
         try:
-            # Step 3: Create embeddings and store in vector database
-            # Creates vector representations of text chunks for semantic search
-            embeddings = OpenAIEmbeddings(
-                api_key=open_ai_key  # Replace with your actual API key
-            )
-            # FAISS is an efficient similarity search library
-            vectorstore = FAISS.from_documents(documents, embeddings)
-            print("FAISS Vector database created successfully")
-            return vectorstore
+            with METRICS.span("index_build", model=config['model'], index=index_config.get('type')) as span:
+                # Step 3: Create embeddings and store in vector database
+                # Creates vector representations of text chunks for semantic search
+                embeddings = make_embeddings(config, open_ai_key=open_ai_key)  # Replace with your actual API key
+                build_embeddings = embeddings
+                if is_remote_backend(config):
+                    ## Retries are handled by the embedding engine during the build
+                    build_embeddings = make_embeddings(config, open_ai_key=open_ai_key, max_retries=0)
+                if use_cache and embedding_cache is None:
+                    embedding_cache = EmbeddingCache()
+
+                engine = AsyncEmbeddingEngine(build_embeddings, batch_size=batch_size, max_concurrency=max_concurrency
+                                                , tokens_per_minute=tokens_per_minute
+                                                , cache=embedding_cache if use_cache else None, model=config['model'])
+
+                # FAISS is an efficient similarity search library
+                vectorstore = None
+                build_info = None
+                ## Embedded batches held back until there are enough vectors to train the index
+                pending = []
+                n_pending = 0
+                train_size = IndexUtils.train_size(index_config)
+                chunks = DataProcessor.with_chunk_ids(documents)
+                for batch in _prefetch(_iter_batches(chunks, batch_size * max_concurrency), max_items=prefetch_batches):
+                    texts = [doc.page_content for doc in batch]
+                    vectors = engine.embed(texts)
+                    metadatas = [doc.metadata for doc in batch]
+                    ids = [doc.id for doc in batch]
+                    if vectorstore is None:
+                        pending.append((texts, vectors, metadatas, ids))
+                        n_pending += len(texts)
+                        if n_pending < train_size:
+                            continue
+                        vectorstore, build_info = _new_vectorstore(embeddings, index_config, pending)
+                        pending = []
+                    else:
+                        vectorstore.add_embeddings(zip(texts, vectors), metadatas=metadatas, ids=ids)
+
+                if vectorstore is None and len(pending) > 0:
+                    vectorstore, build_info = _new_vectorstore(embeddings, index_config, pending)
+
+                if vectorstore is None:
+                    raise ValueError("No documents to embed.")
+                IndexUtils.set_search_params(vectorstore.index, **index_search_params)
+
+                span.set(chunks=vectorstore.index.ntotal, embedding_requests=engine.n_requests, retries=engine.n_retries)
+                print(f"FAISS Vector database created successfully: {vectorstore.index.ntotal} chunks "
+                        f"({engine.n_requests} embedding requests, {engine.n_retries} retries)")
+                if use_cache:
+                    print(f"Embedding cache: {embedding_cache.stats()}")
+
+                manifest = dict(manifest, index=index_config, index_build=build_info, index_search=index_search_params)
+                snapshot_path = SnapshotUtils.save_snapshot(vectorstore, manifest, store_path=store_path, keep_last=keep_last)
+                print(f"FAISS Vector database saved to {snapshot_path}")
+                return vectorstore
 
         except Exception as exp:
             raise Exception(exp)
 
 
     @staticmethod
-    def load_vectorstore(path="faiss_store"):
+    def load_vectorstore(path=None, open_ai_key=None, expected_manifest:dict=None
+                            , embedding_model:str=DEFAULT_EMBEDDING_MODEL, embedding_backend:str=None
+                            , ignore_corpus:bool=False):
         """
         Loads an existing FAISS vector store from local storage.
+
+        path may be a snapshot root written by create_and_save_embeddings, in which case the newest snapshot
+        compatible with expected_manifest is loaded (None if there is none), a single snapshot directory, which is
+        validated against its manifest and expected_manifest in the same way, or a plain FAISS.save_local directory.
+        With ignore_corpus, snapshots built from other versions of the source documents are accepted as well
+        (to be brought up to date with update_vectorstore).
+        Queries are embedded with the backend recorded in the manifest (or embedding_backend and embedding_model).
+        """
+        if path is None:
+            path = DEFAULT_STORE_PATH
+
+        if not expected_manifest is None:
+            config = expected_manifest['embedding']
+        else:
+            config = embedding_config(embedding_backend, embedding_model)
+
+        fields = [field for field in COMPATIBILITY_FIELDS if not (ignore_corpus and field == 'corpus_hash')]
+
+        if os.path.isfile(os.path.join(path, f"{INDEX_NAME}.faiss")):
+            manifest = SnapshotUtils.read_manifest(path)
+            if manifest is None:
+                return SnapshotUtils.load_snapshot(path, make_embeddings(config, open_ai_key=open_ai_key))
+            if expected_manifest is None:
+                config = manifest['embedding']
+            if not SnapshotUtils.is_compatible(manifest, expected_manifest, fields=fields):
+                print(f"Snapshot {path} does not match the expected manifest")
+                return None
+            if not SnapshotUtils.validate_snapshot(path, manifest):
+                print(f"Skipping invalid snapshot: {path}")
+                return None
+            return SnapshotUtils.load_snapshot(path, make_embeddings(config, open_ai_key=open_ai_key), manifest=manifest)
+
+        if expected_manifest is None:
+            ## Use the embedding backend of the newest snapshot
+            snapshots = SnapshotUtils.list_snapshots(path)
+            if len(snapshots) == 0:
+                return None
+            config = snapshots[0][1]['embedding']
+
+        return SnapshotUtils.load_latest(make_embeddings(config, open_ai_key=open_ai_key), store_path=path
+                                            , expected_manifest=expected_manifest, fields=fields)
+
+
+    @staticmethod
+    def update_vectorstore(vectorstore:FAISS, manifest:dict, open_ai_key=None, store_path=None, keep_last:int=3
+                            , embedding_cache:EmbeddingCache=None, use_cache:bool=None
+                            , compact_threshold="auto", save:bool=True) -> dict:
+        """
+        Brings a vector store loaded from a snapshot up to date with manifest (built from the current sources,
+        see SnapshotUtils.build_manifest), without a full rebuild: sources that are new or whose file hash changed
+        are re-parsed and upserted, sources that are no longer listed are deleted, the others are left untouched
+        (see VectorStoreUtils). Sources cited by deleted chunks as duplicates (see VectorStoreUtils.cited_sources) are
+        re-run too, so their text stays in the store. The updated store is then saved as a new snapshot, unless save is False.
+
+        Returns:
+            dict: {source key: {'added': n, 'deleted': n, 'unchanged': n, 'cited_sources': [keys]}} for the sources
+                that were updated.
         """
-        embedding_model = OpenAIEmbeddings()
-        return FAISS.load_local(path, embedding_model)
+        current = SnapshotUtils.get_manifest(vectorstore)
+        if current is None:
+            raise ValueError("Only vector stores loaded from or saved as snapshots can be updated.")
+
+        config = current['embedding']
+        if use_cache is None:
+            use_cache = is_remote_backend(config)
+        embeddings = vectorstore.embedding_function
+        if use_cache:
+            embeddings = CachedEmbeddings(embeddings, embedding_cache or EmbeddingCache(), model=config['model'])
+
+        current_sources = {DataProcessor.source_key(src): src for src in current.get('corpus', [])}
+        expected_sources = {DataProcessor.source_key(src): src for src in manifest['corpus']}
+
+        changes = {}
+        cited_sources = []
+        def upsert(key):
+            try:
+                documents = DataProcessor.iter_source_documents(expected_sources[key], **current.get('chunking', {}))
+                changes[key] = VectorStoreUtils.upsert_source(vectorstore, key, documents, embeddings=embeddings
+                                                                , compact_threshold=compact_threshold)
+                cited_sources.extend(changes[key]['cited_sources'])
+            except ValueError as exp:
+                warnings.warn(f"{key} could not be updated: {exp}")
+
+        for key, source in expected_sources.items():
+            if current_sources.get(key) != source:
+                upsert(key)
+
+        for key in current_sources:
+            if not key in expected_sources:
+                cited_sources.extend(VectorStoreUtils.cited_sources(vectorstore
+                                                                    , VectorStoreUtils.get_source_chunks(vectorstore).get(key, [])))
+                n_deleted = VectorStoreUtils.delete_source(vectorstore, key, compact_threshold=compact_threshold)
+                changes[key] = {'added': 0, 'deleted': n_deleted, 'unchanged': 0, 'cited_sources': []}
+
+        ## Deleted chunks may have stood for duplicates dropped from other sources at the last full build:
+        ## those sources are re-run, which adds back their chunks that are no longer in the store
+        rerun = set(changes)
+        while cited_sources:
+            key = cited_sources.pop(0)
+            if key in expected_sources and not key in rerun:
+                rerun.add(key)
+                upsert(key)
+
+        print(f"FAISS Vector database updated: {changes}")
+        if save:
+            updated = dict(current, corpus=manifest['corpus'], corpus_hash=manifest['corpus_hash'])
+            snapshot_path = SnapshotUtils.save_snapshot(vectorstore, updated, store_path=store_path, keep_last=keep_last)
+            print(f"FAISS Vector database saved to {snapshot_path}")
+        return changes
 
 
     @staticmethod
@@ -58,18 +274,31 @@ class RAGUtils:
                 , query:str= "IEP goals, IEP transition plan, disabilities act, academic standards, job profiles."               
                 , k:int=5
                 , min_sim_score = None
+                , hybrid:bool=False
+                , fetch_k:int=None
+                , category_quotas:dict=None
+                , use_cache:bool=True
                 # , info_categories:str=None
                 # , all_categories=False
                 
                 ) -> List[Document]:
-        "Retrieves the top-k most relevant documents to a specied query."
+        """
+        Retrieves the top-k most relevant documents to a specied query.
 
-        results = vectorstore.similarity_search_with_score(query, k=k)
+        With hybrid=True, fetch_k candidates are retrieved both by FAISS similarity and by BM25 keyword search
+        over the same chunks, and the two rankings are combined with reciprocal-rank fusion (see RetrievalUtils.hybrid_search).
+        This finds chunks matching exact occupation names and standard codes that dense retrieval alone tends to miss.
 
-        if not min_sim_score is None:
-            results = [res for res, score in results if score>=min_sim_score]
-        else:
-            results = [res for res, score in results]
+        With category_quotas (e.g. {'career_profile': 4, 'state_standards': 4, 'idea': 1}), k is ignored and
+        each info_category is searched separately for its quota of chunks (see RetrievalUtils.category_search).
+        The documents are returned grouped by category, in the order of the quotas.
+
+        With use_cache, query vectors and results are cached for the process and repeated queries against
+        the same index version do not call the embedding model or search the index (see RetrievalUtils.retrieve).
+        """
+        doc_ids = RetrievalUtils.retrieve(vectorstore, query, k=k, min_sim_score=min_sim_score, hybrid=hybrid
+                                            , fetch_k=fetch_k, category_quotas=category_quotas, use_cache=use_cache)
+        results = [vectorstore.docstore.search(doc_id) for doc_id in doc_ids]
 
         # if info_categories:
         #     results = [doc for doc in results if doc.metadata.get("info_category") in info_categories]
@@ -86,20 +315,294 @@ class RAGUtils:
 
 
     @staticmethod
-    def generate_iep_goals(chat_model:ChatOpenAI, student_info:dict):
+    async def aretrieve_relevant_documents(vectorstore:FAISS
+                , query:str= "IEP goals, IEP transition plan, disabilities act, academic standards, job profiles."
+                , k:int=5
+                , min_sim_score = None
+                , hybrid:bool=False
+                , fetch_k:int=None
+                , category_quotas:dict=None
+                , use_cache:bool=True
+                ) -> List[Document]:
+        "Async version of retrieve_relevant_documents (see RetrievalUtils.aretrieve)."
+        doc_ids = await RetrievalUtils.aretrieve(vectorstore, query, k=k, min_sim_score=min_sim_score, hybrid=hybrid
+                                                    , fetch_k=fetch_k, category_quotas=category_quotas, use_cache=use_cache)
+        return [vectorstore.docstore.search(doc_id) for doc_id in doc_ids]
+
+
+    @staticmethod
+    def model_key(chat_model) -> str:
+        "Identifies a chat model and its generation parameters."
+        return json.dumps(chat_model._identifying_params, sort_keys=True, default=str)
+
+
+    @staticmethod
+    def format_iep_prompt(student_info:dict, context_budget:int=DEFAULT_CONTEXT_BUDGET):
+        """
+        Formats IEP_RAG_PROMT for a student profile and its retrieved documents. The documents are packed into a
+        compact context of at most context_budget tokens (see ContextUtils.pack); with context_budget=None,
+        they are inserted as they are.
+
+        Returns:
+            tuple: (prompt, packing statistics (see ContextUtils.stats) or None)
+        """
+        docs = student_info.get('retrieved_docs')
+        if context_budget is None or not isinstance(docs, list) or len(docs) == 0:
+            return IEP_RAG_PROMT.format(**student_info), None
+
+        with METRICS.span("context_packing", docs=len(docs), budget=context_budget) as span:
+            packed = ContextUtils.pack(docs, budget=context_budget)
+            context_stats = ContextUtils.stats(packed)
+            span.set(tokens=packed.tokens, tokens_saved=context_stats['tokens_saved'])
+        METRICS.inc("context_tokens_total", packed.tokens)
+        METRICS.inc("context_tokens_saved_total", context_stats['tokens_saved'])
+        print(f"Context: {packed.tokens} tokens, {context_stats['tokens_saved']} saved "
+                f"({packed.n_merged} chunks merged, {packed.n_duplicates} duplicates, {packed.n_dropped} dropped)")
+        return IEP_RAG_PROMT.format(**dict(student_info, retrieved_docs=packed.text)), context_stats
+
+
+    @staticmethod
+    def generate_iep_goals(chat_model:ChatOpenAI, student_info:dict, response_cache:ResponseCache=None, index_version=None
+                            , context_budget:int=DEFAULT_CONTEXT_BUDGET):
+        """
+        Generates the IEP goals for a student profile and its retrieved documents.
+
+        The documents are packed into at most context_budget tokens (see format_iep_prompt); the packing
+        statistics are returned in response_metadata['context'].
+
+        With response_cache, the response is looked up by the formatted prompt, the chat model and index_version
+        (see RetrievalUtils.index_version) before calling the model, and cached afterwards. Responses served
+        from the cache carry their provenance in response_metadata['cache'].
+        """
 
         ## Format the prompt by adding the student's profile and relevant documents
         ## From the vector store
-        formatted_prompt = IEP_RAG_PROMT.format(**student_info)
+        formatted_prompt, context_stats = RAGUtils.format_iep_prompt(student_info, context_budget)
+
+        if response_cache is not None:
+            cache_args = _response_cache_args(chat_model, student_info)
+            cached = response_cache.get(formatted_prompt, index_version=index_version, **cache_args)
+            if cached is not None:
+                response, provenance = cached
+                return _with_metadata(response, cache=provenance, context=context_stats)
 
         # Generate the response
         # The chat model expect a specific format. We will use HumanMessage
-        response = chat_model.invoke([HumanMessage(content=formatted_prompt)])
+        with METRICS.span("llm", model=_model_name(chat_model)) as span:
+            response = chat_model.invoke([HumanMessage(content=formatted_prompt)])
+            _record_usage(span, formatted_prompt, response)
+
+        if response_cache is not None:
+            response_cache.set(formatted_prompt, index_version=index_version, response=response
+                                , sources=_sources(student_info), **cache_args)
+
+        return _with_metadata(response, context=context_stats)
+
+
+    @staticmethod
+    async def agenerate_iep_goals(chat_model:ChatOpenAI, student_info:dict, response_cache:ResponseCache=None, index_version=None
+                                    , context_budget:int=DEFAULT_CONTEXT_BUDGET):
+        """
+        Async version of generate_iep_goals: the chat model is called with ainvoke, and the response cache
+        (on disk) is read and written in a worker thread.
+        """
+        formatted_prompt, context_stats = RAGUtils.format_iep_prompt(student_info, context_budget)
+
+        if response_cache is not None:
+            cache_args = _response_cache_args(chat_model, student_info)
+            cached = await asyncio.to_thread(response_cache.get, formatted_prompt, index_version=index_version, **cache_args)
+            if cached is not None:
+                response, provenance = cached
+                return _with_metadata(response, cache=provenance, context=context_stats)
+
+        with METRICS.span("llm", model=_model_name(chat_model)) as span:
+            response = await chat_model.ainvoke([HumanMessage(content=formatted_prompt)])
+            _record_usage(span, formatted_prompt, response)
 
+        if response_cache is not None:
+            await asyncio.to_thread(response_cache.set, formatted_prompt, index_version=index_version, response=response
+                                    , sources=_sources(student_info), **cache_args)
+
+        return _with_metadata(response, context=context_stats)
+
+
+    @staticmethod
+    def stream_iep_goals(chat_model:ChatOpenAI, student_info:dict, response_cache:ResponseCache=None, index_version=None
+                            , timings:dict=None, context_budget:int=DEFAULT_CONTEXT_BUDGET):
+        """
+        Streaming version of generate_iep_goals: yields the text of the response as the model generates it.
+        A cached response is yielded at once, and a completed response is cached like in generate_iep_goals.
+
+        timings, if given, receives 'ttft_s' (seconds until the first token), 'total_s', 'cached'
+        (the provenance of a cached response, or None) and 'context' (the packing statistics).
+        """
+        timings = {} if timings is None else timings
+        start = time.perf_counter()
+        formatted_prompt, timings['context'] = RAGUtils.format_iep_prompt(student_info, context_budget)
+
+        if response_cache is not None:
+            cache_args = _response_cache_args(chat_model, student_info)
+            cached = response_cache.get(formatted_prompt, index_version=index_version, **cache_args)
+            if cached is not None:
+                response, provenance = cached
+                elapsed = time.perf_counter() - start
+                timings.update(ttft_s=elapsed, total_s=elapsed, cached=provenance)
+                yield response.content
+                return
+
+        response = yield from RAGUtils.stream_text(chat_model, formatted_prompt, timings=timings, start=start)
+
+        if response_cache is not None and response is not None:
+            response_cache.set(formatted_prompt, index_version=index_version, response=response
+                                , sources=_sources(student_info), **cache_args)
+
+
+    @staticmethod
+    def stream_text(chat_model:ChatOpenAI, prompt:str, timings:dict=None, start:float=None):
+        """
+        Yields the text of the chat model's response to prompt as it arrives, and returns the complete message
+        (for use with `yield from`).
+
+        timings, if given, receives 'ttft_s' (seconds from start, or from the first iteration, until the first
+        non-empty token), 'total_s' and 'cached' (None).
+        """
+        timings = {} if timings is None else timings
+        if start is None:
+            start = time.perf_counter()
+        timings.update(ttft_s=None, total_s=None, cached=None)
+
+        ## The LLM spans are recorded at the end, since spans cannot stay open across the yields of a generator
+        llm_start = time.perf_counter()
+        chunks = []
+        for chunk in chat_model.stream([HumanMessage(content=prompt)]):
+            if timings['ttft_s'] is None and chunk.content:
+                timings['ttft_s'] = time.perf_counter() - start
+                METRICS.record_span("llm_first_token", time.perf_counter() - llm_start, model=_model_name(chat_model))
+            chunks.append(chunk)
+            yield chunk.content
+        timings['total_s'] = time.perf_counter() - start
+
+        response = None
+        if len(chunks) > 0:
+            response = message_chunk_to_message(reduce(operator.add, chunks))
+        span = METRICS.record_span("llm", time.perf_counter() - llm_start, model=_model_name(chat_model), stream=True)
+        _record_usage(span, prompt, response)
         return response
 
 
 
+def _model_name(chat_model) -> str:
+    return getattr(chat_model, "model_name", None) or chat_model._llm_type
+
+
+def _record_usage(span, prompt:str, response):
+    """
+    Records the prompt and completion tokens of a chat model call on its span and in the llm_tokens_total counter:
+    those reported by the model (usage_metadata), or else estimated with count_tokens.
+    """
+    usage = getattr(response, "usage_metadata", None)
+    if usage:
+        prompt_tokens, completion_tokens, estimated = usage.get('input_tokens', 0), usage.get('output_tokens', 0), False
+    else:
+        content = "" if response is None else response.content
+        prompt_tokens, completion_tokens, estimated = count_tokens(prompt), count_tokens(content) if content else 0, True
+    span.set(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens, estimated_tokens=estimated)
+    METRICS.inc("llm_tokens_total", prompt_tokens, kind="prompt", model=span.attrs.get('model'))
+    METRICS.inc("llm_tokens_total", completion_tokens, kind="completion", model=span.attrs.get('model'))
+
+
+def _response_cache_args(chat_model, student_info:dict) -> dict:
+    "Model and semantic tier inputs of a ResponseCache lookup for student_info."
+    docs = student_info.get('retrieved_docs') or []
+    ## The semantic tier compares the rest of the profile, for the same student and documents
+    profile_text = "\n".join(f"{key}: {value}" for key, value in student_info.items()
+                                if not key in ('student_name', 'retrieved_docs'))
+    return {
+        'model': RAGUtils.model_key(chat_model)
+        , 'profile_text': profile_text
+        , 'context': [student_info.get('student_name')] + [doc.id or doc.page_content for doc in docs]
+    }
+
+
+def _with_metadata(response, **metadata):
+    "Copy of a chat model response with metadata added to its response_metadata."
+    return response.model_copy(update={'response_metadata': dict(response.response_metadata, **metadata)})
+
+
+def _sources(student_info:dict) -> list:
+    "Sources cited by the retrieved documents, including those of the duplicates they stand for."
+    return [citation.get('source') for doc in student_info.get('retrieved_docs') or []
+                for citation in ChunkDeduplicator.citations(doc.metadata)]
+
+
+
+
+
+def _new_vectorstore(embeddings, index_config:dict, batches:list):
+    "Builds (and trains) the index described by index_config on the given (texts, vectors, metadatas, ids) batches."
+    vectors = np.asarray([vector for _, batch_vectors, _, _ in batches for vector in batch_vectors], dtype=np.float32)
+    index, build_info = IndexUtils.build_index(index_config, vectors)
+    vectorstore = FAISS(embedding_function=embeddings, index=index, docstore=OffsetDocstore(), index_to_docstore_id={})
+    for texts, batch_vectors, metadatas, ids in batches:
+        vectorstore.add_embeddings(zip(texts, batch_vectors), metadatas=metadatas, ids=ids)
+    return vectorstore, build_info
+
+
+def _iter_batches(iterable, size:int):
+    "Groups an iterable into lists of at most size items."
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _prefetch(iterable, max_items:int=2):
+    """
+    Consumes an iterable on a background thread, at most max_items ahead of the caller,
+    so that producing the next items overlaps with processing the current one.
+    Exceptions raised by the producer are re-raised in the caller.
+    """
+    items = queue.Queue(maxsize=max(1, max_items))
+    done = object()
+    stop = threading.Event()
+
+    def put(entry) -> bool:
+        while not stop.is_set():
+            try:
+                items.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+            put((done, None))
+        except BaseException as exp:
+            put((done, exp))
+
+    ## In a copy of the caller's context, so the spans of the parsing are part of the caller's trace
+    producer = threading.Thread(target=contextvars.copy_context().run, args=(produce,), daemon=True)
+    producer.start()
+    try:
+        while True:
+            item, exp = items.get()
+            if item is done:
+                if exp is not None:
+                    raise exp
+                return
+            yield item
+    finally:
+        stop.set()
+
+
 
 
 # Define the structure of the student info
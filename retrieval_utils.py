@@ -0,0 +1,670 @@
+import asyncio
+import math
+import json
+import re
+import uuid
+import weakref
+from collections import Counter, defaultdict
+from typing import List
+
+import faiss
+import numpy as np
+from langchain_community.vectorstores import FAISS
+from langchain_core.callbacks import AsyncCallbackManagerForRetrieverRun, CallbackManagerForRetrieverRun
+from langchain_core.documents.base import Document
+from langchain_core.retrievers import BaseRetriever
+from pydantic import ConfigDict
+
+from cache_utils import LRUCache
+from index_utils import IndexUtils
+from metrics_utils import METRICS
+from snapshot_utils import SnapshotUtils
+
+
+
+## Words, numbers and dotted/dashed codes such as "21.K-2.TL.2" or "41-2031"
+_TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:[.\-][a-z0-9]+)*")
+
+## Number of chunks retrieved per info_category by RetrievalUtils.category_search
+DEFAULT_CATEGORY_QUOTAS = {'career_profile': 4, 'state_standards': 4, 'idea': 1}
+
+## Structures derived from a vector store, rebuilt when the store changes (see RetrievalUtils.derived)
+_DERIVED = weakref.WeakKeyDictionary()
+
+## Process-wide caches shared by all vector stores (see RetrievalUtils.retrieve).
+## Query vectors are keyed by embedding model and query; results by index version, query and search parameters.
+QUERY_VECTOR_CACHE = LRUCache(max_size=1024, ttl=24 * 3600)
+RETRIEVAL_CACHE = LRUCache(max_size=4096, ttl=3600)
+METRICS.register_cache("query_vector", QUERY_VECTOR_CACHE)
+METRICS.register_cache("retrieval", RETRIEVAL_CACHE)
+
+## Identifies vector stores without a snapshot manifest in index versions
+_STORE_TOKENS = weakref.WeakKeyDictionary()
+
+## Number of in-place modifications of each vector store (see RetrievalUtils.bump_revision)
+_REVISIONS = weakref.WeakKeyDictionary()
+
+
+class BM25Index:
+    """
+    Inverted index over a list of documents, scored with Okapi BM25.
+    Postings are stored as NumPy arrays, so a query only touches the documents that contain its terms.
+    Documents can be added and removed in place (see add and remove): removed documents keep their slot and
+    postings, which are skipped by searches, until the index is rebuilt.
+    """
+
+    def __init__(self, doc_ids:List[str], texts:List[str], k1:float=1.5, b:float=0.75):
+        self.k1 = k1
+        self.b = b
+        self.doc_ids = []                           # slot -> doc id, None once removed
+        self._slots = {}                            # doc id -> slot
+        self.doc_len = np.zeros(0, dtype=np.float32)
+        self.live = np.zeros(0, dtype=bool)
+        self.total_len = 0.0
+        self.df = Counter()                         # term -> number of documents containing it
+        self.postings = {}                          # term -> (slots, term frequencies)
+        self.add(doc_ids, texts)
+
+
+    def __len__(self):
+        return len(self._slots)
+
+
+    @property
+    def avg_doc_len(self) -> float:
+        return self.total_len / len(self._slots) if self._slots else 0.0
+
+
+    def add(self, doc_ids:List[str], texts:List[str]):
+        "Adds documents. Only the postings of their terms are extended."
+        doc_ids = list(doc_ids)
+        repeated = [doc_id for doc_id in doc_ids if doc_id in self._slots]
+        if len(repeated) > 0 or len(set(doc_ids)) < len(doc_ids):
+            raise ValueError(f"Documents are already in the BM25 index or repeated: {repeated[:5]}")
+
+        first = len(self.doc_ids)
+        if first + len(doc_ids) > len(self.doc_len):
+            capacity = max(first + len(doc_ids), 2 * len(self.doc_len))
+            self.doc_len = np.concatenate([self.doc_len, np.zeros(capacity - len(self.doc_len), dtype=np.float32)])
+            self.live = np.concatenate([self.live, np.zeros(capacity - len(self.live), dtype=bool)])
+
+        new_postings = defaultdict(lambda: ([], []))
+        for slot, (doc_id, text) in enumerate(zip(doc_ids, texts), start=first):
+            terms = Counter(RetrievalUtils.tokenize(text))
+            self.doc_ids.append(doc_id)
+            self._slots[doc_id] = slot
+            self.doc_len[slot] = sum(terms.values())
+            self.live[slot] = True
+            self.total_len += float(self.doc_len[slot])
+            self.df.update(terms.keys())
+            for term, tf in terms.items():
+                slots, tfs = new_postings[term]
+                slots.append(slot)
+                tfs.append(tf)
+
+        for term, (slots, tfs) in new_postings.items():
+            slots, tfs = np.asarray(slots, dtype=np.int64), np.asarray(tfs, dtype=np.float32)
+            if term in self.postings:
+                old_slots, old_tfs = self.postings[term]
+                slots, tfs = np.concatenate([old_slots, slots]), np.concatenate([old_tfs, tfs])
+            self.postings[term] = (slots, tfs)
+
+
+    def remove(self, doc_ids:List[str], texts:List[str]):
+        "Removes documents, given with the texts they were added with. Unknown ids are ignored."
+        for doc_id, text in zip(doc_ids, texts):
+            slot = self._slots.pop(doc_id, None)
+            if slot is None:
+                continue
+            self.doc_ids[slot] = None
+            self.live[slot] = False
+            self.total_len -= float(self.doc_len[slot])
+            for term in set(RetrievalUtils.tokenize(text)):
+                self.df[term] -= 1
+                if self.df[term] <= 0:
+                    del self.df[term]
+
+
+    def apply_changes(self, vectorstore:FAISS, added:list, removed:list):
+        "Follows chunks added to and removed from a vector store (see RetrievalUtils.update_derived)."
+        self.remove([doc_id for _, doc_id, _ in removed], [doc.page_content for _, _, doc in removed])
+        self.add([doc_id for _, doc_id, _ in added], [doc.page_content for _, _, doc in added])
+
+
+    def search(self, query:str, k:int=10) -> list:
+        "Returns up to k (doc_id, score) pairs, best first. Documents sharing no term with the query are left out."
+        n_docs = len(self._slots)
+        scores = np.zeros(len(self.doc_ids), dtype=np.float32)
+        avg_doc_len = max(self.avg_doc_len, 1e-9)
+        matched = False
+        for term in set(RetrievalUtils.tokenize(query)):
+            df = self.df.get(term, 0)
+            if df <= 0:
+                continue
+            matched = True
+            idf = math.log(1.0 + (n_docs - df + 0.5) / (df + 0.5))
+            docs, tfs = self.postings[term]
+            norm = self.k1 * (1.0 - self.b + self.b * self.doc_len[docs] / avg_doc_len)
+            scores[docs] += idf * tfs * (self.k1 + 1.0) / (tfs + norm)
+
+        if not matched:
+            return []
+
+        scores[~self.live[:len(scores)]] = 0.0
+        k = min(k, int(np.count_nonzero(scores)))
+        if k <= 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [(self.doc_ids[i], float(scores[i])) for i in top]
+
+
+
+class CategoryPartition:
+    """
+    The chunks of one info_category, searchable on their own. The partition only holds their index positions:
+    it is searched in the store's own index, restricted to those positions by a faiss.IDSelectorBatch, so the
+    vectors are not copied and the index type and search parameters of the store apply.
+    """
+
+    def __init__(self, positions:dict):
+        self.positions = positions      # index position -> chunk id, in index order
+        self._selector = None
+        self._bm25 = None
+
+
+    def __len__(self):
+        return len(self.positions)
+
+
+    @property
+    def doc_ids(self) -> List[str]:
+        return list(self.positions.values())
+
+
+    @property
+    def selector(self):
+        if self._selector is None:
+            self._selector = faiss.IDSelectorBatch(np.fromiter(self.positions, dtype=np.int64, count=len(self.positions)))
+        return self._selector
+
+
+    def add(self, position:int, doc_id:str, doc:Document):
+        "Adds a chunk appended to the store at position."
+        self.positions[position] = doc_id
+        self._selector = None
+        if not self._bm25 is None:
+            self._bm25.add([doc_id], [doc.page_content])
+
+
+    def remove(self, position:int, doc_id:str, doc:Document):
+        "Removes a chunk deleted from the store."
+        if self.positions.pop(position, None) is None:
+            return
+        self._selector = None
+        if not self._bm25 is None:
+            self._bm25.remove([doc_id], [doc.page_content])
+
+
+    def bm25(self, vectorstore:FAISS) -> BM25Index:
+        "BM25 index over the chunks of the partition, built on first use."
+        if self._bm25 is None:
+            doc_ids = self.doc_ids
+            self._bm25 = BM25Index(doc_ids, [vectorstore.docstore.search(doc_id).page_content for doc_id in doc_ids])
+        return self._bm25
+
+
+    def search(self, vectorstore:FAISS, vector:np.ndarray, k:int) -> list:
+        """
+        Returns up to k (doc_id, distance) pairs, nearest first. Approximate indexes may find fewer than k chunks
+        of a small partition among the lists or neighbours they visit: the partition is then searched exhaustively.
+        """
+        k = min(k, len(self.positions))
+        if k <= 0:
+            return []
+        scores, positions = IndexUtils.search(vectorstore.index, vector, k, selector=self.selector)
+        if np.count_nonzero(positions[0] != -1) < k:
+            scores, positions = IndexUtils.search_subset(vectorstore.index, vector, k
+                                                            , np.fromiter(self.positions, dtype=np.int64, count=len(self.positions)))
+        return [(self.positions[int(pos)], float(score)) for pos, score in zip(positions[0], scores[0])
+                    if int(pos) in self.positions]
+
+
+
+class CategoryPartitions(dict):
+    "info_category -> CategoryPartition, kept up to date as chunks are added and removed (see RetrievalUtils.update_derived)."
+
+    def apply_changes(self, vectorstore:FAISS, added:list, removed:list):
+        for position, doc_id, doc in removed:
+            category = doc.metadata.get('info_category')
+            partition = self.get(category)
+            if not partition is None:
+                partition.remove(position, doc_id, doc)
+                if len(partition) == 0:
+                    del self[category]
+        for position, doc_id, doc in added:
+            self.setdefault(doc.metadata.get('info_category'), CategoryPartition({})).add(position, doc_id, doc)
+
+
+
+class TombstoneSet:
+    """
+    The index positions that no longer map to a chunk (see VectorStoreUtils), with a faiss.IDSelector excluding
+    them that is built on first use.
+    """
+
+    def __init__(self, positions):
+        self.positions = set(positions)
+        self._selector = None
+
+
+    def __len__(self):
+        return len(self.positions)
+
+
+    @property
+    def selector(self):
+        "faiss.IDSelector excluding the tombstones, or None if there are none."
+        if not self.positions:
+            return None
+        if self._selector is None:
+            batch = faiss.IDSelectorBatch(np.fromiter(self.positions, dtype=np.int64, count=len(self.positions)))
+            selector = faiss.IDSelectorNot(batch)
+            selector.batch = batch  ## IDSelectorNot does not own the selector it wraps
+            self._selector = selector
+        return self._selector
+
+
+    def apply_changes(self, vectorstore:FAISS, added:list, removed:list):
+        ## Chunks are always appended at new positions, so only removals create tombstones
+        if removed:
+            self.positions.update(position for position, _, _ in removed)
+            self._selector = None
+
+
+
+class StoreRetriever(BaseRetriever):
+    """
+    LangChain retriever over a FAISS store that searches through RetrievalUtils.retrieve, so it shares its caches,
+    supports hybrid and per-category retrieval, and skips deleted chunks (see VectorStoreUtils).
+    search_kwargs are passed to RetrievalUtils.retrieve (k, hybrid, category_quotas, ...).
+    """
+
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    vectorstore: FAISS
+    search_kwargs: dict = {}
+
+
+    def _get_relevant_documents(self, query:str, *, run_manager:CallbackManagerForRetrieverRun) -> List[Document]:
+        doc_ids = RetrievalUtils.retrieve(self.vectorstore, query, **self.search_kwargs)
+        return [self.vectorstore.docstore.search(doc_id) for doc_id in doc_ids]
+
+
+    async def _aget_relevant_documents(self, query:str, *, run_manager:AsyncCallbackManagerForRetrieverRun) -> List[Document]:
+        doc_ids = await RetrievalUtils.aretrieve(self.vectorstore, query, **self.search_kwargs)
+        return [self.vectorstore.docstore.search(doc_id) for doc_id in doc_ids]
+
+
+
+class RetrievalUtils:
+
+
+    @staticmethod
+    def tokenize(text:str) -> list:
+        "Lower-cased word tokens. Dotted or dashed codes are kept whole and also split into their parts."
+        tokens = []
+        for token in _TOKEN_PATTERN.findall(text.lower()):
+            tokens.append(token)
+            if "." in token or "-" in token:
+                tokens.extend(part for part in re.split(r"[.\-]", token) if part)
+        return tokens
+
+
+    @staticmethod
+    def store_version(vectorstore:FAISS) -> tuple:
+        "Changes whenever vectors are added to or removed from the store."
+        return (vectorstore.index.ntotal, len(vectorstore.index_to_docstore_id), _REVISIONS.get(vectorstore, 0))
+
+
+    @staticmethod
+    def bump_revision(vectorstore:FAISS):
+        "Marks the store as modified, invalidating the structures and results derived from it."
+        _REVISIONS[vectorstore] = _REVISIONS.get(vectorstore, 0) + 1
+
+
+    @staticmethod
+    def index_version(vectorstore:FAISS) -> tuple:
+        """
+        Identifies the contents of a vector store: its snapshot id (or a per-object token for stores that
+        were not loaded from a snapshot), its store_version and the index search parameters. Cached results
+        are keyed by it, so they are invalidated when another snapshot is loaded or the store is modified.
+        """
+        manifest = SnapshotUtils.get_manifest(vectorstore) or {}
+        snapshot_id = manifest.get('snapshot_id')
+        if snapshot_id is None:
+            snapshot_id = _STORE_TOKENS.setdefault(vectorstore, uuid.uuid4().hex)
+        search_params = tuple(sorted(IndexUtils.get_search_params(vectorstore.index).items()))
+        return (snapshot_id,) + RetrievalUtils.store_version(vectorstore) + (search_params,)
+
+
+    @staticmethod
+    def embedding_key(vectorstore:FAISS) -> str:
+        "Identifies the model used to embed queries for a vector store."
+        manifest = SnapshotUtils.get_manifest(vectorstore) or {}
+        if 'embedding' in manifest:
+            return json.dumps(manifest['embedding'], sort_keys=True)
+        embeddings = vectorstore.embedding_function
+        return f"{type(embeddings).__name__}:{getattr(embeddings, 'model', '')}"
+
+
+    @staticmethod
+    def normalize_query(query:str) -> str:
+        "Strips and collapses whitespace, which does not change the meaning of a query."
+        return " ".join(query.split())
+
+
+    @staticmethod
+    def derived(vectorstore:FAISS, name:str, build):
+        """
+        Returns the structure `name` derived from the vector store, calling build(vectorstore) the first time
+        and again whenever the store has changed since, so it always covers the same chunks as the store.
+        """
+        cache = _DERIVED.setdefault(vectorstore, {})
+        version = RetrievalUtils.store_version(vectorstore)
+        entry = cache.get(name)
+        if entry is None or entry[0] != version:
+            entry = (version, build(vectorstore))
+            cache[name] = entry
+        return entry[1]
+
+
+    @staticmethod
+    def set_derived(vectorstore:FAISS, name:str, value):
+        "Records a structure derived from the store in its current state, e.g. after updating it in place."
+        _DERIVED.setdefault(vectorstore, {})[name] = (RetrievalUtils.store_version(vectorstore), value)
+
+
+    @staticmethod
+    def update_derived(vectorstore:FAISS, version:tuple, added:list, removed:list):
+        """
+        Marks the store as modified after chunks were appended and removed in place, given as lists of
+        (index position, chunk id, Document). The derived structures that were current at version (the
+        store_version before the change) and have an apply_changes(vectorstore, added, removed) method are
+        updated in place, so the work is proportional to the change; the others are rebuilt on next use.
+        """
+        RetrievalUtils.bump_revision(vectorstore)
+        cache = _DERIVED.get(vectorstore)
+        if cache is None:
+            return
+        new_version = RetrievalUtils.store_version(vectorstore)
+        for name, (entry_version, value) in list(cache.items()):
+            if entry_version == version and hasattr(value, 'apply_changes'):
+                value.apply_changes(vectorstore, added, removed)
+                cache[name] = (new_version, value)
+
+
+    @staticmethod
+    def get_tombstones(vectorstore:FAISS) -> TombstoneSet:
+        "The index positions of deleted chunks whose vectors have not been compacted away yet (see VectorStoreUtils)."
+        def build(vs):
+            if vs.index.ntotal == len(vs.index_to_docstore_id):
+                return TombstoneSet(())
+            live = np.fromiter(vs.index_to_docstore_id.keys(), dtype=np.int64, count=len(vs.index_to_docstore_id))
+            return TombstoneSet(np.setdiff1d(np.arange(vs.index.ntotal, dtype=np.int64), live).tolist())
+
+        return RetrievalUtils.derived(vectorstore, "tombstones", build)
+
+
+    @staticmethod
+    def get_tombstone_selector(vectorstore:FAISS):
+        "Returns a faiss.IDSelector excluding the tombstones of the store (see get_tombstones), or None if there are none."
+        return RetrievalUtils.get_tombstones(vectorstore).selector
+
+
+    @staticmethod
+    def iter_documents(vectorstore:FAISS):
+        "Yields (docstore id, Document) for every vector in the store, in index order."
+        for position in sorted(vectorstore.index_to_docstore_id):
+            doc_id = vectorstore.index_to_docstore_id[position]
+            doc = vectorstore.docstore.search(doc_id)
+            if isinstance(doc, Document):
+                yield doc_id, doc
+
+
+    @staticmethod
+    def get_bm25_index(vectorstore:FAISS) -> BM25Index:
+        """
+        BM25 index over the chunks of the vector store. It is updated in place when chunks are added or removed
+        through VectorStoreUtils, and rebuilt after other changes.
+        """
+        def build(vs):
+            ids, texts = [], []
+            for doc_id, doc in RetrievalUtils.iter_documents(vs):
+                ids.append(doc_id)
+                texts.append(doc.page_content)
+            return BM25Index(ids, texts)
+
+        return RetrievalUtils.derived(vectorstore, "bm25", build)
+
+
+    @staticmethod
+    def get_category_partitions(vectorstore:FAISS) -> dict:
+        """
+        Splits the vector store by the info_category of its chunks (see CategoryPartition), so each category can
+        be searched for exactly its quota of chunks. Updated in place when chunks are added or removed through
+        VectorStoreUtils, and rebuilt after other changes.
+        """
+        def build(vs):
+            positions = defaultdict(dict)
+            for position in sorted(vs.index_to_docstore_id):
+                doc_id = vs.index_to_docstore_id[position]
+                doc = vs.docstore.search(doc_id)
+                if isinstance(doc, Document):
+                    positions[doc.metadata.get('info_category')][position] = doc_id
+            return CategoryPartitions((category, CategoryPartition(cat_positions)) for category, cat_positions in positions.items())
+
+        return RetrievalUtils.derived(vectorstore, "category_partitions", build)
+
+
+    @staticmethod
+    def embed_query(vectorstore:FAISS, query:str, use_cache:bool=True) -> np.ndarray:
+        """
+        Embeds a query as a (1, d) float32 array, normalized if the store uses normalized vectors.
+        With use_cache, repeated queries are served from QUERY_VECTOR_CACHE without calling the embedding model.
+        """
+        def embed():
+            with METRICS.span("embed", kind="query"):
+                vector = np.asarray([vectorstore._embed_query(query)], dtype=np.float32)
+            if vectorstore._normalize_L2:
+                vector = vector / np.linalg.norm(vector, axis=1, keepdims=True)
+            vector.flags.writeable = False
+            return vector
+
+        if not use_cache:
+            return embed()
+        key = (RetrievalUtils.embedding_key(vectorstore), vectorstore._normalize_L2, RetrievalUtils.normalize_query(query))
+        return QUERY_VECTOR_CACHE.get_or_set(key, embed)
+
+
+    @staticmethod
+    async def aembed_query(vectorstore:FAISS, query:str, use_cache:bool=True) -> np.ndarray:
+        "Async version of embed_query, using the embedding model's aembed_query."
+        key = (RetrievalUtils.embedding_key(vectorstore), vectorstore._normalize_L2, RetrievalUtils.normalize_query(query))
+        if use_cache:
+            vector = QUERY_VECTOR_CACHE.get(key)
+            if vector is not None:
+                return vector
+
+        with METRICS.span("embed", kind="query"):
+            vector = np.asarray([await vectorstore._aembed_query(query)], dtype=np.float32)
+        if vectorstore._normalize_L2:
+            vector = vector / np.linalg.norm(vector, axis=1, keepdims=True)
+        vector.flags.writeable = False
+        if use_cache:
+            QUERY_VECTOR_CACHE.set(key, vector)
+        return vector
+
+
+    @staticmethod
+    def dense_search(vectorstore:FAISS, query:str, k:int, min_sim_score=None, use_cache:bool=True) -> list:
+        "Returns up to k (doc_id, distance) pairs from the FAISS index, nearest first."
+        vector = RetrievalUtils.embed_query(vectorstore, query, use_cache=use_cache)
+        results = RetrievalUtils.dense_search_by_vector(vectorstore, vector, k)
+        if not min_sim_score is None:
+            results = [(doc_id, score) for doc_id, score in results if score >= min_sim_score]
+        return results
+
+
+    @staticmethod
+    def dense_search_by_vector(vectorstore:FAISS, vector:np.ndarray, k:int) -> list:
+        selector = RetrievalUtils.get_tombstone_selector(vectorstore)
+        scores, positions = IndexUtils.search(vectorstore.index, vector, k, selector=selector)
+        return [(vectorstore.index_to_docstore_id[int(pos)], float(score))
+                    for pos, score in zip(positions[0], scores[0]) if int(pos) in vectorstore.index_to_docstore_id]
+
+
+    @staticmethod
+    def reciprocal_rank_fusion(rankings:List[list], rrf_k:int=60) -> list:
+        """
+        Fuses several rankings of doc ids: score(d) = sum over rankings of 1 / (rrf_k + rank of d).
+
+        Returns:
+            list: (doc_id, fused score) pairs, best first. Ties keep the order of first appearance.
+        """
+        scores = {}
+        for ranking in rankings:
+            for rank, doc_id in enumerate(ranking, start=1):
+                scores[doc_id] = scores.get(doc_id, 0.0) + 1.0 / (rrf_k + rank)
+        return sorted(scores.items(), key=lambda item: -item[1])
+
+
+    @staticmethod
+    def hybrid_search(vectorstore:FAISS, query:str, k:int, fetch_k:int=None, rrf_k:int=60, min_sim_score=None
+                        , use_cache:bool=True) -> list:
+        """
+        Retrieves fetch_k candidates with FAISS and with BM25 over the same chunks,
+        fuses both rankings with reciprocal-rank fusion and returns the top k (doc_id, fused score) pairs.
+        """
+        if fetch_k is None:
+            fetch_k = max(2 * k, 20)
+
+        dense = RetrievalUtils.dense_search(vectorstore, query, fetch_k, min_sim_score=min_sim_score, use_cache=use_cache)
+        lexical = RetrievalUtils.get_bm25_index(vectorstore).search(query, fetch_k)
+
+        fused = RetrievalUtils.reciprocal_rank_fusion([[doc_id for doc_id, _ in dense]
+                                                        , [doc_id for doc_id, _ in lexical]], rrf_k=rrf_k)
+        return fused[:k]
+
+
+    @staticmethod
+    def category_search(vectorstore:FAISS, query:str, quotas:dict=None, hybrid:bool=False, fetch_k:int=None
+                        , rrf_k:int=60, min_sim_score=None, use_cache:bool=True) -> dict:
+        """
+        Retrieves quotas[category] chunks from each info_category with one search per category partition,
+        embedding the query only once. With hybrid=True, each partition is searched with FAISS and BM25
+        and the rankings are fused as in hybrid_search.
+
+        Returns:
+            dict: category -> list of (doc_id, score) pairs, best first. Categories missing from the store
+                have an empty list.
+        """
+        if quotas is None:
+            quotas = DEFAULT_CATEGORY_QUOTAS
+
+        partitions = RetrievalUtils.get_category_partitions(vectorstore)
+        vector = RetrievalUtils.embed_query(vectorstore, query, use_cache=use_cache)
+
+        results = {}
+        for category, quota in quotas.items():
+            partition = partitions.get(category)
+            if partition is None or quota <= 0:
+                results[category] = []
+                continue
+
+            n_candidates = quota if not hybrid else (fetch_k or max(2 * quota, 20))
+            dense = partition.search(vectorstore, vector, n_candidates)
+            if not min_sim_score is None:
+                dense = [(doc_id, score) for doc_id, score in dense if score >= min_sim_score]
+
+            if hybrid:
+                lexical = partition.bm25(vectorstore).search(query, n_candidates)
+                dense = RetrievalUtils.reciprocal_rank_fusion([[doc_id for doc_id, _ in dense]
+                                                                , [doc_id for doc_id, _ in lexical]], rrf_k=rrf_k)
+            results[category] = dense[:quota]
+
+        return results
+
+
+    @staticmethod
+    def retrieve(vectorstore:FAISS, query:str, k:int=5, min_sim_score=None, hybrid:bool=False, fetch_k:int=None
+                    , category_quotas:dict=None, use_cache:bool=True) -> list:
+        """
+        Returns the docstore ids of the chunks retrieved for a query, best first: the top k by FAISS
+        similarity, by hybrid_search (hybrid=True), or the category_quotas per info_category (see category_search).
+
+        With use_cache, the ids are cached in RETRIEVAL_CACHE under the index version, the normalized query and
+        the search parameters, so repeated requests skip both the query embedding and the searches.
+        """
+        with METRICS.span("search", k=k, hybrid=hybrid, quotas=category_quotas is not None) as span:
+            def search():
+                span.set(cached=False)
+                return RetrievalUtils._search(vectorstore, query, k, min_sim_score, hybrid, fetch_k, category_quotas, use_cache)
+
+            span.set(cached=True)
+            if not use_cache:
+                doc_ids = list(search())
+            else:
+                key = RetrievalUtils._retrieval_key(vectorstore, query, k, min_sim_score, hybrid, fetch_k, category_quotas)
+                doc_ids = list(RETRIEVAL_CACHE.get_or_set(key, search))
+            span.set(n_docs=len(doc_ids))
+            return doc_ids
+
+
+    @staticmethod
+    async def aretrieve(vectorstore:FAISS, query:str, k:int=5, min_sim_score=None, hybrid:bool=False, fetch_k:int=None
+                            , category_quotas:dict=None, use_cache:bool=True) -> list:
+        """
+        Async version of retrieve. Cached results are returned without blocking; otherwise the query is embedded
+        with aembed_query and the FAISS and BM25 searches run in a worker thread, so the event loop keeps serving
+        other requests. With use_cache=False, the query is embedded in the worker thread too.
+        """
+        args = (vectorstore, query, k, min_sim_score, hybrid, fetch_k, category_quotas)
+        with METRICS.span("search", k=k, hybrid=hybrid, quotas=category_quotas is not None) as span:
+            if not use_cache:
+                doc_ids = await asyncio.to_thread(RetrievalUtils._search, *args, use_cache)
+                span.set(cached=False)
+            else:
+                key = RetrievalUtils._retrieval_key(*args)
+                doc_ids = RETRIEVAL_CACHE.get(key)
+                span.set(cached=doc_ids is not None)
+                if doc_ids is None:
+                    ## Puts the query vector in QUERY_VECTOR_CACHE, where the searches find it
+                    await RetrievalUtils.aembed_query(vectorstore, query)
+                    doc_ids = await asyncio.to_thread(RetrievalUtils._search, *args, use_cache)
+                    RETRIEVAL_CACHE.set(key, doc_ids)
+            span.set(n_docs=len(doc_ids))
+            return list(doc_ids)
+
+
+    @staticmethod
+    def _search(vectorstore:FAISS, query:str, k:int, min_sim_score, hybrid:bool, fetch_k:int, category_quotas:dict
+                    , use_cache:bool) -> tuple:
+        if not category_quotas is None:
+            by_category = RetrievalUtils.category_search(vectorstore, query, quotas=category_quotas, hybrid=hybrid
+                                                            , fetch_k=fetch_k, min_sim_score=min_sim_score
+                                                            , use_cache=use_cache)
+            return tuple(doc_id for results in by_category.values() for doc_id, _ in results)
+        if hybrid:
+            results = RetrievalUtils.hybrid_search(vectorstore, query, k=k, fetch_k=fetch_k
+                                                    , min_sim_score=min_sim_score, use_cache=use_cache)
+        else:
+            results = RetrievalUtils.dense_search(vectorstore, query, k, min_sim_score=min_sim_score, use_cache=use_cache)
+        return tuple(doc_id for doc_id, _ in results)
+
+
+    @staticmethod
+    def _retrieval_key(vectorstore:FAISS, query:str, k:int, min_sim_score, hybrid:bool, fetch_k:int, category_quotas:dict) -> tuple:
+        quotas = None if category_quotas is None else tuple(category_quotas.items())
+        return (RetrievalUtils.index_version(vectorstore), RetrievalUtils.normalize_query(query)
+                , k if quotas is None else None, min_sim_score, hybrid, fetch_k, quotas)
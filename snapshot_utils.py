@@ -0,0 +1,248 @@
+import hashlib
+import json
+import os
+import shutil
+import uuid
+import weakref
+from datetime import datetime, timezone
+from pathlib import Path
+
+from langchain_community.vectorstores import FAISS
+
+from index_utils import IndexUtils, DEFAULT_INDEX_CONFIG
+
+
+
+PARENT_DIR = Path(__file__).resolve().parent
+
+DEFAULT_STORE_PATH = os.path.join(PARENT_DIR, "data/faiss_store")
+MANIFEST_NAME = "manifest.json"
+MANIFEST_VERSION = 1
+INDEX_NAME = "index"
+
+## Manifest fields that must match for a snapshot to be reused
+COMPATIBILITY_FIELDS = ["manifest_version", "corpus_hash", "embedding", "chunking", "index"]
+
+## Values of compatibility fields missing from manifests written before the field existed
+_FIELD_DEFAULTS = {'index': DEFAULT_INDEX_CONFIG}
+
+## Manifests of the vector stores that were loaded or saved in this process
+_MANIFESTS = weakref.WeakKeyDictionary()
+
+
+class SnapshotUtils:
+
+
+    @staticmethod
+    def file_sha256(path, block_size:int=1 << 20) -> str:
+        "Returns the sha256 hex digest of a file."
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(block_size), b""):
+                digest.update(block)
+        return digest.hexdigest()
+
+
+    @staticmethod
+    def build_manifest(sources:list, embedding:dict, chunking:dict, **extra) -> dict:
+        """
+        Builds the manifest describing the index that the given inputs would produce.
+
+        Args:
+            sources (list): Records with 'source_doc', 'source' and 'info_category' keys. Local files
+                are hashed; remote sources (source_doc is None) are recorded by URL only.
+            embedding (dict): Embedding model configuration (e.g. {'model': 'text-embedding-ada-002'}).
+            chunking (dict): Text splitter parameters.
+
+        Returns:
+            dict: The manifest. Build-specific fields (snapshot_id, created_at, ...) are added on save.
+        """
+        corpus = []
+        for src in sources:
+            entry = dict(src)
+            source_doc = entry.get('source_doc')
+            entry['sha256'] = SnapshotUtils.file_sha256(source_doc) if source_doc and os.path.exists(source_doc) else None
+            if source_doc:
+                ## Paths are stored relative to the project so snapshots survive moving the checkout.
+                entry['source_doc'] = os.path.relpath(source_doc, PARENT_DIR)
+            corpus.append(entry)
+
+        corpus_hash = hashlib.sha256(json.dumps(corpus, sort_keys=True).encode("utf-8")).hexdigest()
+
+        manifest = {
+            'manifest_version': MANIFEST_VERSION
+            , 'corpus': corpus
+            , 'corpus_hash': corpus_hash
+            , 'embedding': embedding
+            , 'chunking': chunking
+        }
+        manifest.update(extra)
+        return manifest
+
+
+    @staticmethod
+    def is_compatible(manifest:dict, expected:dict, fields:list=None) -> bool:
+        "Checks whether a saved snapshot manifest matches the expected build inputs (on fields, COMPATIBILITY_FIELDS by default)."
+        if expected is None:
+            return manifest.get('manifest_version') == MANIFEST_VERSION
+        if fields is None:
+            fields = COMPATIBILITY_FIELDS
+        return all(manifest.get(field, _FIELD_DEFAULTS.get(field)) == expected.get(field, _FIELD_DEFAULTS.get(field))
+                    for field in fields)
+
+
+    @staticmethod
+    def get_manifest(vectorstore:FAISS):
+        "Returns the manifest of a vector store loaded or saved through SnapshotUtils, or None."
+        return _MANIFESTS.get(vectorstore)
+
+
+    @staticmethod
+    def set_manifest(vectorstore:FAISS, manifest:dict):
+        _MANIFESTS[vectorstore] = manifest
+
+
+    @staticmethod
+    def save_snapshot(vectorstore:FAISS, manifest:dict, store_path:str=None, keep_last:int=3) -> str:
+        """
+        Saves a vector store as a new snapshot directory under store_path.
+
+        The snapshot is written to a temporary directory first and renamed into place, so a crashed or
+        interrupted build never leaves a half-written snapshot behind.
+
+        Returns:
+            str: Path of the new snapshot directory.
+        """
+        if store_path is None:
+            store_path = DEFAULT_STORE_PATH
+        os.makedirs(store_path, exist_ok=True)
+
+        created_at = datetime.now(timezone.utc)
+        snapshot_id = f"{created_at.strftime('%Y%m%dT%H%M%S%fZ')}-{manifest.get('corpus_hash', '')[:8]}"
+        tmp_path = os.path.join(store_path, f".tmp-{uuid.uuid4().hex}")
+        final_path = os.path.join(store_path, snapshot_id)
+
+        try:
+            vectorstore.save_local(tmp_path, index_name=INDEX_NAME)
+
+            manifest = dict(manifest)
+            manifest['snapshot_id'] = snapshot_id
+            manifest['created_at'] = created_at.isoformat()
+            manifest['num_vectors'] = int(vectorstore.index.ntotal)
+            manifest['files'] = {
+                fname: {
+                    'size': os.path.getsize(os.path.join(tmp_path, fname))
+                    , 'sha256': SnapshotUtils.file_sha256(os.path.join(tmp_path, fname))
+                }
+                for fname in (f"{INDEX_NAME}.faiss", f"{INDEX_NAME}.pkl")
+            }
+
+            with open(os.path.join(tmp_path, MANIFEST_NAME), "w", encoding="utf-8") as f:
+                json.dump(manifest, f, indent=2)
+
+            os.replace(tmp_path, final_path)
+        except Exception:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+
+        SnapshotUtils.set_manifest(vectorstore, manifest)
+
+        if keep_last is not None:
+            SnapshotUtils.prune_snapshots(store_path, keep_last=keep_last)
+
+        return final_path
+
+
+    @staticmethod
+    def list_snapshots(store_path:str=None) -> list:
+        "Returns (path, manifest) pairs for all complete snapshots under store_path, newest first."
+        if store_path is None:
+            store_path = DEFAULT_STORE_PATH
+        if not os.path.isdir(store_path):
+            return []
+
+        snapshots = []
+        for name in os.listdir(store_path):
+            path = os.path.join(store_path, name)
+            manifest = None if name.startswith(".") else SnapshotUtils.read_manifest(path)
+            if manifest is not None:
+                snapshots.append((path, manifest))
+
+        return sorted(snapshots, key=lambda snap: snap[1].get('created_at', ''), reverse=True)
+
+
+    @staticmethod
+    def read_manifest(path:str):
+        "Returns the manifest of a snapshot directory, or None if it has none (or it cannot be read)."
+        manifest_path = os.path.join(path, MANIFEST_NAME)
+        if not os.path.isfile(manifest_path):
+            return None
+        try:
+            with open(manifest_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+
+    @staticmethod
+    def prune_snapshots(store_path:str=None, keep_last:int=3):
+        "Deletes all but the keep_last newest snapshots."
+        for path, _ in SnapshotUtils.list_snapshots(store_path)[keep_last:]:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+    @staticmethod
+    def validate_snapshot(path:str, manifest:dict, verify_checksums:bool=False) -> bool:
+        "Checks that the files listed in a snapshot manifest exist and are intact."
+        for fname, info in manifest.get('files', {}).items():
+            fpath = os.path.join(path, fname)
+            if not os.path.isfile(fpath) or os.path.getsize(fpath) != info.get('size'):
+                return False
+            if verify_checksums and SnapshotUtils.file_sha256(fpath) != info.get('sha256'):
+                return False
+        return len(manifest.get('files', {})) > 0
+
+
+    @staticmethod
+    def load_snapshot(path:str, embeddings, manifest:dict=None) -> FAISS:
+        """
+        Loads a single snapshot directory (or a plain FAISS.save_local directory).
+        The search parameters recorded in the manifest ('index_search', e.g. nprobe or ef_search) are applied to the index.
+        """
+        vectorstore = FAISS.load_local(path, embeddings, index_name=INDEX_NAME
+                                        , allow_dangerous_deserialization=True  ## We only load snapshots we wrote
+                                    )
+        IndexUtils.prepare_index(vectorstore.index)
+        if manifest is not None:
+            if vectorstore.index.ntotal != manifest.get('num_vectors'):
+                raise ValueError(f"Snapshot {path} is corrupt: expected {manifest.get('num_vectors')} vectors, found {vectorstore.index.ntotal}.")
+            IndexUtils.set_search_params(vectorstore.index, **manifest.get('index_search', {}))
+            SnapshotUtils.set_manifest(vectorstore, manifest)
+        return vectorstore
+
+
+    @staticmethod
+    def load_latest(embeddings, store_path:str=None, expected_manifest:dict=None, verify_checksums:bool=False
+                    , fields:list=None):
+        """
+        Loads the newest snapshot under store_path that is compatible with expected_manifest
+        (compared on fields, COMPATIBILITY_FIELDS by default).
+
+        Returns:
+            FAISS or None: The vector store, or None if no valid compatible snapshot exists.
+        """
+        for path, manifest in SnapshotUtils.list_snapshots(store_path):
+            if not SnapshotUtils.is_compatible(manifest, expected_manifest, fields=fields):
+                continue
+            if not SnapshotUtils.validate_snapshot(path, manifest, verify_checksums=verify_checksums):
+                print(f"Skipping invalid snapshot: {path}")
+                continue
+            try:
+                vectorstore = SnapshotUtils.load_snapshot(path, embeddings, manifest=manifest)
+            except Exception as exp:
+                print(f"Skipping snapshot that failed to load: {path} ({exp})")
+                continue
+            print(f"Loaded FAISS snapshot {manifest['snapshot_id']}")
+            return vectorstore
+
+        return None
@@ -0,0 +1,9 @@
+import os
+import sys
+
+## The modules of the project are imported from its root, as the app and the scripts do
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+## Tests never call remote embedding models or fetch pages
+os.environ.setdefault("RAG_IEP_EMBEDDING_BACKEND", "hashing")
+os.environ.setdefault("RAG_IEP_OFFLINE", "1")
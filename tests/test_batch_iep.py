@@ -0,0 +1,75 @@
+import json
+
+from langchain_core.messages import AIMessage
+
+from batch_iep import FAKE_GOALS, read_checkpoint, run_batch
+from rag_utils import StudentProfile
+
+
+class FakeAgent:
+    "Stands in for My_IEP_Goal_Generator: no documents are retrieved and every student gets FAKE_GOALS."
+
+    def __init__(self, retrieval_failures=0):
+        self.generated = []
+        self.retrieval_failures = retrieval_failures
+
+    def retrieve_documents(self, career_suggestions, hybrid=True, category_quotas=None):
+        if self.retrieval_failures > 0:
+            self.retrieval_failures -= 1
+            raise TimeoutError("embedding request timed out")
+        return []
+
+    def generate_iep_goals(self, profile, relevant_docs=None):
+        self.generated.append(profile.name)
+        return AIMessage(content=FAKE_GOALS), relevant_docs
+
+
+def records(n):
+    return [(f"s{i}", StudentProfile(name=f"Student {i}", age=16, grade=10, career_interest_or_category="Welding"
+                                        , learning_preferences="", onnet_results="", career_suggestions="Welder"
+                                        , preferred_employers=""))
+            for i in range(n)]
+
+
+def test_read_checkpoint_drops_truncated_line(tmp_path):
+    path = tmp_path / "goals.jsonl"
+    path.write_text(json.dumps({'id': "s0", 'status': "ok"}) + "\n" + '{"id": "s1", "sta', encoding="utf-8")
+
+    assert list(read_checkpoint(str(path))) == ["s0"]
+    assert path.read_text(encoding="utf-8").endswith("}\n")
+
+
+def test_run_batch_resumes_after_truncated_line(tmp_path):
+    path = tmp_path / "goals.jsonl"
+    agent = FakeAgent()
+    assert run_batch(agent, records(2), str(path), max_workers=2)['ok'] == 2
+
+    ## An interrupted run leaves a partial record, and an error to retry
+    lines = {json.loads(line)['id']: line for line in path.read_text(encoding="utf-8").splitlines()}
+    error = dict(json.loads(lines["s1"]), status="error")
+    path.write_text(lines["s0"] + "\n" + json.dumps(error) + "\n" + lines["s1"][:20], encoding="utf-8")
+
+    agent = FakeAgent()
+    stats = run_batch(agent, records(4), str(path), max_workers=2)
+
+    done = read_checkpoint(str(path))
+    assert stats == {'ok': 3, 'skipped': 1, 'retrievals': 1}
+    assert sorted(agent.generated) == ["Student 1", "Student 2", "Student 3"]
+    assert sorted(done) == ["s0", "s1", "s2", "s3"]
+    assert all(record['status'] == "ok" for record in done.values())
+
+
+def test_run_batch_records_retrieval_errors(tmp_path):
+    path = tmp_path / "goals.jsonl"
+    agent = FakeAgent(retrieval_failures=1)
+    stats = run_batch(agent, records(3), str(path), max_workers=2)
+
+    done = read_checkpoint(str(path))
+    assert stats == {'error': 1, 'ok': 2, 'skipped': 0, 'retrievals': 1}
+    assert done["s0"]['status'] == "error" and "TimeoutError" in done["s0"]['error']
+    assert sorted(agent.generated) == ["Student 1", "Student 2"]
+
+    ## The failed student is retried on resume
+    stats = run_batch(FakeAgent(), records(3), str(path), max_workers=2)
+    assert stats == {'ok': 1, 'skipped': 2, 'retrievals': 1}
+    assert all(record['status'] == "ok" for record in read_checkpoint(str(path)).values())
@@ -0,0 +1,82 @@
+from langchain_core.documents.base import Document
+
+from chunk_utils import OffsetDocstore, StructureChunker, TextStore
+
+
+SOURCE = "profile.html\0"
+
+
+def test_text_store_round_trip():
+    store = TextStore()
+    text = "Welders join metal parts. They work in factories and on construction sites."
+    spans = [(0, text[0:40]), (26, text[26:]), (10, text[10:30])]
+    refs = store.add(SOURCE, spans)
+
+    assert [store.text(ref) for ref in refs] == [span_text for _, span_text in spans]
+    ## Overlapping chunks share their text
+    assert store.n_chars() == len(text)
+
+    for ref in refs:
+        store.release(ref)
+    assert store.n_chars() == 0
+
+
+def test_text_store_contradicting_spans():
+    store = TextStore()
+    first = store.add(SOURCE, [(0, "hello world")])
+    ## Overlaps the stored text with different characters, in a later call and within the same call
+    later = store.add(SOURCE, [(6, "there")])
+    same_call = store.add("other.html\0", [(0, "abcdef"), (3, "xyz")])
+
+    assert store.text(first[0]) == "hello world"
+    assert store.text(later[0]) == "there"
+    assert [store.text(ref) for ref in same_call] == ["abcdef", "xyz"]
+    assert later[0].source_id != first[0].source_id
+
+    for ref in first + later + same_call:
+        store.release(ref)
+    assert store.n_chars() == 0
+
+
+def test_offset_docstore_delete_is_atomic():
+    docstore = OffsetDocstore()
+    docstore.add({"a": Document(page_content="some text", metadata={'source': "a.html", 'start_index': 0})})
+
+    try:
+        docstore.delete(["a", "missing"])
+        assert False, "Deleting a missing id should fail"
+    except ValueError:
+        pass
+    assert docstore.search("a").page_content == "some text"
+
+    docstore.delete(["a"])
+    assert len(docstore) == 0
+    assert docstore.stats()['stored_chars'] == 0
+
+
+def test_structure_chunker_bounds_and_coverage():
+    sections = []
+    for i in range(6):
+        paragraphs = [" ".join(f"word{i}{j}{k}" for k in range(8 + 7 * j)) + "." for j in range(5)]
+        sections.append(f"Section {i}\n\n" + "\n\n".join(paragraphs))
+    ## A single word longer than a chunk must still be split
+    sections.append("Last\n\n" + "x" * 250)
+    text = "\n\n".join(sections)
+    headings = [(text.index(f"Section {i}\n"), 1, f"Section {i}") for i in range(6)] + [(text.index("Last\n"), 1, "Last")]
+
+    chunker = StructureChunker(chunk_size=120, chunk_overlap=0)
+    chunks = chunker.split_documents([Document(page_content=text, metadata={'source': "a.html", 'headings': headings})])
+
+    covered = [False] * len(text)
+    for chunk in chunks:
+        start = chunk.metadata['start_index']
+        assert 0 < len(chunk.page_content) <= 120
+        assert text[start:start + len(chunk.page_content)] == chunk.page_content
+        assert not 'headings' in chunk.metadata
+        for position in range(start, start + len(chunk.page_content)):
+            covered[position] = True
+    assert all(covered[position] for position, char in enumerate(text) if not char.isspace())
+
+    starts = [chunk.metadata['start_index'] for chunk in chunks]
+    assert starts == sorted(starts)
+    assert chunks[0].metadata['section'] == "Section 0"
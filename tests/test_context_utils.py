@@ -0,0 +1,41 @@
+from langchain_core.documents.base import Document
+
+from chunk_utils import StructureChunker
+from context_utils import ContextUtils
+
+
+TEXT = "\n\n".join(" ".join(f"paragraph{i} word{j}" for j in range(6)) + "." for i in range(6))
+
+
+def chunks():
+    chunker = StructureChunker(chunk_size=120, chunk_overlap=0)
+    return chunker.split_documents([Document(page_content=TEXT, metadata={'source': "a.html", 'info_category': 'career_profile'})])
+
+
+def test_merge_consecutive_structure_chunks():
+    split = chunks()
+    assert len(split) == 6
+    first, second = split[1], split[2]
+    ## The chunks are trimmed, so consecutive chunks are separated by whitespace
+    assert second.metadata['start_index'] > first.metadata['start_index'] + len(first.page_content)
+
+    blocks = ContextUtils.merge_chunks([split[4], second, first])
+    assert [block.page_content for block in blocks] == [split[4].page_content, first.page_content + " " + second.page_content]
+    assert blocks[1].metadata['start_index'] == first.metadata['start_index']
+
+
+def test_merge_keeps_chunks_apart_when_text_is_missing_between():
+    split = chunks()
+    blocks = ContextUtils.merge_chunks([split[0], split[2]])
+    assert [block.page_content for block in blocks] == [split[0].page_content, split[2].page_content]
+
+
+def test_merge_consecutive_then_overlapping():
+    split = chunks()
+    end = split[1].metadata['start_index'] + len(split[1].page_content)
+    ## A chunk overlapping the end of a joined block only adds the text that is not in it yet
+    overlapping = Document(page_content=TEXT[end - 10:end + 20], metadata=dict(split[1].metadata, start_index=end - 10
+                                                                                , chunk_index=None))
+    blocks = ContextUtils.merge_chunks([split[0], split[1], overlapping])
+    assert len(blocks) == 1
+    assert blocks[0].page_content == split[0].page_content + " " + split[1].page_content + TEXT[end:end + 20]
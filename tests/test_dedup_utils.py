@@ -0,0 +1,58 @@
+import gc
+import weakref
+
+from langchain_core.documents.base import Document
+
+from dedup_utils import ChunkDeduplicator
+
+
+def chunk(text, source, page=None):
+    return Document(page_content=text, metadata={'source': source, 'page': page, 'info_category': 'career_profile'})
+
+
+LONG_TEXT = ("Workers in this occupation must follow safety rules and wear protective equipment at all times on the "
+             "job site, including hard hats, gloves, goggles and steel toe boots, and they must report any hazard "
+             "they notice to their supervisor before the start of their shift.")
+
+
+def test_exact_duplicates():
+    deduplicator = ChunkDeduplicator()
+    chunks = [chunk(LONG_TEXT, "a.html"), chunk("  " + LONG_TEXT.replace(" ", "\n", 3), "b.html"), chunk(LONG_TEXT, "a.html", 2)]
+    kept = list(deduplicator.filter(chunks))
+
+    assert kept == [chunks[0]]
+    assert [citation['source'] for citation in kept[0].metadata['sources']] == ["a.html", "b.html", "a.html"]
+    assert deduplicator.stats()['exact_duplicates'] == 2
+
+
+def test_near_duplicates():
+    deduplicator = ChunkDeduplicator(threshold=0.8)
+    near = LONG_TEXT.replace("supervisor", "manager")
+    other = "Electricians install and maintain the wiring of homes, factories and businesses."
+    chunks = [chunk(LONG_TEXT, "a.html"), chunk(near, "b.html"), chunk(other, "c.html")]
+    kept = list(deduplicator.filter(chunks))
+
+    assert kept == [chunks[0], chunks[2]]
+    assert [citation['source'] for citation in kept[0].metadata['sources']] == ["a.html", "b.html"]
+    assert ChunkDeduplicator.citations(kept[1].metadata) == [{'source': "c.html", 'info_category': 'career_profile'}]
+    assert deduplicator.stats()['near_duplicates'] == 1
+
+
+def test_exact_only():
+    deduplicator = ChunkDeduplicator(threshold=None)
+    chunks = [chunk(LONG_TEXT, "a.html"), chunk(LONG_TEXT.replace("supervisor", "manager"), "b.html")]
+    assert list(deduplicator.filter(chunks)) == chunks
+
+
+def test_kept_chunks_are_not_retained():
+    deduplicator = ChunkDeduplicator()
+    kept = chunk(LONG_TEXT, "a.html")
+    reference = weakref.ref(kept)
+    sources = next(deduplicator.filter([kept])).metadata['sources']
+    del kept
+    gc.collect()
+    assert reference() is None
+
+    ## The sources list of the yielded chunk is still extended by later duplicates
+    assert list(deduplicator.filter([chunk(LONG_TEXT, "b.html")])) == []
+    assert [citation['source'] for citation in sources] == ["a.html", "b.html"]
@@ -0,0 +1,121 @@
+import numpy as np
+import pytest
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores import FAISS
+from langchain_core.documents.base import Document
+
+from dedup_utils import ChunkDeduplicator
+from embedding_utils import embedding_config
+from index_utils import IndexUtils, index_config
+from rag_utils import RAGUtils
+from retrieval_utils import RetrievalUtils
+from vectorstore_utils import VectorStoreUtils
+
+
+SHARED = "Workers in this occupation must follow safety rules and wear protective equipment at all times on the job site."
+
+TEXTS = {
+    'a.html': ["Welders join metal parts using heat and filler material in factories.", SHARED
+                , "Welders often work overtime and on weekends during busy periods."]
+    , 'b.html': ["Electricians install and maintain wiring in homes and businesses.", SHARED]
+}
+
+
+def source_chunks(source, texts):
+    return [Document(page_content=text, metadata={'source': source, 'info_category': 'career_profile', 'start_index': 1000 * i})
+            for i, text in enumerate(texts)]
+
+
+def texts_of(vectorstore, source):
+    return sorted(vectorstore.docstore.search(doc_id).page_content
+                    for doc_id in VectorStoreUtils.get_source_chunks(vectorstore).get(source, []))
+
+
+@pytest.fixture
+def vectorstore(tmp_path):
+    corpus = [chunk for source, texts in TEXTS.items() for chunk in source_chunks(source, texts)]
+    return RAGUtils.create_and_save_embeddings(ChunkDeduplicator().filter(corpus), None, store_path=str(tmp_path)
+                                                , manifest={'embedding': embedding_config("hashing")}, use_cache=False)
+
+
+def test_upsert_unchanged_source(vectorstore):
+    assert texts_of(vectorstore, 'b.html') == sorted(TEXTS['b.html'][:1])
+
+    ## Deduplicating the source on its own does not reproduce the sources cited across the corpus
+    documents = ChunkDeduplicator().filter(source_chunks('a.html', TEXTS['a.html']))
+    changes = VectorStoreUtils.upsert_source(vectorstore, 'a.html', documents)
+
+    assert changes == {'added': 0, 'deleted': 0, 'unchanged': 3, 'cited_sources': []}
+    assert VectorStoreUtils.n_tombstones(vectorstore) == 0
+
+
+def test_upsert_modified_source(vectorstore):
+    ## Builds the derived structures, which are then updated in place
+    RetrievalUtils.retrieve(vectorstore, "welders overtime", hybrid=True, use_cache=False)
+
+    texts = [TEXTS['a.html'][0], "Welders may work night shifts in shipyards."]
+    changes = VectorStoreUtils.upsert_source(vectorstore, 'a.html', source_chunks('a.html', texts), compact_threshold=None)
+
+    assert changes == {'added': 1, 'deleted': 2, 'unchanged': 1, 'cited_sources': ['b.html']}
+    assert texts_of(vectorstore, 'a.html') == sorted(texts)
+    assert VectorStoreUtils.n_tombstones(vectorstore) == 2
+
+    found = [vectorstore.docstore.search(doc_id).page_content
+                for doc_id in RetrievalUtils.retrieve(vectorstore, "night shifts shipyards", k=5, hybrid=True, use_cache=False)]
+    assert "Welders may work night shifts in shipyards." in found
+    assert not SHARED in found
+    assert RetrievalUtils.get_bm25_index(vectorstore).search("overtime") == []
+
+    ## The shared paragraph is restored by re-running the source that cites it
+    changes = VectorStoreUtils.upsert_source(vectorstore, 'b.html', source_chunks('b.html', TEXTS['b.html']), compact_threshold=None)
+    assert changes['added'] == 1
+    assert texts_of(vectorstore, 'b.html') == sorted(TEXTS['b.html'])
+
+
+def test_compact(vectorstore):
+    ids = VectorStoreUtils.get_source_chunks(vectorstore)['a.html']
+    VectorStoreUtils.delete(vectorstore, ids[:2], compact_threshold=None)
+    assert VectorStoreUtils.n_tombstones(vectorstore) == 2
+
+    assert VectorStoreUtils.compact(vectorstore) == 2
+    assert VectorStoreUtils.n_tombstones(vectorstore) == 0
+    assert vectorstore.index.ntotal == len(vectorstore.index_to_docstore_id) == 2
+    assert sorted(vectorstore.index_to_docstore_id) == [0, 1]
+    assert texts_of(vectorstore, 'a.html') == [TEXTS['a.html'][2]]
+
+    doc_ids = RetrievalUtils.retrieve(vectorstore, TEXTS['a.html'][2], k=1, use_cache=False)
+    assert doc_ids == [ids[2]]
+
+
+def index_store(config, n=2000, dim=32):
+    vectors = np.random.default_rng(0).standard_normal((n, dim)).astype(np.float32)
+    index, _ = IndexUtils.build_index(config, vectors)
+    index.add(vectors)
+    ids = [str(i) for i in range(n)]
+    docstore = InMemoryDocstore({doc_id: Document(id=doc_id, page_content=doc_id, metadata={'source': 'a.html'}) for doc_id in ids})
+    return FAISS(None, index, docstore, dict(enumerate(ids)))
+
+
+def test_compact_keeps_ivfpq_codes():
+    vectorstore = index_store(index_config("ivfpq", nlist=16))
+    ids = list(vectorstore.index_to_docstore_id.values())
+    live = np.arange(1, 2000, 2)
+    before = vectorstore.index.reconstruct_batch(live)
+
+    VectorStoreUtils.delete(vectorstore, ids[::2], compact_threshold=None)
+    assert VectorStoreUtils.compact(vectorstore) == 1000
+
+    ## The codes are not re-encoded, so the remaining vectors do not drift
+    assert vectorstore.index.ntotal == 1000
+    assert np.array_equal(vectorstore.index.reconstruct_batch(np.arange(1000)), before)
+    assert [vectorstore.index_to_docstore_id[pos] for pos in range(3)] == ['1', '3', '5']
+
+
+def test_hnsw_is_not_compacted_by_default():
+    vectorstore = index_store(index_config("hnsw"), n=200)
+    ids = list(vectorstore.index_to_docstore_id.values())
+    VectorStoreUtils.delete(vectorstore, ids[:100])
+    assert VectorStoreUtils.n_tombstones(vectorstore) == 100
+
+    VectorStoreUtils.delete(vectorstore, ids[100:110], compact_threshold=0.2)
+    assert VectorStoreUtils.n_tombstones(vectorstore) == 0
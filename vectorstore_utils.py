@@ -0,0 +1,340 @@
+from typing import List
+
+import faiss
+import numpy as np
+from faiss.contrib.inspect_tools import get_invlist
+from langchain_community.vectorstores import FAISS
+from langchain_core.documents.base import Document
+
+from data_utils import DataProcessor
+from dedup_utils import ChunkDeduplicator
+from index_utils import IndexUtils
+from retrieval_utils import RetrievalUtils
+
+
+
+## Fraction of deleted vectors in the index above which it is compacted
+DEFAULT_COMPACT_THRESHOLD = 0.2
+
+## Number of vectors reconstructed at a time when an HNSW index is compacted
+_COMPACT_BATCH_SIZE = 65536
+
+
+class VectorStoreUtils:
+    """
+    Adds, replaces and removes the chunks of single sources in a FAISS vector store, without rebuilding it.
+
+    Chunks are identified by their stable ids (see DataProcessor.chunk_id). Removing a chunk only drops it from
+    the docstore and from index_to_docstore_id, which leaves a tombstone: its vector stays in the FAISS index,
+    but is excluded from searches (see RetrievalUtils.get_tombstone_selector). New vectors are always appended
+    at the end of the index. Tombstones are cleared by compact(), which runs once they make up more than
+    compact_threshold of the index ('auto': DEFAULT_COMPACT_THRESHOLD, or never for HNSW indexes, see
+    get_compact_threshold). The tombstones are saved with the store, since they are just positions missing
+    from index_to_docstore_id.
+
+    The structures derived from the store (the tombstones, the BM25 index and the category partitions, see
+    RetrievalUtils.update_derived) are updated with the chunks added and removed, rather than rebuilt. Compaction
+    renumbers the index positions, so they are rebuilt after it.
+
+    Stores must only be modified through these methods once they contain tombstones: FAISS.add_embeddings
+    assumes that the index positions are dense.
+    """
+
+
+    @staticmethod
+    def get_source_chunks(vectorstore:FAISS) -> dict:
+        "Returns {source key (see DataProcessor.source_key): [chunk ids]} for the chunks in the store."
+        def build(vs):
+            source_chunks = {}
+            for doc_id, doc in RetrievalUtils.iter_documents(vs):
+                source_chunks.setdefault(DataProcessor.source_key(doc.metadata), []).append(doc_id)
+            return source_chunks
+
+        return RetrievalUtils.derived(vectorstore, "source_chunks", build)
+
+
+    @staticmethod
+    def get_positions(vectorstore:FAISS) -> dict:
+        "Returns {chunk id: index position}."
+        return RetrievalUtils.derived(vectorstore, "positions"
+                                        , lambda vs: {doc_id: pos for pos, doc_id in vs.index_to_docstore_id.items()})
+
+
+    @staticmethod
+    def cited_sources(vectorstore:FAISS, ids:List[str]) -> list:
+        """
+        Returns the keys of the sources other than their own that the given chunks cite (see ChunkDeduplicator.citations).
+        Their duplicates were dropped in favour of these chunks, so they must be re-run when the chunks are deleted,
+        or their text is lost (see RAGUtils.update_vectorstore).
+        """
+        cited = {}
+        for doc_id in ids:
+            doc = vectorstore.docstore.search(doc_id)
+            if not isinstance(doc, Document):
+                continue
+            own = DataProcessor.source_key(doc.metadata)
+            for citation in ChunkDeduplicator.citations(doc.metadata):
+                key = DataProcessor.source_key(citation)
+                if key != own:
+                    cited[key] = None
+        return list(cited)
+
+
+    @staticmethod
+    def n_tombstones(vectorstore:FAISS) -> int:
+        return vectorstore.index.ntotal - len(vectorstore.index_to_docstore_id)
+
+
+    @staticmethod
+    def get_compact_threshold(vectorstore:FAISS, compact_threshold="auto") -> float:
+        """
+        Resolves compact_threshold 'auto' to DEFAULT_COMPACT_THRESHOLD, or to None (never compact) for HNSW indexes:
+        compacting them rebuilds the whole graph, which costs as much as building the index.
+        """
+        if compact_threshold != "auto":
+            return compact_threshold
+        return None if hasattr(vectorstore.index, "hnsw") else DEFAULT_COMPACT_THRESHOLD
+
+
+    @staticmethod
+    def _compact_if_needed(vectorstore:FAISS, compact_threshold):
+        compact_threshold = VectorStoreUtils.get_compact_threshold(vectorstore, compact_threshold)
+        if not compact_threshold is None and VectorStoreUtils.n_tombstones(vectorstore) > compact_threshold * vectorstore.index.ntotal:
+            VectorStoreUtils.compact(vectorstore)
+
+
+    @staticmethod
+    def _commit(vectorstore:FAISS, version:tuple, source_chunks:dict, positions:dict, added:list, removed:list):
+        """
+        Marks the store as modified, passes the (position, chunk id, Document) of the added and removed chunks to
+        the structures derived from the store at version (see RetrievalUtils.update_derived) and re-attaches the
+        lookup tables that were updated in place.
+        """
+        RetrievalUtils.update_derived(vectorstore, version, added, removed)
+        RetrievalUtils.set_derived(vectorstore, "source_chunks", source_chunks)
+        RetrievalUtils.set_derived(vectorstore, "positions", positions)
+
+
+    @staticmethod
+    def append(vectorstore:FAISS, documents:List[Document], vectors) -> List[str]:
+        """
+        Appends chunks and their embeddings at the end of the index. The chunks must have ids (see
+        DataProcessor.with_chunk_ids) that are not in the store yet.
+
+        Returns:
+            list: The ids of the appended chunks.
+        """
+        source_chunks = VectorStoreUtils.get_source_chunks(vectorstore)
+        positions = VectorStoreUtils.get_positions(vectorstore)
+        version = RetrievalUtils.store_version(vectorstore)
+
+        ids = [doc.id for doc in documents]
+        if any(doc_id is None for doc_id in ids):
+            raise ValueError("Chunks must have an id to be added to the store.")
+        duplicates = [doc_id for doc_id in ids if doc_id in positions]
+        if len(duplicates) > 0 or len(set(ids)) < len(ids):
+            raise ValueError(f"Chunk ids are already in the store or repeated: {duplicates[:5]}")
+        if len(documents) == 0:
+            return []
+
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if vectorstore._normalize_L2:
+            faiss.normalize_L2(vectors)
+
+        start = vectorstore.index.ntotal
+        documents = [Document(id=doc.id, page_content=doc.page_content, metadata=doc.metadata) for doc in documents]
+        vectorstore.index.add(vectors)
+        vectorstore.docstore.add({doc.id: doc for doc in documents})
+        added = []
+        for offset, doc in enumerate(documents):
+            vectorstore.index_to_docstore_id[start + offset] = doc.id
+            positions[doc.id] = start + offset
+            source_chunks.setdefault(DataProcessor.source_key(doc.metadata), []).append(doc.id)
+            added.append((start + offset, doc.id, doc))
+
+        VectorStoreUtils._commit(vectorstore, version, source_chunks, positions, added, [])
+        return ids
+
+
+    @staticmethod
+    def delete(vectorstore:FAISS, ids:List[str], compact_threshold="auto") -> int:
+        """
+        Removes chunks by id, leaving tombstones in the index, and compacts the index if there are too many.
+
+        Returns:
+            int: Number of chunks removed.
+        """
+        source_chunks = VectorStoreUtils.get_source_chunks(vectorstore)
+        positions = VectorStoreUtils.get_positions(vectorstore)
+        version = RetrievalUtils.store_version(vectorstore)
+
+        ids = [doc_id for doc_id in dict.fromkeys(ids) if doc_id in positions]
+        if len(ids) == 0:
+            return 0
+
+        removed = []
+        touched_sources = set()
+        for doc_id in ids:
+            position = positions.pop(doc_id)
+            doc = vectorstore.docstore.search(doc_id)
+            if isinstance(doc, Document):
+                touched_sources.add(DataProcessor.source_key(doc.metadata))
+                removed.append((position, doc_id, doc))
+            else:
+                ## Without the chunk, the derived structures cannot be updated: they are rebuilt instead
+                version = None
+            del vectorstore.index_to_docstore_id[position]
+        vectorstore.docstore.delete(ids)
+
+        removed_ids = set(ids)
+        for source in touched_sources:
+            remaining = [doc_id for doc_id in source_chunks.get(source, []) if not doc_id in removed_ids]
+            if remaining:
+                source_chunks[source] = remaining
+            else:
+                source_chunks.pop(source, None)
+
+        VectorStoreUtils._commit(vectorstore, version, source_chunks, positions, [], removed)
+
+        VectorStoreUtils._compact_if_needed(vectorstore, compact_threshold)
+        return len(ids)
+
+
+    @staticmethod
+    def delete_source(vectorstore:FAISS, source, compact_threshold="auto") -> int:
+        """
+        Removes all chunks of a source, given by its source key or as a record of DataProcessor.list_sources.
+
+        Returns:
+            int: Number of chunks removed.
+        """
+        if isinstance(source, dict):
+            source = DataProcessor.source_key(source)
+        ids = list(VectorStoreUtils.get_source_chunks(vectorstore).get(source, []))
+        return VectorStoreUtils.delete(vectorstore, ids, compact_threshold=compact_threshold)
+
+
+    @staticmethod
+    def upsert_source(vectorstore:FAISS, source, documents, embeddings=None
+                        , compact_threshold="auto") -> dict:
+        """
+        Replaces all chunks of a source with documents (e.g. DataProcessor.iter_source_documents(source)), or adds
+        them if the source is not in the store yet. Chunks whose id, text and metadata are unchanged are kept as
+        they are; only new or modified chunks are embedded, with embeddings (the store's embedding model by default).
+        The work done is proportional to the size of the source, not of the store.
+
+        metadata['sources'] is left out of the comparison: the stored chunks cite the duplicates found across the
+        whole corpus, which deduplicating a single source cannot reproduce. Deleted chunks may have stood for
+        duplicates in other sources, which are returned as 'cited_sources' and must be re-run.
+
+        Returns:
+            dict: Numbers of chunks 'added', 'deleted' and 'unchanged', and the 'cited_sources' of the deleted
+                chunks (see cited_sources).
+        """
+        if isinstance(source, dict):
+            source = DataProcessor.source_key(source)
+        if embeddings is None:
+            embeddings = vectorstore.embedding_function
+
+        documents = list(DataProcessor.with_chunk_ids(documents))
+        for doc in documents:
+            if DataProcessor.source_key(doc.metadata) != source:
+                raise ValueError(f"Chunk {doc.id} belongs to {DataProcessor.source_key(doc.metadata)}, not to {source}.")
+
+        existing = set(VectorStoreUtils.get_source_chunks(vectorstore).get(source, []))
+        new_documents = []
+        unchanged = set()
+        for doc in documents:
+            current = vectorstore.docstore.search(doc.id) if doc.id in existing else None
+            if isinstance(current, Document) and current.page_content == doc.page_content \
+                    and VectorStoreUtils._without_sources(current.metadata) == VectorStoreUtils._without_sources(doc.metadata):
+                unchanged.add(doc.id)
+            else:
+                new_documents.append(doc)
+
+        ## Deleting first lets a modified chunk be re-added under the same id. Compaction waits until the end.
+        deleted = [doc_id for doc_id in existing if not doc_id in unchanged]
+        cited_sources = [key for key in VectorStoreUtils.cited_sources(vectorstore, deleted) if key != source]
+        n_deleted = VectorStoreUtils.delete(vectorstore, deleted, compact_threshold=None)
+        if len(new_documents) > 0:
+            vectors = embeddings.embed_documents([doc.page_content for doc in new_documents])
+            VectorStoreUtils.append(vectorstore, new_documents, vectors)
+
+        VectorStoreUtils._compact_if_needed(vectorstore, compact_threshold)
+
+        return {'added': len(new_documents), 'deleted': n_deleted, 'unchanged': len(unchanged), 'cited_sources': cited_sources}
+
+
+    @staticmethod
+    def _without_sources(metadata:dict) -> dict:
+        return {field: value for field, value in metadata.items() if field != 'sources'}
+
+
+    @staticmethod
+    def compact(vectorstore:FAISS) -> int:
+        """
+        Removes the tombstoned vectors from the FAISS index. The remaining vectors keep their order and
+        index_to_docstore_id becomes dense again. An OffsetDocstore also drops the text that only deleted chunks used.
+
+        Flat and IVF indexes drop the tombstoned vectors in place (index.remove_ids): the codes of the remaining
+        vectors are kept as they are, so repeated compactions do not re-encode them. HNSW graphs do not support
+        removal: the index is rebuilt from the reconstructed vectors, which costs as much as building it.
+
+        Returns:
+            int: Number of tombstones removed.
+        """
+        n_tombstones = VectorStoreUtils.n_tombstones(vectorstore)
+        if n_tombstones == 0:
+            return 0
+
+        index = vectorstore.index
+        live_positions = np.asarray(sorted(vectorstore.index_to_docstore_id), dtype=np.int64)
+
+        if hasattr(index, "hnsw"):
+            compacted = faiss.clone_index(index)
+            compacted.reset()
+            IndexUtils.set_search_params(compacted, **IndexUtils.get_search_params(index))
+            for start in range(0, len(live_positions), _COMPACT_BATCH_SIZE):
+                compacted.add(index.reconstruct_batch(live_positions[start:start + _COMPACT_BATCH_SIZE]))
+            vectorstore.index = compacted
+        else:
+            VectorStoreUtils._remove_positions(index, live_positions)
+
+        vectorstore.index_to_docstore_id = {new_pos: vectorstore.index_to_docstore_id[int(old_pos)]
+                                                for new_pos, old_pos in enumerate(live_positions)}
+        ## The text of deleted chunks is only dropped from an OffsetDocstore when it is compacted
+        if hasattr(vectorstore.docstore, 'compact'):
+            vectorstore.docstore.compact()
+        RetrievalUtils.bump_revision(vectorstore)
+        return n_tombstones
+
+
+    @staticmethod
+    def _remove_positions(index, live_positions:np.ndarray):
+        """
+        Removes the vectors that are not at live_positions from a flat or IVF index, in place. The remaining
+        vectors are renumbered by their rank in live_positions.
+        """
+        live = faiss.IDSelectorBatch(live_positions)
+        removed = faiss.IDSelectorNot(live)
+        try:
+            ivf = faiss.extract_index_ivf(index)
+        except RuntimeError:
+            ## Flat indexes shift the remaining vectors down, which renumbers them
+            index.remove_ids(removed)
+            return
+
+        new_positions = np.full(index.ntotal, -1, dtype=np.int64)
+        new_positions[live_positions] = np.arange(len(live_positions), dtype=np.int64)
+        ## IVF indexes can only remove vectors without a direct map, which is rebuilt afterwards
+        ivf.set_direct_map_type(faiss.DirectMap.NoMap)
+        index.remove_ids(removed)
+        ## The inverted lists still hold the old positions as ids: they are renumbered, and the codes copied back as they are
+        for list_no in range(ivf.nlist):
+            ids, codes = get_invlist(ivf.invlists, list_no)
+            if len(ids) > 0:
+                ## swig_ptr does not keep its array alive: both must be held until the entries are updated
+                ids = new_positions[ids]
+                codes = np.ascontiguousarray(codes)
+                ivf.invlists.update_entries(list_no, 0, len(ids), faiss.swig_ptr(ids), faiss.swig_ptr(codes))
+        IndexUtils.prepare_index(index)